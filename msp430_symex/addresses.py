@@ -0,0 +1,229 @@
+"""
+Reading and writing memory at symbolic addresses.
+
+Without this, Memory raises SymbolicAddressError on an address that isn't a
+single value (say, a lookup table indexed by an input byte), which stops the
+whole run. An AddressResolver, set as a Memory's addresses, handles those
+accesses instead.
+
+First it works out the range [lo, hi] the address can take on the state's
+path, by binary search with the solver. If that's a single value, the access
+is concrete. If the range is small (up to max_range bytes), a read is an If
+chain over the bytes in it, and a write updates every byte in it:
+
+    read(a) = If(a == lo, m[lo], If(a == lo + 1, m[lo + 1], ...))
+    m[x] = If(a == x, value, m[x]) for x in [lo, hi]
+
+Bytes that hold the same value as the last one in the range are left out of
+the chain, so a read out of mostly zeroed memory stays small.
+
+Bigger ranges go by the resolver's policy:
+
+    'array'     reads select from a z3 Array of the bytes in the range that
+                aren't zero, so only those go in the expression (writes
+                fall back to 'solutions')
+    'min'       the address is concretized to its lowest value on the path
+    'max'       ... or its highest
+    'solutions' the address is concretized to the first max_solutions values
+                the solver finds, and handled like a small range of those
+
+Concretizing adds a condition to the path saying the address is one of the
+values picked, so it's sound but not complete: the states where the address
+was something else are lost.
+
+Ranges are cached on the address and the path predicate, so reading both
+bytes of a word, or reading back the same index, only searches once.
+"""
+import z3
+
+from .constants import BYTE_VALUES, word
+from .memory import PAGE_SIZE, SymbolicAddressError
+
+
+POLICIES = ('array', 'min', 'max', 'solutions')
+
+# how many (address, path) ranges to keep, before dropping them all
+MAX_RANGES = 1 << 12
+
+
+class AddressResolver:
+    """
+    Resolves symbolic addresses for a Memory (and its clones), see the module
+    docstring
+    """
+    def __init__(self, max_range=0x100, policy='array', max_solutions=8):
+        if policy not in POLICIES:
+            raise ValueError('unknown policy {!r}, expected one of {}'.format( \
+                    policy, ', '.join(POLICIES)))
+        self.max_range = max_range
+        self.policy = policy
+        self.max_solutions = max_solutions
+        # (address id, pred id) -> ((address, pred), (lo, hi))
+        self._ranges = {}
+
+    def settings(self):
+        """
+        The arguments to build an AddressResolver like this one with
+        """
+        return {'max_range': self.max_range, 'policy': self.policy, \
+                'max_solutions': self.max_solutions}
+
+    @staticmethod
+    def _solver(path):
+        solver = z3.Solver()
+        if path is not None:
+            solver.add(path.pred())
+        return solver
+
+    def range(self, address, path):
+        """
+        The lowest and highest values address can take on path (None for
+        both if path is unsat)
+        """
+        pred = path.pred() if path is not None else z3.BoolVal(True)
+        key = (address.get_id(), pred.get_id())
+        entry = self._ranges.get(key)
+        if entry is None:
+            if len(self._ranges) >= MAX_RANGES:
+                self._ranges.clear()
+            entry = self._ranges[key] = ((address, pred), \
+                    self._search(address, path))
+        return entry[1]
+
+    def _search(self, address, path):
+        solver = self._solver(path)
+        if solver.check() != z3.sat:
+            return None, None
+        # start from the value the solver found, and narrow down both ways
+        value = solver.model().eval(address, model_completion=True).as_long()
+
+        def lowest(lo, hi, condition):
+            # the lowest v in [lo, hi] with condition(v) sat, given that
+            # condition(hi) is
+            while lo < hi:
+                mid = (lo + hi) // 2
+                solver.push()
+                solver.add(condition(mid))
+                if solver.check() == z3.sat:
+                    hi = mid
+                else:
+                    lo = mid + 1
+                solver.pop()
+            return lo
+
+        lo = lowest(0, value, lambda v: z3.ULE(address, v))
+        # the highest v with UGE(address, v) is 0xffff - the lowest of ~v
+        hi = 0xffff - lowest(0, 0xffff - value, \
+                lambda v: z3.UGE(address, 0xffff - v))
+        return lo, hi
+
+    def _solutions(self, address, path):
+        solver = self._solver(path)
+        values = []
+        while len(values) < self.max_solutions and solver.check() == z3.sat:
+            value = solver.model().eval(address, model_completion=True)
+            values.append(value.as_long())
+            solver.add(address != value)
+        return values
+
+    def _concretize(self, address, path, lo, hi, policy):
+        """
+        Pick the values of address to keep by policy, and constrain path to
+        them
+        """
+        if path is None:
+            raise SymbolicAddressError( \
+                    'no path to concretize {} on'.format(address))
+        if policy == 'min':
+            values = [lo]
+        elif policy == 'max':
+            values = [hi]
+        else:
+            values = self._solutions(address, path)
+        path.add(z3.Or(*[address == word(value) for value in values]))
+        return values
+
+    def _choices(self, memory, address, addresses):
+        """
+        The byte at address, which is one of addresses, as an If chain
+        """
+        last = memory._read(addresses[-1])
+        value = BYTE_VALUES[last] if isinstance(last, int) else last
+        for addr in reversed(addresses[:-1]):
+            byte = memory._read(addr)
+            if isinstance(byte, int):
+                if byte == last:
+                    continue
+                byte = BYTE_VALUES[byte]
+            elif not isinstance(last, int) and byte.eq(last):
+                continue
+            value = z3.If(address == word(addr), byte, value)
+        return value
+
+    def _array(self, memory, address, lo, hi):
+        """
+        The byte at address, in [lo, hi], selected from an Array of the bytes
+        in there that aren't zero
+        """
+        array = z3.K(z3.BitVecSort(16), BYTE_VALUES[0])
+        for page_number in range(lo // PAGE_SIZE, hi // PAGE_SIZE + 1):
+            page = memory._pages[page_number]
+            if not any(page):
+                continue
+            base = page_number * PAGE_SIZE
+            for offset, byte in enumerate(page):
+                if byte and lo <= base + offset <= hi:
+                    array = z3.Store(array, word(base + offset), \
+                            BYTE_VALUES[byte])
+        for addr, byte in sorted(memory._symbolic.items()):
+            if lo <= addr <= hi:
+                array = z3.Store(array, word(addr), byte)
+        # z3's default solver case splits on a select from a long chain of
+        # stores, and can take seconds over a few hundred of them. The same
+        # select rewritten into a chain of Ifs over the stored addresses is
+        # solved as fast as the small range chains.
+        return z3.simplify(z3.Select(array, address), \
+                expand_select_store=True)
+
+    def _addresses(self, memory, address, policy):
+        """
+        The addresses address can be at, after concretizing by policy if
+        there are too many. None if the path is unsat, or 'array' if the
+        read should go through an Array.
+        """
+        lo, hi = self.range(address, memory.path)
+        if lo is None:
+            memory.path.make_unsat()
+            return None
+        if hi - lo < self.max_range:
+            return list(range(lo, hi + 1))
+        if policy == 'array':
+            return policy
+        return self._concretize(address, memory.path, lo, hi, policy)
+
+    def read(self, memory, address):
+        """
+        The byte in memory at the symbolic address
+        """
+        addresses = self._addresses(memory, address, self.policy)
+        if addresses is None:
+            return BYTE_VALUES[0]
+        if addresses == 'array':
+            return self._array(memory, address, *self.range(address, memory.path))
+        if len(addresses) == 1:
+            return memory[addresses[0]]
+        return self._choices(memory, address, addresses)
+
+    def write(self, memory, address, value):
+        """
+        Write the byte value to memory at the symbolic address
+        """
+        policy = 'solutions' if self.policy == 'array' else self.policy
+        addresses = self._addresses(memory, address, policy)
+        if addresses is None:
+            return
+        if len(addresses) == 1:
+            memory[addresses[0]] = value
+            return
+        for addr in addresses:
+            memory[addr] = z3.If(address == word(addr), value, memory[addr])
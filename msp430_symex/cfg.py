@@ -1,7 +1,6 @@
 from z3 import simplify
 
 from .code import Opcode, Register, AddressingMode, decode_instruction
-from .state import State
 
 def intval(val):
     """
@@ -59,9 +58,17 @@ class CFG:
 
             while not found_jump:
                 raw = self.memory[ip : ip + 6]
-                insn, insn_len = decode_instruction(ip, raw)
-
-                if insn.opcode == Opcode.CALL:
+                try:
+                    insn, insn_len = decode_instruction(ip, raw)
+                except AssertionError:
+                    # not code (or not code yet, e.g. packed code), so
+                    # end the block here
+                    boundaries.add(ip)
+                    break
+
+                # only follow calls to known addresses (not call r15)
+                if insn.opcode == Opcode.CALL and \
+                        insn.addressing_mode == AddressingMode.IMMEDIATE:
                     called = intval(insn.operand)
                     called_addrs.add((ip, called))
 
@@ -100,9 +107,12 @@ class CFG:
             ip = start_addr
             last_addr = start_addr
             # step up instructions to the one that *ends* at end_addr
-            while ip != end_addr:
+            while ip < end_addr:
                 raw = self.memory[ip : ip + 6]
-                insn, insn_len = decode_instruction(ip, raw)
+                try:
+                    insn, insn_len = decode_instruction(ip, raw)
+                except AssertionError:
+                    break # undecodable, see above
                 instructions.append(insn)
                 last_addr = ip
                 ip += insn_len
@@ -116,15 +126,16 @@ class CFG:
 
             bbs.append(bb)
 
-        fn = Function(bbs)
+        fn = Function(bbs, entry_point)
 
         return fn, {addr for _, addr in called_addrs}
 
 
 class Function:
 
-    def __init__(self, basic_blocks):
+    def __init__(self, basic_blocks, entry_point=None):
         self.basic_blocks = basic_blocks
+        self.entry_point = entry_point
 
 
 class BasicBlock:
@@ -7,7 +7,9 @@ by length, and you can do whatever you want with the instructions.
 I recommend symbolically executing them! :)
 """
 from enum import Enum, unique
-from z3 import is_bv, simplify, BitVecVal
+from z3 import is_bv, simplify
+
+from .constants import word
 
 
 @unique
@@ -167,6 +169,280 @@ class DoubleOperandInstruction:
             self.dest_operand)
 
 
+# Tables for pulling fields out of instruction words
+
+_registers = {i: Register(i) for i in range(16)}
+
+_single_operand_opcodes = {
+    0b000: Opcode.RRC,
+    0b001: Opcode.SWPB,
+    0b010: Opcode.RRA,
+    0b011: Opcode.SXT,
+    0b100: Opcode.PUSH,
+    0b101: Opcode.CALL,
+    0b110: Opcode.RETI,
+}
+
+_jump_opcodes = {
+    0b000: Opcode.JNZ,
+    0b001: Opcode.JZ,
+    0b010: Opcode.JNC,
+    0b011: Opcode.JC,
+    0b100: Opcode.JN,
+    0b101: Opcode.JGE,
+    0b110: Opcode.JL,
+    0b111: Opcode.JMP,
+}
+
+_double_operand_opcodes = {
+    0b0100: Opcode.MOV,
+    0b0101: Opcode.ADD,
+    0b0110: Opcode.ADDC,
+    0b0111: Opcode.SUBC,
+    0b1000: Opcode.SUB,
+    0b1001: Opcode.CMP,
+    0b1010: Opcode.DADD,
+    0b1011: Opcode.BIT,
+    0b1100: Opcode.BIC,
+    0b1101: Opcode.BIS,
+    0b1110: Opcode.XOR,
+    0b1111: Opcode.AND,
+}
+
+_widths = {
+    0b0: OperandWidth.WORD,
+    0b1: OperandWidth.BYTE,
+}
+
+# source (and single-operand) addressing modes, by register
+_normal_addressing_modes = {
+    0b00: AddressingMode.DIRECT,
+    0b01: AddressingMode.INDEXED,
+    0b10: AddressingMode.INDIRECT,
+    0b11: AddressingMode.AUTOINCREMENT,
+}
+_addressing_modes = {
+    Register.R0: { # R0 special
+        0b00: AddressingMode.DIRECT,
+        0b01: AddressingMode.SYMBOLIC,
+        0b10: AddressingMode.INDIRECT,
+        0b11: AddressingMode.IMMEDIATE,
+    },
+    Register.R2: { # R2 special
+        0b00: AddressingMode.DIRECT,
+        0b01: AddressingMode.ABSOLUTE,
+        0b10: AddressingMode.CONSTANT4,
+        0b11: AddressingMode.CONSTANT8,
+    },
+    Register.R3: { # R3 special
+        0b00: AddressingMode.CONSTANT0,
+        0b01: AddressingMode.CONSTANT1,
+        0b10: AddressingMode.CONSTANT2,
+        0b11: AddressingMode.CONSTANTNEG1,
+    },
+}
+
+# destination addressing modes, by register
+_normal_dest_addressing_modes = {
+    0b0: AddressingMode.DIRECT,
+    0b1: AddressingMode.INDEXED,
+}
+_dest_addressing_modes = {
+    Register.R0: {
+        0b0: AddressingMode.DIRECT,
+        0b1: AddressingMode.SYMBOLIC,
+    },
+    Register.R2: {
+        0b0: AddressingMode.DIRECT,
+        0b1: AddressingMode.ABSOLUTE,
+    },
+}
+
+# operand is in the instruction stream for these
+_modes_with_operands = {
+    AddressingMode.IMMEDIATE,
+    AddressingMode.INDEXED,
+    AddressingMode.SYMBOLIC,
+    AddressingMode.ABSOLUTE,
+}
+
+is_single_operand_instruction = lambda x: (x >> 10) == 0b000100
+is_jump_instruction = lambda x: (x >> 13) == 0b001
+is_double_operand_instruction = lambda x: \
+        not is_single_operand_instruction(x) and not is_jump_instruction(x)
+
+
+class SingleOperandTemplate:
+    """
+    Everything about a single-operand instruction that is determined by its
+    instruction word
+    """
+    def __init__(self, word):
+        assert word <= 0xFFFF
+        assert is_single_operand_instruction(word), \
+                'Passed in a non-single operand instruction to decode_single_operand_instruction'
+
+        raw_opcode = (word >> 7) & 0b111
+        assert raw_opcode in _single_operand_opcodes, 'Invalid Opcode: {}'.format(raw_opcode)
+
+        self.opcode = _single_operand_opcodes[raw_opcode]
+        self.width = _widths[(word >> 6) & 0b1]
+        self.register = _registers[word & 0b1111]
+        self.addressing_mode = _addressing_modes.get(self.register, \
+                _normal_addressing_modes)[(word >> 4) & 0b11]
+        self.operand_size = 2 if self.addressing_mode in _modes_with_operands else 0
+        self.length = 2 + self.operand_size
+
+    def decode(self, address, data):
+        operand = None
+        if self.operand_size:
+            operand = word(int.from_bytes(data[2:4], 'little'))
+        return SingleOperandInstruction(data[:self.length], address, \
+                self.opcode, self.width, self.addressing_mode, self.register, \
+                operand), self.length
+
+
+class JumpTemplate:
+    """
+    Everything about a jump instruction that is determined by its
+    instruction word
+    """
+    def __init__(self, word):
+        assert word <= 0xFFFF
+        assert is_jump_instruction(word)
+
+        self.opcode = _jump_opcodes[(word >> 10) & 0b111]
+
+        # NOTE: decoded offset is 1/2 the actual offset, so multiply by 2
+        magnitude = 2 * (word & 0b111111111)
+        sign_bit = (word >> 9) & 0b1
+        if sign_bit == 1:
+            self.offset = -(2**10 - magnitude) # 2's complement
+        else:
+            self.offset = magnitude
+        self.length = 2
+
+    def decode(self, address, data):
+        target = address + 2 + self.offset # +2 because PC is pre-incremented
+        if not is_bv(target): # wrap non-BVs into BVs
+            target = word(target)
+        return JumpInstruction(data[:2], address, self.opcode, target), 2
+
+
+class DoubleOperandTemplate:
+    """
+    Everything about a double-operand instruction that is determined by its
+    instruction word
+    """
+    def __init__(self, word):
+        assert word <= 0xFFFF
+
+        raw_opcode = (word >> 12) & 0b1111
+        assert raw_opcode in _double_operand_opcodes, \
+                'Invalid opcode for double-operand instruction: {} (full: 0x{:04x})'.format(raw_opcode, word)
+
+        self.opcode = _double_operand_opcodes[raw_opcode]
+        self.width = _widths[(word >> 6) & 0b1]
+        self.source_register = _registers[(word >> 8) & 0b1111]
+        # TODO: check dest registers are movable into (Not R3?)
+        self.dest_register = _registers[word & 0b1111]
+        self.source_addressing_mode = _addressing_modes.get(self.source_register, \
+                _normal_addressing_modes)[(word >> 4) & 0b11]
+        self.dest_addressing_mode = _dest_addressing_modes.get(self.dest_register, \
+                _normal_dest_addressing_modes)[(word >> 7) & 0b1]
+
+        self.source_size = 2 if self.source_addressing_mode in _modes_with_operands else 0
+        self.dest_size = 2 if self.dest_addressing_mode in _modes_with_operands else 0
+        self.length = 2 + self.source_size + self.dest_size
+
+    def decode(self, address, data):
+        current_offset = 2 # after the instruction
+        source_operand = None
+        if self.source_size:
+            raw = data[current_offset : current_offset + 2]
+            source_operand = word(int.from_bytes(raw, 'little'))
+            current_offset += 2 # advance instruction stream by the # of bytes we pulled off
+        dest_operand = None
+        if self.dest_size:
+            raw = data[current_offset : current_offset + 2]
+            dest_operand = word(int.from_bytes(raw, 'little'))
+            current_offset += 2
+
+        return DoubleOperandInstruction(data[:self.length], address, \
+                self.opcode, self.width, self.source_addressing_mode, \
+                self.source_register, source_operand, self.dest_addressing_mode, \
+                self.dest_register, dest_operand), self.length
+
+
+def make_template(word):
+    """
+    Build the decode template for a 16-bit instruction word
+    """
+    if is_single_operand_instruction(word):
+        return SingleOperandTemplate(word)
+    elif is_jump_instruction(word):
+        return JumpTemplate(word)
+    elif is_double_operand_instruction(word):
+        return DoubleOperandTemplate(word)
+    else:
+        raise ValueError( \
+            '0x{:x} does not look like a valid MSP430 instruction!'.format( \
+                word))
+
+
+# instruction word -> template, filled in on first use of each word
+_decode_table = [None] * 0x10000
+
+
+def get_template(word):
+    """
+    Get the (cached) decode template for a 16-bit instruction word
+    """
+    template = _decode_table[word]
+    if template is None:
+        template = make_template(word)
+        _decode_table[word] = template
+    return template
+
+
+def build_decode_table():
+    """
+    Fill in the template for every valid instruction word up front, instead
+    of as they are first seen
+    """
+    for word in range(0x10000):
+        if _decode_table[word] is None:
+            try:
+                _decode_table[word] = make_template(word)
+            except AssertionError:
+                pass # not a valid instruction, nothing to cache
+
+
+# address -> (instruction, length) of the last instruction decoded there.
+# Shared by every state, entries are checked against the bytes being decoded
+# so code that gets rewritten at runtime is just decoded again.
+_decode_cache = {}
+
+
+def clear_decode_cache():
+    """
+    Forget every cached instruction decode
+    """
+    _decode_cache.clear()
+
+
+def _raw_matches(raw, data):
+    """
+    Are the first len(raw) bytes of data the concrete bytes in raw?
+    """
+    if len(data) < len(raw):
+        return False
+    for expected, actual in zip(raw, data):
+        if not isinstance(actual, int) or actual != expected:
+            return False
+    return True
+
+
 def decode_instruction(address, data):
     """
     data is the raw bytes, in little-endian, of at least the area containing
@@ -174,32 +450,65 @@ def decode_instruction(address, data):
     You can give more, but you need at least enough to fully decode the
     instruction, so 6 bytes should be enough.
 
+    Decodes at concrete addresses are cached, so decoding the same code
+    again is just a lookup.
+
 
     Reference: http://mspgcc.sourceforge.net/manual/x223.html
                https://en.wikipedia.org/wiki/MSP430#MSP430_CPU
     """
+    if not isinstance(address, int):
+        return _decode_instruction(address, data)
+
+    cached = _decode_cache.get(address)
+    if cached is not None and _raw_matches(cached[0].raw, data):
+        return cached
+
+    decoded = _decode_instruction(address, data)
+    _decode_cache[address] = decoded
+    return decoded
 
-    is_single_operand_instruction = lambda x: (x >> 10) == 0b000100
-    is_jump_instruction = lambda x: (x >> 13) == 0b001
-    is_double_operand_instruction = lambda x: \
-            not is_single_operand_instruction(x) and not is_jump_instruction(x)
 
+def _decode_instruction(address, data):
+    """
+    Decode an instruction, without going through the cache
+    """
     # turn a list of BitVecVals and ints into a list of ints
     unBVV = lambda l: [simplify(x).as_long() if is_bv(x) else x for x in data]
 
     data = unBVV(data)
     instruction = int.from_bytes(data[:2], 'little')
 
-    if is_single_operand_instruction(instruction):
-        return decode_single_operand_instruction(address, data)
-    elif is_jump_instruction(instruction):
-        return decode_jump_instruction(address, data)
-    elif is_double_operand_instruction(instruction):
-        return decode_double_operand_instruction(address, data)
-    else:
-        raise ValueError( \
-            '0x{:x} does not look like a valid MSP430 instruction!'.format( \
-                instruction))
+    return get_template(instruction).decode(address, data)
+
+
+def decode_image(data, start=0, end=None):
+    """
+    Decode every word-aligned instruction in data, a whole memory image (or
+    any other list of concrete bytes, starting at address 0).
+
+    Returns a dict address -> (instruction, length), skipping addresses that
+    do not hold a valid instruction. Every decode also goes into the decode
+    cache, so states stepping through this image never decode again.
+    """
+    if end is None:
+        end = len(data)
+    data = list(data[:end + 4]) # room for operands of the last instruction
+    start += start & 1 # instructions are word-aligned
+
+    decoded = {}
+    for address in range(start, end - 1, 2):
+        window = data[address : address + 6]
+        try:
+            template = get_template(int.from_bytes(window[:2], 'little'))
+        except AssertionError:
+            continue # not an instruction
+        if len(window) < template.length:
+            continue # runs off the end of the image
+        insn = template.decode(address, window)
+        decoded[address] = insn
+        _decode_cache[address] = insn
+    return decoded
 
 
 def decode_single_operand_instruction(address, data):
@@ -211,112 +520,10 @@ def decode_single_operand_instruction(address, data):
 
     top 6 bits are 000100
     """
-
     instruction = int.from_bytes(data[:2], 'little') # decode instruction
-
-    assert instruction <= 0xFFFF
-    assert (instruction >> 10) == 0b000100, \
+    assert is_single_operand_instruction(instruction), \
             'Passed in a non-single operand instruction to decode_single_operand_instruction'
-
-
-    opcodes = {
-        0b000: Opcode.RRC,
-        0b001: Opcode.SWPB,
-        0b010: Opcode.RRA,
-        0b011: Opcode.SXT,
-        0b100: Opcode.PUSH,
-        0b101: Opcode.CALL,
-        0b110: Opcode.RETI,
-    }
-    def get_opcode(instruction):
-        raw = (instruction >> 7) & 0b111
-        assert raw in opcodes, 'Invalid Opcode: {}'.format(raw)
-        return opcodes[raw]
-
-    widths = {
-        0b0: OperandWidth.WORD,
-        0b1: OperandWidth.BYTE,
-    }
-    get_width = lambda x: widths[(x >> 6) & 0b1]
-
-    registers = {
-        0b0000: Register.R0,
-        0b0001: Register.R1,
-        0b0010: Register.R2,
-        0b0011: Register.R3,
-        0b0100: Register.R4,
-        0b0101: Register.R5,
-        0b0110: Register.R6,
-        0b0111: Register.R7,
-        0b1000: Register.R8,
-        0b1001: Register.R9,
-        0b1010: Register.R10,
-        0b1011: Register.R11,
-        0b1100: Register.R12,
-        0b1101: Register.R13,
-        0b1110: Register.R14,
-        0b1111: Register.R15,
-    }
-    get_register = lambda x: registers[(x & 0b1111)]
-
-    normal_addressing_modes = {
-        0b00: AddressingMode.DIRECT,
-        0b01: AddressingMode.INDEXED,
-        0b10: AddressingMode.INDIRECT,
-        0b11: AddressingMode.AUTOINCREMENT,
-    }
-    r0_addressing_modes = {
-        0b00: AddressingMode.DIRECT,
-        0b01: AddressingMode.SYMBOLIC,
-        0b10: AddressingMode.INDIRECT,
-        0b11: AddressingMode.IMMEDIATE,
-    }
-    r2_addressing_modes = {
-        0b00: AddressingMode.DIRECT,
-        0b01: AddressingMode.ABSOLUTE,
-        0b10: AddressingMode.CONSTANT4,
-        0b11: AddressingMode.CONSTANT8,
-    }
-    r3_addressing_modes = {
-        0b00: AddressingMode.CONSTANT0,
-        0b01: AddressingMode.CONSTANT1,
-        0b10: AddressingMode.CONSTANT2,
-        0b11: AddressingMode.CONSTANTNEG1,
-    }
-    def get_addressing_mode(instruction, dest_register):
-        mode = (instruction >> 4) & 0b11
-        if dest_register == Register.R0: # R0 special
-            return r0_addressing_modes[mode]
-        elif dest_register == Register.R2: # R2 special
-            return r2_addressing_modes[mode]
-        elif dest_register == Register.R3: # R3 special
-            return r3_addressing_modes[mode]
-        else: # normal
-            return normal_addressing_modes[mode]
-
-    def get_operand(data, addressing_mode):
-        n_bytes = 2
-
-        modes_with_operands = {AddressingMode.IMMEDIATE, \
-                AddressingMode.INDEXED, \
-                AddressingMode.SYMBOLIC, \
-                AddressingMode.ABSOLUTE}
-        if addressing_mode in modes_with_operands: # operand is in the instruction stream, extract
-            operand = int.from_bytes(data[2:2+n_bytes], 'little')
-            operand = BitVecVal(operand, 8 * n_bytes)
-            return operand, n_bytes
-        else: # no operand
-            return None, 0
-
-    opcode = get_opcode(instruction)
-    width = get_width(instruction)
-    register = get_register(instruction)
-    addressing_mode = get_addressing_mode(instruction, register)
-    operand, operand_size = get_operand(data, addressing_mode)
-
-    return SingleOperandInstruction(data[:2+operand_size], \
-            address, opcode, width, addressing_mode, register, operand), \
-            2 + operand_size
+    return get_template(instruction).decode(address, data)
 
 
 def decode_jump_instruction(address, data):
@@ -329,38 +536,8 @@ def decode_jump_instruction(address, data):
     top 3 bits of data are 001
     """
     instruction = int.from_bytes(data[:2], 'little') # decode instruction
-
-    assert instruction <= 0xFFFF
-    assert (instruction >> 13) == 0b001
-
-    opcodes = {
-        0b000: Opcode.JNZ,
-        0b001: Opcode.JZ,
-        0b010: Opcode.JNC,
-        0b011: Opcode.JC,
-        0b100: Opcode.JN,
-        0b101: Opcode.JGE,
-        0b110: Opcode.JL,
-        0b111: Opcode.JMP,
-    }
-    get_opcode = lambda x: opcodes[(instruction >> 10) & 0b111]
-
-    def get_offset(instruction):
-        # NOTE: decoded offset is 1/2 the actual offset, so multiply by 2
-        magnitude = 2 * (instruction & 0b111111111)
-        sign_bit = (instruction >> 9) & 0b1
-        if sign_bit == 1:
-            return -(2**10 - magnitude) # 2's complement
-        else:
-            return magnitude
-
-    opcode = get_opcode(instruction)
-    offset = get_offset(instruction)
-    target = address + 2 + offset # +2 because PC is pre-incremented
-    if not is_bv(target): # wrap non-BVs into BVs
-        target = BitVecVal(target, 16)
-
-    return JumpInstruction(data[:2], address, opcode, target), 2
+    assert is_jump_instruction(instruction)
+    return get_template(instruction).decode(address, data)
 
 
 def decode_double_operand_instruction(address, data):
@@ -371,144 +548,5 @@ def decode_double_operand_instruction(address, data):
     instruction, so 6 bytes should be enough.
     """
     instruction = int.from_bytes(data[:2], 'little') # decode instruction
-
-    assert instruction <= 0xFFFF
-
-    opcodes = {
-        0b0100: Opcode.MOV,
-        0b0101: Opcode.ADD,
-        0b0110: Opcode.ADDC,
-        0b0111: Opcode.SUBC,
-        0b1000: Opcode.SUB,
-        0b1001: Opcode.CMP,
-        0b1010: Opcode.DADD,
-        0b1011: Opcode.BIT,
-        0b1100: Opcode.BIC,
-        0b1101: Opcode.BIS,
-        0b1110: Opcode.XOR,
-        0b1111: Opcode.AND,
-    }
-    def get_opcode(instruction):
-        raw = (instruction >> 12) & 0b1111
-        assert raw in opcodes, 'Invalid opcode for double-operand instruction: {} @ {} (full: {})'.format(raw, address, data)
-        return opcodes[raw]
-
-    registers = {
-        0b0000: Register.R0,
-        0b0001: Register.R1,
-        0b0010: Register.R2,
-        0b0011: Register.R3,
-        0b0100: Register.R4,
-        0b0101: Register.R5,
-        0b0110: Register.R6,
-        0b0111: Register.R7,
-        0b1000: Register.R8,
-        0b1001: Register.R9,
-        0b1010: Register.R10,
-        0b1011: Register.R11,
-        0b1100: Register.R12,
-        0b1101: Register.R13,
-        0b1110: Register.R14,
-        0b1111: Register.R15,
-    }
-    get_source_register = lambda x: registers[(instruction >> 8) & 0b1111]
-    # TODO: check dest registers are movable into (Not R3?)
-    get_dest_register = lambda x: registers[instruction & 0b1111]
-
-    normal_source_addressing_modes = {
-        0b00: AddressingMode.DIRECT,
-        0b01: AddressingMode.INDEXED,
-        0b10: AddressingMode.INDIRECT,
-        0b11: AddressingMode.AUTOINCREMENT,
-    }
-    r0_source_addressing_modes = {
-        0b00: AddressingMode.DIRECT,
-        0b01: AddressingMode.SYMBOLIC,
-        0b10: AddressingMode.INDIRECT,
-        0b11: AddressingMode.IMMEDIATE,
-    }
-    r2_source_addressing_modes = {
-        0b00: AddressingMode.DIRECT,
-        0b01: AddressingMode.ABSOLUTE,
-        0b10: AddressingMode.CONSTANT4,
-        0b11: AddressingMode.CONSTANT8,
-    }
-    r3_source_addressing_modes = {
-        0b00: AddressingMode.CONSTANT0,
-        0b01: AddressingMode.CONSTANT1,
-        0b10: AddressingMode.CONSTANT2,
-        0b11: AddressingMode.CONSTANTNEG1,
-    }
-    def get_source_addressing_mode(instruction, register):
-        raw = (instruction >> 4) & 0b11
-        if register == Register.R0:
-            return r0_source_addressing_modes[raw]
-        elif register == Register.R2:
-            return r2_source_addressing_modes[raw]
-        elif register == Register.R3:
-            return r3_source_addressing_modes[raw]
-        else:
-            return normal_source_addressing_modes[raw]
-
-    normal_dest_addressing_modes = {
-        0b0: AddressingMode.DIRECT,
-        0b1: AddressingMode.INDEXED,
-    }
-    r0_dest_addressing_modes = {
-        0b0: AddressingMode.DIRECT,
-        0b1: AddressingMode.SYMBOLIC,
-    }
-    r2_dest_addressing_modes = {
-        0b0: AddressingMode.DIRECT,
-        0b1: AddressingMode.ABSOLUTE,
-    }
-    def get_dest_addressing_mode(instruction, register):
-        raw = (instruction >> 7) & 0b1
-        if register == Register.R0:
-            return r0_dest_addressing_modes[raw]
-        elif register == Register.R2:
-            return r2_dest_addressing_modes[raw]
-        else:
-            return normal_dest_addressing_modes[raw]
-
-    widths = {
-        0b0: OperandWidth.WORD,
-        0b1: OperandWidth.BYTE,
-    }
-    get_operand_width = lambda x: widths[(x >> 6) & 0b1]
-
-    def get_operand(data, addressing_mode, current_offset):
-        n_bytes = 2
-
-        modes_with_operands = { \
-            AddressingMode.IMMEDIATE, \
-            AddressingMode.INDEXED, \
-            AddressingMode.ABSOLUTE, \
-            AddressingMode.SYMBOLIC \
-        }
-        if addressing_mode in modes_with_operands: # operand is in the instruction stream, extract
-            raw = data[current_offset : current_offset + n_bytes]
-            operand = int.from_bytes(raw, 'little')
-            operand = BitVecVal(operand, 8 * n_bytes)
-            return operand, n_bytes
-        else: # no operand
-            return None, 0
-
-    opcode = get_opcode(instruction)
-    source_register = get_source_register(instruction)
-    dest_register = get_dest_register(instruction)
-    source_addressing_mode = get_source_addressing_mode(instruction, source_register)
-    dest_addressing_mode = get_dest_addressing_mode(instruction, dest_register)
-    width = get_operand_width(instruction)
-
-    current_offset = 2 # after the instruction
-    source_operand, source_size = \
-            get_operand(data, source_addressing_mode, current_offset)
-    current_offset += source_size # advance instruction stream by the # of bytes we pulled off
-    dest_operand, dest_size = \
-            get_operand(data, dest_addressing_mode, current_offset)
-    current_offset += dest_size
-
-    return DoubleOperandInstruction(data[:current_offset], address, opcode, \
-            width, source_addressing_mode, source_register, source_operand, \
-            dest_addressing_mode, dest_register, dest_operand), current_offset
+    assert is_double_operand_instruction(instruction)
+    return get_template(instruction).decode(address, data)
@@ -0,0 +1,521 @@
+"""
+A concrete interpreter for instructions whose operands are all concrete.
+
+Most of what a program does before it reads any input (clearing memory,
+setting up the stack, copying strings around) only ever touches concrete
+values, but the step functions in cpu.py still build and fold z3 expressions
+for every operand, and fork a state per flag only for the solver to throw
+all but one of them away. Here the same instructions run on plain ints.
+
+step_concrete runs one instruction with exactly the semantics of the
+CPU.step_* functions (quirks included), so stepping with it gives the same
+successor as the symbolic CPU would have, minus the unsat ones. When the
+instruction reads a symbolic value, or is one this doesn't handle
+(interrupts, instructions that aren't implemented), it hands off: it
+returns None without touching the state, and the symbolic CPU runs that
+instruction instead.
+"""
+from z3 import is_bv_value, simplify
+
+from .code import Register, Opcode, OperandWidth, AddressingMode, \
+        SingleOperandInstruction, DoubleOperandInstruction, decode_instruction
+
+
+class HandOff(Exception):
+    """
+    Raised when an instruction has to be run by the symbolic CPU
+    """
+
+
+_constants = {
+    AddressingMode.CONSTANT4: 4,
+    AddressingMode.CONSTANT8: 8,
+    AddressingMode.CONSTANT0: 0,
+    AddressingMode.CONSTANT1: 1,
+    AddressingMode.CONSTANT2: 2,
+    AddressingMode.CONSTANTNEG1: 0xffff,
+}
+
+# flags each instruction sets with lazy_flags (see CPU.set_flags_lazily)
+_lazy_flags = {
+    Opcode.ADD: {'N', 'Z', 'C', 'V'},
+    Opcode.SUB: {'N', 'Z', 'C', 'V'},
+    Opcode.CMP: {'N', 'Z', 'C', 'V'},
+    Opcode.XOR: {'N', 'Z', 'C', 'V'},
+    Opcode.BIT: {'N', 'Z', 'C'},
+}
+
+
+def _signed(value, bits):
+    if value >> (bits - 1):
+        return value - (1 << bits)
+    return value
+
+
+class ConcreteStep:
+    """
+    The effects of running one instruction on a state, as ints.
+
+    Registers and memory are read from the state as they're needed, and
+    writes are kept here until apply() puts them into a clone of the state.
+    """
+    def __init__(self, state):
+        self.state = state
+        self.registers = {} # Register -> value, read or written
+        self.written = set() # registers written
+        self.memory = {} # address -> byte written
+        # set when something is written to [code_start, code_end)
+        self.code_start, self.code_end = 0, 0
+        self.code_written = False
+
+    def reg(self, register):
+        value = self.registers.get(register)
+        if value is None:
+            value = self.state.cpu.registers.concrete(register)
+            if value is not None:
+                self.registers[register] = value
+                return value
+            value = self.state.cpu.registers[register]
+            if not is_bv_value(value):
+                value = simplify(value)
+                if not is_bv_value(value):
+                    raise HandOff('symbolic {}'.format(register))
+            value = self.registers[register] = value.as_long()
+        return value
+
+    def set_reg(self, register, value):
+        self.registers[register] = value & 0xffff
+        self.written.add(register)
+
+    def read(self, address, width):
+        if width == OperandWidth.BYTE:
+            return self._byte(address)
+        # the symbolic CPU makes unaligned word accesses unsat
+        if address & 1:
+            raise HandOff('unaligned access')
+        return self._byte(address) | (self._byte(address + 1) << 8)
+
+    def write(self, address, value, width):
+        if width == OperandWidth.BYTE:
+            self.store(address, value)
+            return
+        if address & 1:
+            raise HandOff('unaligned access')
+        self.store(address, value)
+        self.store(address + 1, value >> 8)
+
+    def store(self, address, value):
+        """
+        Write one byte, without any alignment checks
+        """
+        address &= 0xffff
+        self.memory[address] = value & 0xff
+        if self.code_start <= address < self.code_end:
+            self.code_written = True
+
+    def _byte(self, address):
+        address &= 0xffff
+        value = self.memory.get(address)
+        if value is None:
+            value = self.state.memory._read(address)
+            if not isinstance(value, int):
+                raise HandOff('symbolic memory at {:04x}'.format(address))
+        return value
+
+    def operand(self, mode, register, operand, width):
+        """
+        The value of a source (or single) operand, like
+        CPU.get_double_operand_source_value
+        """
+        mask = 0xff if width == OperandWidth.BYTE else 0xffff
+        if mode == AddressingMode.DIRECT:
+            return self.reg(register) & mask
+        if mode == AddressingMode.IMMEDIATE:
+            return operand.as_long() & mask
+        if mode in _constants:
+            return _constants[mode] & mask
+
+        if mode == AddressingMode.INDEXED:
+            address = self.reg(register) + operand.as_long()
+        elif mode in (AddressingMode.INDIRECT, AddressingMode.AUTOINCREMENT):
+            address = self.reg(register)
+        elif mode == AddressingMode.SYMBOLIC:
+            address = operand.as_long() + self.reg(Register.R0)
+        elif mode == AddressingMode.ABSOLUTE:
+            address = operand.as_long()
+        else:
+            raise HandOff('addressing mode {}'.format(mode))
+
+        value = self.read(address, width)
+        if mode == AddressingMode.AUTOINCREMENT:
+            self.set_reg(register, self.reg(register) + \
+                    (1 if width == OperandWidth.BYTE else 2))
+        return value
+
+    def dest_address(self, instruction):
+        """
+        The address a double-operand instruction writes to, or None if it
+        writes to a register
+        """
+        mode = instruction.dest_addressing_mode
+        if mode == AddressingMode.DIRECT:
+            return None
+        if mode == AddressingMode.INDEXED:
+            address = self.reg(instruction.dest_register) + \
+                    instruction.dest_operand.as_long()
+        elif mode == AddressingMode.SYMBOLIC:
+            address = self.reg(Register.R0) + instruction.dest_operand.as_long()
+        elif mode == AddressingMode.ABSOLUTE:
+            address = instruction.dest_operand.as_long()
+        else:
+            raise HandOff('addressing mode {}'.format(mode))
+        address &= 0xffff
+        if instruction.width == OperandWidth.WORD and address & 1:
+            raise HandOff('unaligned access')
+        return address
+
+    def set_flags(self, needed, **flags):
+        """
+        Set (or clear) the flags in needed, of the given n, z, c and v
+        """
+        if not needed:
+            return
+        registers = self.state.cpu.registers
+        masks = {'N': registers.mask_N, 'Z': registers.mask_Z, \
+                'C': registers.mask_C, 'V': registers.mask_V}
+        sr = self.reg(Register.R2)
+        for flag in needed:
+            if flags[flag.lower()]:
+                sr |= masks[flag]
+            else:
+                sr &= ~masks[flag]
+        self.set_reg(Register.R2, sr)
+
+    def save(self):
+        return dict(self.registers), set(self.written), dict(self.memory)
+
+    def restore(self, saved):
+        registers, written, memory = saved
+        self.registers, self.written, self.memory = \
+                dict(registers), set(written), dict(memory)
+
+    def apply(self, instructions=1):
+        """
+        Return a successor of the state with all the writes done, that ran
+        :instructions: instructions
+        """
+        st = self.state.clone()
+        st.ticks += instructions - 1
+        for register in self.written:
+            st.cpu.registers[register] = self.registers[register]
+        for address, value in self.memory.items():
+            st.memory[address] = value
+        return st
+
+
+def _flags_needed(step, instruction, enable_unsound_optimizations):
+    cpu = step.state.cpu
+    if cpu.lazy_flags:
+        return _lazy_flags[instruction.opcode]
+    return cpu.flags_needed(step.state, instruction, \
+            enable_unsound_optimizations=enable_unsound_optimizations)
+
+
+def _step_double(step, instruction, enable_unsound_optimizations):
+    width = instruction.width
+    bits = 8 if width == OperandWidth.BYTE else 16
+    mask = (1 << bits) - 1
+    opcode = instruction.opcode
+
+    src = step.operand(instruction.source_addressing_mode, \
+            instruction.source_register, instruction.source_operand, width)
+    address = step.dest_address(instruction)
+    if address is None:
+        register = instruction.dest_register
+        dst = step.reg(register) & mask
+    else:
+        dst = step.read(address, width)
+
+    def store(value, combine=None):
+        # byte results clear the register's high byte, combine is how the
+        # new value goes into memory, when it isn't just written
+        if address is None:
+            step.set_reg(register, value & mask)
+        elif combine is None:
+            step.write(address, value, width)
+        elif width == OperandWidth.BYTE:
+            step.write(address, combine(dst, value & 0xff), width)
+        else:
+            # each byte is combined separately
+            step.write(address, combine(dst & 0xff, value & 0xff) | \
+                    (combine(dst >> 8, (value >> 8) & 0xff) << 8), width)
+
+    if opcode == Opcode.MOV:
+        store(src)
+
+    elif opcode in (Opcode.ADD, Opcode.SUB, Opcode.CMP):
+        s_src, s_dst = _signed(src, bits), _signed(dst, bits)
+        if opcode == Opcode.ADD:
+            result = (dst + src) & mask
+            s_result = _signed(result, bits)
+            flags = dict(n=s_result < 0, z=result == 0, \
+                    c=(src + dst) >> bits,
+                    v=(s_src > 0 and s_dst > 0 and s_result < 0) or \
+                            (s_src < 0 and s_dst < 0 and s_result > 0))
+        else:
+            result = (dst - src) & mask
+            s_result = _signed(result, bits)
+            # cmp == dst + ~src + 1, with ~src + 1 taken in the width first
+            flags = dict(n=s_src > s_dst, z=src == dst, \
+                    c=((((~src + 1) & mask) + dst) >> bits) & 1,
+                    v=(s_src < 0 and s_dst > 0 and s_result < 0) or \
+                            (s_src > 0 and s_dst < 0 and s_result > 0))
+        step.set_flags(_flags_needed(step, instruction, \
+                enable_unsound_optimizations), **flags)
+        if opcode != Opcode.CMP:
+            # word add and sub into memory or the result in (see step_add)
+            word_memory = address is not None and width == OperandWidth.WORD
+            store(result, combine=(lambda old, new: old | new) \
+                    if word_memory else None)
+
+    elif opcode == Opcode.XOR:
+        result = src ^ dst
+        flags = dict(n=result >> (bits - 1), z=result == 0, c=result != 0, \
+                v=_signed(src, bits) < 0 and _signed(dst, bits) < 0)
+        step.set_flags(_flags_needed(step, instruction, \
+                enable_unsound_optimizations), **flags)
+        store(result)
+
+    elif opcode == Opcode.BIT:
+        result = src & dst
+        # V is always reset
+        needed = set(_flags_needed(step, instruction, \
+                enable_unsound_optimizations)) | {'V'}
+        step.set_flags(needed, n=result >> (bits - 1), z=result == 0, \
+                c=result != 0, v=False)
+
+    elif opcode == Opcode.BIC:
+        if address is None:
+            step.set_reg(register, step.reg(register) & ~src)
+        else:
+            store(src, combine=lambda old, new: old & ~new)
+
+    elif opcode == Opcode.BIS:
+        if address is None:
+            step.set_reg(register, step.reg(register) | src)
+        else:
+            store(src, combine=lambda old, new: old | new)
+
+    elif opcode == Opcode.AND:
+        if address is None:
+            step.set_reg(register, step.reg(register) & src)
+        else:
+            store(src, combine=lambda old, new: old & new)
+
+    else:
+        raise HandOff(str(opcode))
+
+
+_jump_conditions = {
+    Opcode.JNZ: lambda sr, r: not sr & r.mask_Z,
+    Opcode.JZ: lambda sr, r: bool(sr & r.mask_Z),
+    Opcode.JNC: lambda sr, r: not sr & r.mask_C,
+    Opcode.JC: lambda sr, r: bool(sr & r.mask_C),
+    Opcode.JL: lambda sr, r: bool(sr & r.mask_N) != bool(sr & r.mask_V),
+}
+
+
+def _step_single(step, instruction):
+    opcode = instruction.opcode
+    if instruction.width != OperandWidth.WORD:
+        raise HandOff('byte {}'.format(opcode))
+
+    if opcode in (Opcode.PUSH, Opcode.CALL):
+        value = step.operand(instruction.addressing_mode, instruction.register, \
+                instruction.operand, instruction.width)
+        if opcode == Opcode.CALL:
+            if value == step.state.cpu.interrupt_address:
+                raise HandOff('interrupt')
+            value, target = step.reg(Register.R0), value
+        sp = (step.reg(Register.R1) - 2) & 0xffff
+        step.set_reg(Register.R1, sp)
+        # push doesn't check alignment
+        step.store(sp, value)
+        step.store(sp + 1, value >> 8)
+        if opcode == Opcode.CALL:
+            step.set_reg(Register.R0, target)
+        return
+
+    # writing single operands back anywhere but a register is left to the
+    # symbolic CPU
+    if instruction.addressing_mode != AddressingMode.DIRECT:
+        raise HandOff('{} to memory'.format(opcode))
+    value = step.reg(instruction.register)
+    registers = step.state.cpu.registers
+
+    if opcode == Opcode.SWPB:
+        result = ((value & 0xff) << 8) | (value >> 8)
+    elif opcode == Opcode.RRC:
+        carry = step.reg(Register.R2) & registers.mask_C
+        result = (value >> 1) | (0x8000 if carry else 0)
+        step.set_flags({'C'}, c=value & 1)
+    elif opcode == Opcode.SXT:
+        result = value & 0xff
+        if result & 0x80:
+            result |= 0xff00
+        # sxt sets every flag whether it's needed or not
+        step.set_flags({'N', 'Z', 'C', 'V'}, n=result >> 15, z=result == 0, \
+                c=result != 0, v=False)
+    else:
+        raise HandOff(str(opcode))
+    step.set_reg(instruction.register, result)
+
+
+def _execute(step, instruction, instruction_length, \
+        enable_unsound_optimizations):
+    step.set_reg(Register.R0, instruction.address + instruction_length)
+    opcode = instruction.opcode
+    if isinstance(instruction, DoubleOperandInstruction):
+        _step_double(step, instruction, enable_unsound_optimizations)
+    elif opcode == Opcode.JMP:
+        step.set_reg(Register.R0, instruction.target.as_long())
+    elif opcode in _jump_conditions:
+        if _jump_conditions[opcode](step.reg(Register.R2), \
+                step.state.cpu.registers):
+            step.set_reg(Register.R0, instruction.target.as_long())
+    elif isinstance(instruction, SingleOperandInstruction):
+        _step_single(step, instruction)
+    else:
+        raise HandOff(str(opcode))
+
+
+def step_concrete(state, instruction, instruction_length, \
+        enable_unsound_optimizations=True):
+    """
+    Run instruction (at the state's ip, which is instruction.address) on
+    plain ints.
+
+    Returns the successor state, or None if the symbolic CPU has to run
+    this instruction. state itself is never changed.
+    """
+    step = ConcreteStep(state)
+    try:
+        _execute(step, instruction, instruction_length, \
+                enable_unsound_optimizations)
+    except HandOff:
+        return None
+    return step.apply()
+
+
+def _ends_block(instruction):
+    """
+    Whether instruction (might) change the flow of control
+    """
+    if isinstance(instruction, DoubleOperandInstruction):
+        return instruction.dest_addressing_mode == AddressingMode.DIRECT and \
+                instruction.dest_register == Register.R0
+    return not isinstance(instruction, SingleOperandInstruction) or \
+            instruction.opcode in (Opcode.CALL, Opcode.RETI) or \
+            (instruction.addressing_mode == AddressingMode.DIRECT and \
+            instruction.register == Register.R0)
+
+
+def _code(memory, start, end):
+    """
+    The bytes in memory[start:end], or None if any of them are symbolic
+    """
+    values = [memory._read(addr) for addr in range(start, min(end, 0x10000))]
+    if not all(isinstance(value, int) for value in values):
+        return None
+    return bytes(values)
+
+
+class Block:
+    """
+    A decoded run of straight-line instructions, from address up to (not
+    including) end: up to and including the first one that can jump, or up
+    to a stop address
+    """
+    def __init__(self, address, instructions, code):
+        self.address = address
+        self.instructions = instructions # [(instruction, length)]
+        self.code = code # the bytes it was decoded from
+        self.end = address + len(code)
+
+
+class BlockCache:
+    """
+    A translation cache of Blocks by address, so straight-line code is only
+    decoded once, and can be run by run_block with a single clone of the
+    state.
+
+    Blocks never run past an address in stops (e.g. addresses a PathGroup
+    has to see a state at, like the ones it avoids or merges at). A cached
+    block is only used while memory still holds the code it was decoded
+    from.
+    """
+    def __init__(self, stops=(), max_instructions=32):
+        self.stops = frozenset(stops)
+        self.max_instructions = max_instructions
+        self.blocks = {}
+
+    def get(self, memory, address):
+        """
+        The Block at address in memory, or None if there's no code there
+        """
+        block = self.blocks.get(address)
+        if block is not None and \
+                _code(memory, block.address, block.end) == block.code:
+            return block
+
+        instructions = []
+        ip = address
+        while len(instructions) < self.max_instructions:
+            if instructions and ip in self.stops:
+                break
+            code = _code(memory, ip, ip + 6)
+            if code is None:
+                break
+            try:
+                instruction, length = decode_instruction(ip, list(code))
+            except AssertionError:
+                break # not code
+            instructions.append((instruction, length))
+            ip += length
+            if _ends_block(instruction):
+                break
+        if not instructions:
+            return None
+
+        block = Block(address, instructions, _code(memory, address, ip))
+        self.blocks[address] = block
+        return block
+
+
+def run_block(state, block, enable_unsound_optimizations=True):
+    """
+    Run as much of block as possible on plain ints, from the state's ip
+    (block.address).
+
+    Returns the successor state after the last instruction that could be
+    run, or None if the symbolic CPU has to run the first one. state itself
+    is never changed.
+    """
+    step = ConcreteStep(state)
+    step.code_start, step.code_end = block.address, block.end
+    count = 0
+    for instruction, length in block.instructions:
+        saved = step.save()
+        try:
+            _execute(step, instruction, length, enable_unsound_optimizations)
+        except HandOff:
+            step.restore(saved)
+            break
+        count += 1
+        # stop if it jumped, or wrote over the rest of the block
+        if step.registers[Register.R0] != instruction.address + length or \
+                step.code_written:
+            break
+    if count == 0:
+        return None
+    return step.apply(count)
@@ -0,0 +1,71 @@
+"""
+Interned z3 constants and expression shapes.
+
+Every call through the z3 Python bindings that builds an AST goes through
+ctypes and makes a new Python wrapper, even though z3 itself shares equal
+ASTs. The step functions build the same few constants (flag masks, zero
+bytes, decoded operands) and the same small expressions (the low byte of a
+register, a word out of two bytes of memory) over and over, so those are
+built once here and shared.
+"""
+from z3 import BitVecVal, Extract, Concat
+
+
+_values = {} # (value, bits) -> BitVecVal
+
+
+def bv(value, bits):
+    """
+    The shared BitVecVal of value (modulo 2**bits), bits wide
+    """
+    value &= (1 << bits) - 1
+    key = (value, bits)
+    constant = _values.get(key)
+    if constant is None:
+        constant = _values[key] = BitVecVal(value, bits)
+    return constant
+
+
+def word(value):
+    """
+    The shared 16-bit BitVecVal of value
+    """
+    return bv(value, 16)
+
+
+# every concrete byte read out of memory is one of these, so reads
+# never have to build a new BitVecVal
+BYTE_VALUES = [bv(x, 8) for x in range(0x100)]
+
+
+# Expressions built out of other expressions are keyed on the AST ids of
+# their arguments. Each entry keeps its arguments alive, so an id can't be
+# reused for a different AST while it's in here. Once there are too many,
+# the whole thing is dropped and refilled.
+MAX_SHAPES = 1 << 16
+_shapes = {}
+
+
+def _shape(key, arguments, build):
+    entry = _shapes.get(key)
+    if entry is None:
+        if len(_shapes) >= MAX_SHAPES:
+            _shapes.clear()
+        entry = _shapes[key] = (arguments, build())
+    return entry[1]
+
+
+def extract(high, low, term):
+    """
+    Extract(high, low, term), shared
+    """
+    return _shape((high, low, term.get_id()), term, \
+            lambda: Extract(high, low, term))
+
+
+def concat(high, low):
+    """
+    Concat(high, low), shared
+    """
+    return _shape((high.get_id(), low.get_id()), (high, low), \
+            lambda: Concat(high, low))
@@ -1,6 +1,8 @@
 from enum import Enum, unique
-from z3 import BitVecVal, Concat, Extract, And, Or, Not, simplify, If, SignExt, Xor
+from z3 import Concat, Extract, And, Or, Not, simplify, If, SignExt, Xor, \
+        is_bv_value
 
+from .constants import bv, word, extract, concat
 from .code import Register, Opcode, OperandWidth, AddressingMode, \
         SingleOperandInstruction, JumpInstruction, DoubleOperandInstruction, \
         decode_instruction
@@ -14,103 +16,100 @@ class DestinationType(Enum):
     REGISTER = 0
     ADDRESS = 1
 
+# Register, number or name -> index into RegisterFile._values
+_register_indices = {}
+for _register in Register:
+    for _key in (_register, _register.value, _register.name, _register.name.lower()):
+        _register_indices[_key] = _register.value
+
+
 class RegisterFile:
     """
     All the registers, plus their values
-    """
-    reg_strs = {
-        'R0': Register.R0,
-        'R1': Register.R1,
-        'R2': Register.R2,
-        'R3': Register.R3,
-        'R4': Register.R4,
-        'R5': Register.R5,
-        'R6': Register.R6,
-        'R7': Register.R7,
-        'R8': Register.R8,
-        'R9': Register.R9,
-        'R10': Register.R10,
-        'R11': Register.R11,
-        'R12': Register.R12,
-        'R13': Register.R13,
-        'R14': Register.R14,
-        'R15': Register.R15,
-    }
-    reg_nums = {
-        0: Register.R0,
-        1: Register.R1,
-        2: Register.R2,
-        3: Register.R3,
-        4: Register.R4,
-        5: Register.R5,
-        6: Register.R6,
-        7: Register.R7,
-        8: Register.R8,
-        9: Register.R9,
-        10: Register.R10,
-        11: Register.R11,
-        12: Register.R12,
-        13: Register.R13,
-        14: Register.R14,
-        15: Register.R15,
-    }
 
-    def __init__(self, set_regs={}):
-        self.registers = {
-            Register.R0: BitVecVal(0, 16),
-            Register.R1: BitVecVal(0, 16),
-            Register.R2: BitVecVal(0, 16),
-            Register.R3: BitVecVal(0, 16),
-            Register.R4: BitVecVal(0, 16),
-            Register.R5: BitVecVal(0, 16),
-            Register.R6: BitVecVal(0, 16),
-            Register.R7: BitVecVal(0, 16),
-            Register.R8: BitVecVal(0, 16),
-            Register.R9: BitVecVal(0, 16),
-            Register.R10: BitVecVal(0, 16),
-            Register.R11: BitVecVal(0, 16),
-            Register.R12: BitVecVal(0, 16),
-            Register.R13: BitVecVal(0, 16),
-            Register.R14: BitVecVal(0, 16),
-            Register.R15: BitVecVal(0, 16),
-        }
+    Registers can be indexed by Register, by number, or by name ('R15' or
+    'r15'), and always read as BitVecs. Concrete values are kept as plain
+    ints in a list of 16, so clones only copy the list.
+    """
+    __slots__ = ('_values',)
 
-        self.registers.update(set_regs)
+    # bitmasks for SR (R2)
+    mask_C = 0b1
+    mask_Z = 0b10
+    mask_N = 0b100
+    mask_V = 0b10000000
 
-        # bitmasks for SR (R2)
-        self.mask_C = 0b1
-        self.mask_Z = 0b10
-        self.mask_N = 0b100
-        self.mask_V = 0b10000000
+    def __init__(self, set_regs={}):
+        self._values = [0] * 16
+        for key, value in set_regs.items():
+            self[key] = value
 
     def __getitem__(self, key):
-        if isinstance(key, str):
-            key = RegisterFile.reg_strs[key.upper()]
-        elif isinstance(key, int):
-            key = RegisterFile.reg_nums[key]
-        return self.registers[key]
+        value = self._values[_register_indices[key]]
+        if value.__class__ is int:
+            return word(value)
+        return value
 
     def __setitem__(self, key, value):
-        if isinstance(key, str):
-            key = RegisterFile.reg_strs[key.upper()]
-        elif isinstance(key, int):
-            key = RegisterFile.reg_nums[key]
-        self.registers[key] = value
+        if isinstance(value, int):
+            value &= 0xffff
+        elif is_bv_value(value) and value.size() == 16:
+            value = value.as_long()
+        self._values[_register_indices[key]] = value
+
+    def concrete(self, key):
+        """
+        The value of a register as an int, or None if it isn't a constant
+        (without simplifying it)
+        """
+        value = self._values[_register_indices[key]]
+        if value.__class__ is int:
+            return value
+        return None
 
     def __repr__(self):
-        return 'RegisterFile({})'.format(self.registers)
+        return 'RegisterFile({})'.format({register: self[register] \
+                for register in Register})
 
     def clone(self):
-        return RegisterFile(self.registers)
+        other = RegisterFile.__new__(RegisterFile)
+        other._values = self._values[:]
+        return other
 
 
 class CPU:
-    def __init__(self, registers=None):
+    def __init__(self, registers=None, lazy_flags=False, live_flags=None, \
+            concrete=False, summaries=None, loops=None):
         if registers is None:
             registers = RegisterFile()
 
         self.registers = registers
 
+        # When set, flag-setting instructions store N/Z/C/V in SR as symbolic
+        # expressions instead of forking a state per flag combination. The
+        # split then only happens if a conditional jump reads the flag.
+        self.lazy_flags = lazy_flags
+
+        # address -> (raw bytes, flags live after the instruction there),
+        # from liveness.flag_liveness. Shared between clones.
+        self.live_flags = live_flags
+
+        # When set, instructions whose operands are all concrete are run by
+        # concrete.step_concrete on ints, instead of the step_* functions.
+        self.concrete = concrete
+
+        # function address -> summary (see summaries.py), run instead of the
+        # function when a state gets to it. Shared between clones.
+        if summaries is None:
+            summaries = {}
+        self.summaries = summaries
+
+        # loop head -> end, of the loops to run with loops.summarize_loop.
+        # Shared between clones.
+        if loops is None:
+            loops = {}
+        self.loops = loops
+
         self.interrupt_address = 0x10 # callgated addr for interrupts
 
         # interrupt id -> summary function
@@ -127,7 +126,62 @@ class CPU:
         }
 
     def clone(self):
-        return self.__class__(self.registers.clone())
+        return self.__class__(self.registers.clone(), lazy_flags=self.lazy_flags, \
+                live_flags=self.live_flags, concrete=self.concrete, \
+                summaries=self.summaries, loops=self.loops)
+
+    def flags_needed(self, state, instruction, enable_unsound_optimizations=True):
+        """
+        The flags (of 'N', 'Z', 'C', 'V') set by instruction that might be
+        read later, so the rest don't need to be computed.
+
+        Uses the static flag liveness if there is any for this instruction,
+        otherwise with unsound optimizations enabled, looks for conditional
+        jumps in the next 6 instructions.
+        """
+        if self.live_flags is not None:
+            analyzed = self.live_flags.get(instruction.address)
+            # make sure the code wasn't changed since it was analyzed
+            if analyzed is not None and analyzed[0] == instruction.raw:
+                return analyzed[1]
+
+        if not enable_unsound_optimizations:
+            return {'N', 'Z', 'C', 'V'}
+
+        # lookahead 6 instruction, and compute relevant
+        # flags from the kind of jump
+        insns = state.decode_some_instructions(instruction.address, 6)
+        flags_needed = set()
+        for insn in insns:
+            if insn.opcode in {Opcode.JN, Opcode.JGE, Opcode.JL}:
+                flags_needed.add('N')
+            if insn.opcode in {Opcode.JNZ, Opcode.JZ}:
+                flags_needed.add('Z')
+            if insn.opcode in {Opcode.JNC, Opcode.JC}:
+                flags_needed.add('C')
+            if insn.opcode in {Opcode.JGE, Opcode.JL}:
+                flags_needed.add('V')
+        return flags_needed
+
+    def set_flags_lazily(self, state, n=None, z=None, c=None, v=None):
+        """
+        Set the flags in SR of state to the given conditions without forking.
+
+        Each argument is a z3 boolean (or python bool) for when that flag is
+        set, or None to leave the flag as it is.
+        """
+        flags = [(n, self.registers.mask_N), (z, self.registers.mask_Z), \
+                 (c, self.registers.mask_C), (v, self.registers.mask_V)]
+        flags = [(cond, mask) for cond, mask in flags if cond is not None]
+
+        clear_mask = 0
+        for _, mask in flags:
+            clear_mask |= mask
+
+        sr = state.cpu.registers[Register.R2] & bv(~clear_mask, 16)
+        for cond, mask in flags:
+            sr |= If(cond, bv(mask, 16), bv(0, 16))
+        state.cpu.registers[Register.R2] = sr
 
     def push(self, state, value):
         """
@@ -173,7 +227,7 @@ class CPU:
                 val = state.cpu.registers[instruction.register]
 
             elif instruction.width == OperandWidth.BYTE:
-                val = Extract(7, 0, state.cpu.registers[instruction.register])
+                val = extract(7, 0, state.cpu.registers[instruction.register])
 
         elif instruction.addressing_mode == AddressingMode.INDEXED:
             address = state.cpu.registers[instruction.register] + \
@@ -182,7 +236,7 @@ class CPU:
                 state.path.add(Extract(0, 0, address) == 0)
 
                 val = \
-                        Concat(state.memory[address + 1], \
+                        concat(state.memory[address + 1], \
                         state.memory[address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -194,7 +248,7 @@ class CPU:
                 state.path.add(Extract(0, 0, address) == 0)
 
                 val = \
-                        Concat(state.memory[address + 1], \
+                        concat(state.memory[address + 1], \
                         state.memory[address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -206,7 +260,7 @@ class CPU:
                 state.path.add(Extract(0, 0, address) == 0)
 
                 val = \
-                        Concat(state.memory[address + 1], \
+                        concat(state.memory[address + 1], \
                         state.memory[address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -221,7 +275,7 @@ class CPU:
                 state.path.add(Extract(0, 0, address) == 0)
 
                 val = \
-                        Concat(state.memory[address + 1], \
+                        concat(state.memory[address + 1], \
                         state.memory[address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -233,7 +287,7 @@ class CPU:
             elif instruction.width == OperandWidth.BYTE:
                 # I'm 99% sure SLAU144J 4.4.7.1 implies we mask off low byte
                 # That also makes sense semantically, so we do that
-                val = Extract(7, 0, instruction.operand)
+                val = extract(7, 0, instruction.operand)
 
         elif instruction.addressing_mode == AddressingMode.ABSOLUTE:
             address = instruction.operand
@@ -241,7 +295,7 @@ class CPU:
                 state.path.add(Extract(0, 0, address) == 0)
 
                 val = \
-                        Concat(state.memory[address + 1], \
+                        concat(state.memory[address + 1], \
                         state.memory[address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -249,45 +303,45 @@ class CPU:
 
         elif instruction.addressing_mode == AddressingMode.CONSTANT4:
             if instruction.width == OperandWidth.WORD:
-                val = BitVecVal(4, 16)
+                val = bv(4, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                val = BitVecVal(4, 8)
+                val = bv(4, 8)
 
         elif instruction.addressing_mode == AddressingMode.CONSTANT8:
             if instruction.width == OperandWidth.WORD:
-                val = BitVecVal(8, 16)
+                val = bv(8, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                val = BitVecVal(8, 8)
+                val = bv(8, 8)
 
         elif instruction.addressing_mode == AddressingMode.CONSTANT0:
             if instruction.width == OperandWidth.WORD:
-                val = BitVecVal(0, 16)
+                val = bv(0, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                val = BitVecVal(0, 8)
+                val = bv(0, 8)
 
         elif instruction.addressing_mode == AddressingMode.CONSTANT1:
             if instruction.width == OperandWidth.WORD:
-                val = BitVecVal(1, 16)
+                val = bv(1, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                val = BitVecVal(1, 8)
+                val = bv(1, 8)
 
         elif instruction.addressing_mode == AddressingMode.CONSTANT2:
             if instruction.width == OperandWidth.WORD:
-                val = BitVecVal(2, 16)
+                val = bv(2, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                val = BitVecVal(2, 8)
+                val = bv(2, 8)
 
         elif instruction.addressing_mode == AddressingMode.CONSTANTNEG1:
             if instruction.width == OperandWidth.WORD:
-                val = BitVecVal(-1, 16)
+                val = bv(-1, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                val = BitVecVal(-1, 8)
+                val = bv(-1, 8)
 
         return val
 
@@ -448,7 +502,7 @@ class CPU:
                 source_val = state.cpu.registers[instruction.source_register]
 
             elif instruction.width == OperandWidth.BYTE:
-                source_val = Extract(7, 0, state.cpu.registers[instruction.source_register])
+                source_val = extract(7, 0, state.cpu.registers[instruction.source_register])
 
         elif instruction.source_addressing_mode == AddressingMode.INDEXED:
             source_address = state.cpu.registers[instruction.source_register] + \
@@ -457,7 +511,7 @@ class CPU:
                 state.path.add(Extract(0, 0, source_address) == 0)
 
                 source_val = \
-                        Concat(state.memory[source_address + 1], \
+                        concat(state.memory[source_address + 1], \
                         state.memory[source_address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -469,7 +523,7 @@ class CPU:
                 state.path.add(Extract(0, 0, source_address) == 0)
 
                 source_val = \
-                        Concat(state.memory[source_address + 1], \
+                        concat(state.memory[source_address + 1], \
                         state.memory[source_address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -481,7 +535,7 @@ class CPU:
                 state.path.add(Extract(0, 0, source_address) == 0)
 
                 source_val = \
-                        Concat(state.memory[source_address + 1], \
+                        concat(state.memory[source_address + 1], \
                         state.memory[source_address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -496,7 +550,7 @@ class CPU:
                 state.path.add(Extract(0, 0, source_address) == 0)
 
                 source_val = \
-                        Concat(state.memory[source_address + 1], \
+                        concat(state.memory[source_address + 1], \
                         state.memory[source_address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -508,7 +562,7 @@ class CPU:
             elif instruction.width == OperandWidth.BYTE:
                 # I'm 99% sure SLAU144J 4.4.7.1 implies we mask off low byte
                 # That also makes sense semantically, so we do that
-                source_val = Extract(7, 0, instruction.source_operand)
+                source_val = extract(7, 0, instruction.source_operand)
 
         elif instruction.source_addressing_mode == AddressingMode.ABSOLUTE:
             source_address = instruction.source_operand
@@ -516,7 +570,7 @@ class CPU:
                 state.path.add(Extract(0, 0, source_address) == 0)
 
                 source_val = \
-                        Concat(state.memory[source_address + 1], \
+                        concat(state.memory[source_address + 1], \
                         state.memory[source_address])
 
             elif instruction.width == OperandWidth.BYTE:
@@ -524,45 +578,45 @@ class CPU:
 
         elif instruction.source_addressing_mode == AddressingMode.CONSTANT4:
             if instruction.width == OperandWidth.WORD:
-                source_val = BitVecVal(4, 16)
+                source_val = bv(4, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                source_val = BitVecVal(4, 8)
+                source_val = bv(4, 8)
 
         elif instruction.source_addressing_mode == AddressingMode.CONSTANT8:
             if instruction.width == OperandWidth.WORD:
-                source_val = BitVecVal(8, 16)
+                source_val = bv(8, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                source_val = BitVecVal(8, 8)
+                source_val = bv(8, 8)
 
         elif instruction.source_addressing_mode == AddressingMode.CONSTANT0:
             if instruction.width == OperandWidth.WORD:
-                source_val = BitVecVal(0, 16)
+                source_val = bv(0, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                source_val = BitVecVal(0, 8)
+                source_val = bv(0, 8)
 
         elif instruction.source_addressing_mode == AddressingMode.CONSTANT1:
             if instruction.width == OperandWidth.WORD:
-                source_val = BitVecVal(1, 16)
+                source_val = bv(1, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                source_val = BitVecVal(1, 8)
+                source_val = bv(1, 8)
 
         elif instruction.source_addressing_mode == AddressingMode.CONSTANT2:
             if instruction.width == OperandWidth.WORD:
-                source_val = BitVecVal(2, 16)
+                source_val = bv(2, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                source_val = BitVecVal(2, 8)
+                source_val = bv(2, 8)
 
         elif instruction.source_addressing_mode == AddressingMode.CONSTANTNEG1:
             if instruction.width == OperandWidth.WORD:
-                source_val = BitVecVal(-1, 16)
+                source_val = bv(-1, 16)
 
             elif instruction.width == OperandWidth.BYTE:
-                source_val = BitVecVal(-1, 8)
+                source_val = bv(-1, 8)
 
         return source_val
 
@@ -604,14 +658,14 @@ class CPU:
         value = self.get_single_operand_value(st, instruction)
 
         c_flag = If(st.cpu.registers[Register.R2] & self.registers.mask_C == 0, \
-                BitVecVal(0, 1), BitVecVal(1, 1))
+                bv(0, 1), bv(1, 1))
 
         new_c_flag = Extract(0, 0, value)
         new_value = Extract(value.size()-1, 0, Concat(c_flag, value) >> 1)
 
         # set the C flag
-        c_on = st.cpu.registers[Register.R2] | BitVecVal(self.registers.mask_C, 16)
-        c_off = st.cpu.registers[Register.R2] & ~BitVecVal(self.registers.mask_C, 16)
+        c_on = st.cpu.registers[Register.R2] | bv(self.registers.mask_C, 16)
+        c_off = st.cpu.registers[Register.R2] & bv(~self.registers.mask_C, 16)
         st.cpu.registers[Register.R2] = If(new_c_flag != 0, c_on, c_off)
 
         # set the value
@@ -656,34 +710,38 @@ class CPU:
         # V: reset
         new_states = [st]
         
-        # N flag
-        set_states = [x for x in new_states]
-        unset_states = [x.clone() for x in new_states]
-        for st in set_states:
-            st.path.add(extended_num < 0)
-            st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_N, 16)
-        for st in unset_states:
-            st.path.add(extended_num >= 0)
-            st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_N, 16)
-        new_states = set_states + unset_states
-
-        # Z + C flags
-        set_states = [x for x in new_states] # states where Z is set (C unset)
-        unset_states = [x.clone() for x in new_states] # states where Z is unset (C set)
-        for st in set_states:
-            st.path.add(extended_num == 0)
-            st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_Z, 16)
-            st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_C, 16)
-        for st in unset_states:
-            st.path.add(extended_num != 0)
-            st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_Z, 16)
-            st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_C, 16)
-        new_states = set_states + unset_states
+        if self.lazy_flags:
+            self.set_flags_lazily(st, n=extended_num < 0, z=extended_num == 0, \
+                    c=extended_num != 0, v=False)
+        else:
+            # N flag
+            set_states = [x for x in new_states]
+            unset_states = [x.clone() for x in new_states]
+            for st in set_states:
+                st.path.add(extended_num < 0)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_N, 16)
+            for st in unset_states:
+                st.path.add(extended_num >= 0)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_N, 16)
+            new_states = set_states + unset_states
 
-        # V flag
-        # all unset
-        for st in new_states:
-            st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_V, 16)
+            # Z + C flags
+            set_states = [x for x in new_states] # states where Z is set (C unset)
+            unset_states = [x.clone() for x in new_states] # states where Z is unset (C set)
+            for st in set_states:
+                st.path.add(extended_num == 0)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_C, 16)
+            for st in unset_states:
+                st.path.add(extended_num != 0)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_C, 16)
+            new_states = set_states + unset_states
+
+            # V flag
+            # all unset
+            for st in new_states:
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_V, 16)
 
         # set dest location
         for st in new_states:
@@ -732,10 +790,10 @@ class CPU:
         taken = state.clone()
         not_taken = state.clone()
         
-        taken.path.add(taken.cpu.registers[Register.R2] & BitVecVal(self.registers.mask_Z, 16) == 0)
+        taken.path.add(taken.cpu.registers[Register.R2] & bv(self.registers.mask_Z, 16) == 0)
         taken.cpu.registers[Register.R0] = instruction.target
 
-        not_taken.path.add(not_taken.cpu.registers[Register.R2] & BitVecVal(self.registers.mask_Z, 16) == self.registers.mask_Z)
+        not_taken.path.add(not_taken.cpu.registers[Register.R2] & bv(self.registers.mask_Z, 16) == self.registers.mask_Z)
         # R0 is already pointing at the next instruction
 
         return [taken, not_taken]
@@ -746,10 +804,10 @@ class CPU:
         taken = state.clone()
         not_taken = state.clone()
         
-        taken.path.add(taken.cpu.registers[Register.R2] & BitVecVal(self.registers.mask_Z, 16) == self.registers.mask_Z)
+        taken.path.add(taken.cpu.registers[Register.R2] & bv(self.registers.mask_Z, 16) == self.registers.mask_Z)
         taken.cpu.registers[Register.R0] = instruction.target
 
-        not_taken.path.add(not_taken.cpu.registers[Register.R2] & BitVecVal(self.registers.mask_Z, 16) == 0)
+        not_taken.path.add(not_taken.cpu.registers[Register.R2] & bv(self.registers.mask_Z, 16) == 0)
         # R0 is already pointing at the next instruction
 
         return [taken, not_taken]
@@ -759,10 +817,10 @@ class CPU:
         taken = state.clone()
         not_taken = state.clone()
         
-        not_taken.path.add(taken.cpu.registers[Register.R2] & BitVecVal(self.registers.mask_C, 16) == 0)
+        not_taken.path.add(taken.cpu.registers[Register.R2] & bv(self.registers.mask_C, 16) == 0)
         not_taken.cpu.registers[Register.R0] = instruction.target
 
-        taken.path.add(not_taken.cpu.registers[Register.R2] & BitVecVal(self.registers.mask_C, 16) == self.registers.mask_C)
+        taken.path.add(not_taken.cpu.registers[Register.R2] & bv(self.registers.mask_C, 16) == self.registers.mask_C)
 	# R0 is already pointing at the next instruction
 
         return [taken, not_taken]
@@ -773,10 +831,10 @@ class CPU:
         taken = state.clone()
         not_taken = state.clone()
         
-        taken.path.add(taken.cpu.registers[Register.R2] & BitVecVal(self.registers.mask_C, 16) == self.registers.mask_C)
+        taken.path.add(taken.cpu.registers[Register.R2] & bv(self.registers.mask_C, 16) == self.registers.mask_C)
         taken.cpu.registers[Register.R0] = instruction.target
 
-        not_taken.path.add(not_taken.cpu.registers[Register.R2] & BitVecVal(self.registers.mask_C, 16) == 0)
+        not_taken.path.add(not_taken.cpu.registers[Register.R2] & bv(self.registers.mask_C, 16) == 0)
 	# R0 is already pointing at the next instruction
 
         return [taken, not_taken]
@@ -793,8 +851,8 @@ class CPU:
         assert instruction.opcode == Opcode.JL
         
         r2 = state.cpu.registers[Register.R2]
-        n_flag = r2 & BitVecVal(self.registers.mask_N, 16) == self.registers.mask_N
-        v_flag = r2 & BitVecVal(self.registers.mask_V, 16) == self.registers.mask_V
+        n_flag = r2 & bv(self.registers.mask_N, 16) == self.registers.mask_N
+        v_flag = r2 & bv(self.registers.mask_V, 16) == self.registers.mask_V
 
         taken = state.clone()
         not_taken = state.clone()
@@ -837,7 +895,7 @@ class CPU:
             elif instruction.width == OperandWidth.BYTE:
                 st.cpu.registers[dest_loc] = \
                         Concat(\
-                        BitVecVal(0, 8), source_val)
+                        bv(0, 8), source_val)
         elif dest_type == DestinationType.ADDRESS:
             if instruction.width == OperandWidth.WORD:
                 st.memory[dest_loc] = Extract(7, 0, source_val)
@@ -860,30 +918,28 @@ class CPU:
             if instruction.width == OperandWidth.WORD:
                 dest_val = st.cpu.registers[dest_loc]
             elif instruction.width == OperandWidth.BYTE:
-                dest_val = Extract(7, 0, st.cpu.registers[dest_loc])
+                dest_val = extract(7, 0, st.cpu.registers[dest_loc])
         elif dest_type == DestinationType.ADDRESS:
             if instruction.width == OperandWidth.WORD:
-                dest_val = Concat(st.memory[dest_loc+1], \
+                dest_val = concat(st.memory[dest_loc+1], \
                         st.memory[dest_loc])
             elif instruction.width == OperandWidth.BYTE:
                 dest_val = st.memory[dest_loc]
 
-        if enable_unsound_optimizations:
-            # lookahead 6 instruction, and compute relevant
-            # flags from the kind of jump
-            insns = state.decode_some_instructions(instruction.address, 6)
+        if self.lazy_flags:
+            zero_bit = bv(0, 1)
+            src_ext = Concat(zero_bit, source_val)
+            dst_ext = Concat(zero_bit, dest_val)
+            did_overflow = Extract(src_ext.size()-1, src_ext.size()-1, src_ext + dst_ext) == 1
+            cond_a = And(source_val > 0, dest_val > 0, source_val + dest_val < 0)
+            cond_b = And(source_val < 0, dest_val < 0, source_val + dest_val > 0)
+            self.set_flags_lazily(st, n=source_val + dest_val < 0, \
+                    z=source_val + dest_val == 0, c=did_overflow, \
+                    v=Or(cond_a, cond_b))
             flags_needed = set()
-            for insn in insns:
-                if insn.opcode in {Opcode.JN, Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('N')
-                if insn.opcode in {Opcode.JNZ, Opcode.JZ}:
-                    flags_needed.add('Z')
-                if insn.opcode in {Opcode.JNC, Opcode.JC}:
-                    flags_needed.add('C')
-                if insn.opcode in {Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('V')
         else:
-            flags_needed = {'N', 'Z', 'C', 'V'}
+            flags_needed = self.flags_needed(state, instruction, \
+                    enable_unsound_optimizations=enable_unsound_optimizations)
 
 
         # From SLAU144J, the way all the flags are set:
@@ -902,10 +958,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states] # N bit cleared
             for st in set_states:
                 st.path.add(source_val + dest_val < 0)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_N, 16)
             for st in unset_states:
                 st.path.add(source_val + dest_val >= 0)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_N, 16)
             new_states = set_states + unset_states
 
         # Z bit
@@ -914,16 +970,16 @@ class CPU:
             unset_states = [x.clone() for x in new_states] # N bit cleared
             for st in set_states:
                 st.path.add(source_val + dest_val == 0)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_Z, 16)
             for st in unset_states:
                 st.path.add(source_val + dest_val != 0)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_Z, 16)
             new_states = set_states + unset_states
 
         # C bit
         # basically we check if the highest bit transitioned from a 1 to a 0
         if 'C' in flags_needed:
-            zero_bit = BitVecVal(0, 1)
+            zero_bit = bv(0, 1)
             src_ext = Concat(zero_bit, source_val)
             dst_ext = Concat(zero_bit, dest_val)
             did_overflow = Extract(src_ext.size()-1, src_ext.size()-1, src_ext + dst_ext) == 1
@@ -932,10 +988,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states] # C bit cleared
             for st in set_states:
                 st.path.add(did_overflow)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_C, 16)
             for st in unset_states:
                 st.path.add(Not(did_overflow))
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_C, 16)
             new_states = set_states + unset_states
 
         # V bit
@@ -947,12 +1003,12 @@ class CPU:
                 cond_a = And(source_val > 0, dest_val > 0, source_val + dest_val < 0)
                 cond_b = And(source_val < 0, dest_val < 0, source_val + dest_val > 0)
                 st.path.add(Or(cond_a, cond_b))
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_V, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_V, 16)
             for st in unset_states:
                 cond_a = And(source_val > 0, dest_val > 0, source_val + dest_val < 0)
                 cond_b = And(source_val < 0, dest_val < 0, source_val + dest_val > 0)
                 st.path.add(Not(Or(cond_a, cond_b)))
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_V, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_V, 16)
             new_states = set_states + unset_states
 
         # set dest location to the sum in all states
@@ -964,7 +1020,7 @@ class CPU:
                 elif instruction.width == OperandWidth.BYTE:
                     # top bits get cloeared
                     st.cpu.registers[dest_loc] = Concat( \
-                            BitVecVal(0, 8), \
+                            bv(0, 8), \
                             source_val + dest_val)
 
             elif dest_type == DestinationType.ADDRESS:
@@ -997,31 +1053,29 @@ class CPU:
             if instruction.width == OperandWidth.WORD:
                 dest_val = st.cpu.registers[dest_loc]
             elif instruction.width == OperandWidth.BYTE:
-                dest_val = Extract(7, 0, st.cpu.registers[dest_loc])
+                dest_val = extract(7, 0, st.cpu.registers[dest_loc])
         elif dest_type == DestinationType.ADDRESS:
             if instruction.width == OperandWidth.WORD:
-                dest_val = Concat(st.memory[dest_loc+1], \
+                dest_val = concat(st.memory[dest_loc+1], \
                         st.memory[dest_loc])
             elif instruction.width == OperandWidth.BYTE:
                 dest_val = st.memory[dest_loc]
 
 
-        if enable_unsound_optimizations:
-            # lookahead 6 instruction, and compute relevant
-            # flags from the kind of jump
-            insns = state.decode_some_instructions(instruction.address, 6)
+        if self.lazy_flags:
+            zero_bit = bv(0, 1)
+            src_ext = Concat(zero_bit, ~source_val + 1) # cmp == dst + ~src + 1
+            dst_ext = Concat(zero_bit, dest_val)
+            did_overflow = Extract(src_ext.size()-1, src_ext.size()-1, src_ext + dst_ext) == 1
+            condA = And(source_val < 0, dest_val > 0, dest_val - source_val < 0)
+            condB = And(source_val > 0, dest_val < 0, dest_val - source_val > 0)
+            self.set_flags_lazily(st, n=source_val > dest_val, \
+                    z=source_val == dest_val, c=did_overflow, \
+                    v=Or(condA, condB))
             flags_needed = set()
-            for insn in insns:
-                if insn.opcode in {Opcode.JN, Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('N')
-                if insn.opcode in {Opcode.JNZ, Opcode.JZ}:
-                    flags_needed.add('Z')
-                if insn.opcode in {Opcode.JNC, Opcode.JC}:
-                    flags_needed.add('C')
-                if insn.opcode in {Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('V')
         else:
-            flags_needed = {'N', 'Z', 'C', 'V'}
+            flags_needed = self.flags_needed(state, instruction, \
+                    enable_unsound_optimizations=enable_unsound_optimizations)
 
         # From SLAU144J, the way all the flags are set:
         # N: Set if src > dest, reset if src <= dest
@@ -1038,10 +1092,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states] # N bit cleared
             for st in set_states:
                 st.path.add(source_val > dest_val)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_N, 16)
             for st in unset_states:
                 st.path.add(source_val <= dest_val)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_N, 16)
             new_states = set_states + unset_states
 
         # Z bit
@@ -1050,17 +1104,17 @@ class CPU:
             unset_states = [x.clone() for x in new_states] # Z bit cleared
             for st in set_states:
                 st.path.add(source_val == dest_val)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_Z, 16)
             for st in unset_states:
                 st.path.add(source_val != dest_val)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_Z, 16)
             new_states = set_states + unset_states
 
 
         # C bit
         # basically we check if the highest bit transitioned from a 1 to a 0
         if 'C' in flags_needed:
-            zero_bit = BitVecVal(0, 1)
+            zero_bit = bv(0, 1)
             src_ext = Concat(zero_bit, ~source_val + 1) # cmp == dst + ~src + 1
             dst_ext = Concat(zero_bit, dest_val)
             did_overflow = Extract(src_ext.size()-1, src_ext.size()-1, src_ext + dst_ext) == 1
@@ -1069,10 +1123,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states] # C bit cleared
             for st in set_states:
                 st.path.add(did_overflow)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_C, 16)
             for st in unset_states:
                 st.path.add(Not(did_overflow))
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_C, 16)
             new_states = set_states + unset_states
         
         # V bit
@@ -1084,13 +1138,13 @@ class CPU:
                 condA = And(source_val < 0, dest_val > 0, dest_val - source_val < 0)
                 condB = And(source_val > 0, dest_val < 0, dest_val - source_val > 0)
                 st.path.add(Or(condA, condB))
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_V, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_V, 16)
             for st in unset_states:
                 # following conditions above...
                 condA = And(source_val < 0, dest_val > 0, dest_val - source_val < 0)
                 condB = And(source_val > 0, dest_val < 0, dest_val - source_val > 0)
                 st.path.add(Not(Or(condA, condB)))
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_V, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_V, 16)
             new_states = set_states + unset_states
 
         # set dest location to the difference in all states
@@ -1102,7 +1156,7 @@ class CPU:
                 elif instruction.width == OperandWidth.BYTE:
                     # top bits get cloeared
                     st.cpu.registers[dest_loc] = Concat( \
-                            BitVecVal(0, 8), \
+                            bv(0, 8), \
                             dest_val - source_val)
 
             elif dest_type == DestinationType.ADDRESS:
@@ -1128,31 +1182,29 @@ class CPU:
             if instruction.width == OperandWidth.WORD:
                 dest_val = st.cpu.registers[dest_loc]
             elif instruction.width == OperandWidth.BYTE:
-                dest_val = Extract(7, 0, st.cpu.registers[dest_loc])
+                dest_val = extract(7, 0, st.cpu.registers[dest_loc])
         elif dest_type == DestinationType.ADDRESS:
             if instruction.width == OperandWidth.WORD:
-                dest_val = Concat(st.memory[dest_loc+1], \
+                dest_val = concat(st.memory[dest_loc+1], \
                         st.memory[dest_loc])
             elif instruction.width == OperandWidth.BYTE:
                 dest_val = st.memory[dest_loc]
 
 
-        if enable_unsound_optimizations:
-            # lookahead 6 instruction, and compute relevant
-            # flags from the kind of jump
-            insns = state.decode_some_instructions(instruction.address, 6)
+        if self.lazy_flags:
+            zero_bit = bv(0, 1)
+            src_ext = Concat(zero_bit, ~source_val + 1) # cmp == dst + ~src + 1
+            dst_ext = Concat(zero_bit, dest_val)
+            did_overflow = Extract(src_ext.size()-1, src_ext.size()-1, src_ext + dst_ext) == 1
+            condA = And(source_val < 0, dest_val > 0, dest_val - source_val < 0)
+            condB = And(source_val > 0, dest_val < 0, dest_val - source_val > 0)
+            self.set_flags_lazily(st, n=source_val > dest_val, \
+                    z=source_val == dest_val, c=did_overflow, \
+                    v=Or(condA, condB))
             flags_needed = set()
-            for insn in insns:
-                if insn.opcode in {Opcode.JN, Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('N')
-                if insn.opcode in {Opcode.JNZ, Opcode.JZ}:
-                    flags_needed.add('Z')
-                if insn.opcode in {Opcode.JNC, Opcode.JC}:
-                    flags_needed.add('C')
-                if insn.opcode in {Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('V')
         else:
-            flags_needed = {'N', 'Z', 'C', 'V'}
+            flags_needed = self.flags_needed(state, instruction, \
+                    enable_unsound_optimizations=enable_unsound_optimizations)
 
 
         # From SLAU144J, the way all the flags are set:
@@ -1170,10 +1222,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states] # N bit cleared
             for st in set_states:
                 st.path.add(source_val > dest_val)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_N, 16)
             for st in unset_states:
                 st.path.add(source_val <= dest_val)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_N, 16)
             new_states = set_states + unset_states
 
         # Z bit
@@ -1182,15 +1234,15 @@ class CPU:
             unset_states = [x.clone() for x in new_states] # Z bit cleared
             for st in set_states:
                 st.path.add(source_val == dest_val)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_Z, 16)
             for st in unset_states:
                 st.path.add(source_val != dest_val)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_Z, 16)
             new_states = set_states + unset_states
 
         # C bit
         if 'C' in flags_needed:
-            zero_bit = BitVecVal(0, 1)
+            zero_bit = bv(0, 1)
             src_ext = Concat(zero_bit, ~source_val + 1) # cmp == dst + ~src + 1
             dst_ext = Concat(zero_bit, dest_val)
             did_overflow = Extract(src_ext.size()-1, src_ext.size()-1, src_ext + dst_ext) == 1
@@ -1199,10 +1251,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states] # C bit cleared
             for st in set_states:
                 st.path.add(did_overflow)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_C, 16)
             for st in unset_states:
                 st.path.add(Not(did_overflow))
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_C, 16)
             new_states = set_states + unset_states
         
         # V bit
@@ -1214,13 +1266,13 @@ class CPU:
                 condA = And(source_val < 0, dest_val > 0, dest_val - source_val < 0)
                 condB = And(source_val > 0, dest_val < 0, dest_val - source_val > 0)
                 st.path.add(Or(condA, condB))
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_V, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_V, 16)
             for st in unset_states:
                 # following conditions above...
                 condA = And(source_val < 0, dest_val > 0, dest_val - source_val < 0)
                 condB = And(source_val > 0, dest_val < 0, dest_val - source_val > 0)
                 st.path.add(Not(Or(condA, condB)))
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_V, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_V, 16)
             new_states = set_states + unset_states
 
         return new_states
@@ -1242,30 +1294,23 @@ class CPU:
             if instruction.width == OperandWidth.WORD:
                 dest_val = st.cpu.registers[dest_loc]
             elif instruction.width == OperandWidth.BYTE:
-                dest_val = Extract(7, 0, st.cpu.registers[dest_loc])
+                dest_val = extract(7, 0, st.cpu.registers[dest_loc])
         elif dest_type == DestinationType.ADDRESS:
             if instruction.width == OperandWidth.WORD:
-                dest_val = Concat(st.memory[dest_loc+1], \
+                dest_val = concat(st.memory[dest_loc+1], \
                         st.memory[dest_loc])
             elif instruction.width == OperandWidth.BYTE:
                 dest_val = st.memory[dest_loc]
 
-        if enable_unsound_optimizations:
-            # lookahead 6 instruction, and compute relevant
-            # flags from the kind of jump
-            insns = state.decode_some_instructions(instruction.address, 6)
+        if self.lazy_flags:
+            high_set = lambda x: Extract(x.size()-1, x.size()-1, x) == 0b1
+            self.set_flags_lazily(st, n=high_set(source_val & dest_val), \
+                    z=(source_val & dest_val) == 0, \
+                    c=(source_val & dest_val) != 0)
             flags_needed = set()
-            for insn in insns:
-                if insn.opcode in {Opcode.JN, Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('N')
-                if insn.opcode in {Opcode.JNZ, Opcode.JZ}:
-                    flags_needed.add('Z')
-                if insn.opcode in {Opcode.JNC, Opcode.JC}:
-                    flags_needed.add('C')
-                if insn.opcode in {Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('V')
         else:
-            flags_needed = {'N', 'Z', 'C', 'V'}
+            flags_needed = self.flags_needed(state, instruction, \
+                    enable_unsound_optimizations=enable_unsound_optimizations)
 
         # Flag Semantics from SLAU144J:
         # N: Set if MSB of result is set, reset otherwise
@@ -1281,10 +1326,10 @@ class CPU:
             high_set = lambda x: Extract(x.size()-1, x.size()-1, x) == 0b1
             for st in set_states:
                 st.path.add(high_set(source_val & dest_val))
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_N, 16)
             for st in unset_states:
                 st.path.add(Not(high_set(source_val & dest_val)))
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_N, 16)
             new_states = set_states + unset_states
 
         # Z flag
@@ -1293,10 +1338,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states]
             for st in set_states:
                 st.path.add((source_val & dest_val) == 0)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_Z, 16)
             for st in unset_states:
                 st.path.add((source_val & dest_val) != 0)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_Z, 16)
             new_states = set_states + unset_states
 
         # C flag
@@ -1305,15 +1350,15 @@ class CPU:
             unset_states = [x.clone() for x in new_states]
             for st in set_states:
                 st.path.add((source_val & dest_val) != 0)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_C, 16)
             for st in unset_states:
                 st.path.add((source_val & dest_val) == 0)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_C, 16)
             new_states = set_states + unset_states
 
         # V flag (always set)
         for st in new_states:
-            st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_V, 16)
+            st.cpu.registers[Register.R2] &= bv(~self.registers.mask_V, 16)
 
         return new_states
 
@@ -1333,7 +1378,7 @@ class CPU:
             elif instruction.width == OperandWidth.BYTE:
                 st.cpu.registers[dest_loc] &= \
                         ~Concat( \
-                        BitVecVal(0, 8), source_val)
+                        bv(0, 8), source_val)
         elif dest_type == DestinationType.ADDRESS:
             if instruction.width == OperandWidth.WORD:
                 st.memory[dest_loc] &= ~Extract(7, 0, source_val)
@@ -1359,7 +1404,7 @@ class CPU:
             elif instruction.width == OperandWidth.BYTE:
                 st.cpu.registers[dest_loc] |= \
                         Concat( \
-                        BitVecVal(0, 8), source_val)
+                        bv(0, 8), source_val)
         elif dest_type == DestinationType.ADDRESS:
             if instruction.width == OperandWidth.WORD:
                 st.memory[dest_loc] |= Extract(7, 0, source_val)
@@ -1382,30 +1427,24 @@ class CPU:
             if instruction.width == OperandWidth.WORD:
                 dest_val = st.cpu.registers[dest_loc]
             elif instruction.width == OperandWidth.BYTE:
-                dest_val = Extract(7, 0, st.cpu.registers[dest_loc])
+                dest_val = extract(7, 0, st.cpu.registers[dest_loc])
         elif dest_type == DestinationType.ADDRESS:
             if instruction.width == OperandWidth.WORD:
-                dest_val = Concat(st.memory[dest_loc+1], \
+                dest_val = concat(st.memory[dest_loc+1], \
                         st.memory[dest_loc])
             elif instruction.width == OperandWidth.BYTE:
                 dest_val = st.memory[dest_loc]
 
-        if enable_unsound_optimizations:
-            # lookahead 6 instruction, and compute relevant
-            # flags from the kind of jump
-            insns = state.decode_some_instructions(instruction.address, 6)
+        if self.lazy_flags:
+            highest_bit = lambda x: Extract(x.size()-1, x.size()-1, x)
+            self.set_flags_lazily(st, n=highest_bit(source_val ^ dest_val) == 1, \
+                    z=(source_val ^ dest_val) == 0, \
+                    c=(source_val ^ dest_val) != 0, \
+                    v=And(source_val < 0, dest_val < 0))
             flags_needed = set()
-            for insn in insns:
-                if insn.opcode in {Opcode.JN, Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('N')
-                if insn.opcode in {Opcode.JNZ, Opcode.JZ}:
-                    flags_needed.add('Z')
-                if insn.opcode in {Opcode.JNC, Opcode.JC}:
-                    flags_needed.add('C')
-                if insn.opcode in {Opcode.JGE, Opcode.JL}:
-                    flags_needed.add('V')
         else:
-            flags_needed = {'N', 'Z', 'C', 'V'}
+            flags_needed = self.flags_needed(state, instruction, \
+                    enable_unsound_optimizations=enable_unsound_optimizations)
 
         # Flags according to SLAU144J:
 	# N: Set if result MSB is set, reset if not set
@@ -1421,10 +1460,10 @@ class CPU:
             highest_bit = lambda x: Extract(x.size()-1, x.size()-1, x)
             for st in set_states:
                 st.path.add(highest_bit(source_val ^ dest_val) == 1)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_N, 16)
             for st in unset_states:
                 st.path.add(highest_bit(source_val ^ dest_val) == 0)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_N, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_N, 16)
             new_states = set_states + unset_states
 
         # Z flag
@@ -1433,10 +1472,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states]
             for st in set_states:
                 st.path.add((source_val ^ dest_val) == 0)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_Z, 16)
             for st in unset_states:
                 st.path.add((source_val ^ dest_val) != 0)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_Z, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_Z, 16)
             new_states = set_states + unset_states
 
         # C flag
@@ -1445,10 +1484,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states]
             for st in set_states:
                 st.path.add((source_val ^ dest_val) != 0)
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_C, 16)
             for st in unset_states:
                 st.path.add((source_val ^ dest_val) == 0)
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_C, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_C, 16)
             new_states = set_states + unset_states
 
         # V flag
@@ -1457,10 +1496,10 @@ class CPU:
             unset_states = [x.clone() for x in new_states]
             for st in set_states:
                 st.path.add(And(source_val < 0, dest_val < 0))
-                st.cpu.registers[Register.R2] |= BitVecVal(self.registers.mask_V, 16)
+                st.cpu.registers[Register.R2] |= bv(self.registers.mask_V, 16)
             for st in unset_states:
                 st.path.add(Not(And(source_val < 0, dest_val < 0)))
-                st.cpu.registers[Register.R2] &= ~BitVecVal(self.registers.mask_V, 16)
+                st.cpu.registers[Register.R2] &= bv(~self.registers.mask_V, 16)
             new_states = set_states + unset_states
 
 
@@ -1472,7 +1511,7 @@ class CPU:
                 elif instruction.width == OperandWidth.BYTE:
                     st.cpu.registers[dest_loc] = \
                             Concat( \
-                            BitVecVal(0, 8), res_val)
+                            bv(0, 8), res_val)
             elif dest_type == DestinationType.ADDRESS:
                 if instruction.width == OperandWidth.WORD:
                     st.memory[dest_loc] = Extract(7, 0, res_val)
@@ -1500,7 +1539,7 @@ class CPU:
             elif instruction.width == OperandWidth.BYTE:
                 st.cpu.registers[dest_loc] &= \
                         Concat( \
-                        BitVecVal(0, 8), source_val)
+                        bv(0, 8), source_val)
         elif dest_type == DestinationType.ADDRESS:
             if instruction.width == OperandWidth.WORD:
                 st.memory[dest_loc] &= Extract(7, 0, source_val)
@@ -1552,7 +1591,7 @@ class CPU:
         all_nonzero = And([x != 0 for x in sym_bytes])
         # if all are nonzero, byte after last is set to zero
         st.memory[dest_addr + length + 1] = If(all_nonzero, \
-                                               BitVecVal(0, 8), \
+                                               bv(0, 8), \
                                                st.memory[dest_addr + length + 1])
 
         return [st]
@@ -0,0 +1,287 @@
+"""
+Static distances to the places an exploit has to get to, for directing the
+search (see strategy.DirectedStrategy).
+
+There are two kinds of target:
+    - unlocking the door: an interrupt 0x7f, either through the INT wrapper
+      (push #0x7f; call #INT) or straight through the callgate
+      (mov #0xff00, sr; call #0x10)
+    - returning from a function that read input (e.g. login, after getsn
+      into a buffer on its stack), where the return address might be
+      controllable
+
+The distance of an instruction is the fewest instructions that have to run
+from it to reach one of them, over an interprocedural graph of every known
+instruction: a call goes to its callee (or to the next instruction if the
+callee isn't known code), and a ret goes back to the instruction after every
+call to its function. That ignores the call stack, so it's a guess, but it
+never says a target is unreachable when it isn't, as long as the code only
+jumps where the CFG knows about.
+
+Instructions that can't reach a target at all are dead ends, and states
+there can be dropped (see dead_ends). Anywhere control goes that the graph
+doesn't follow (br r15, call r15, a ret from a function with no known
+callers, running into code that doesn't decode) counts as maybe reaching
+one, and so does raising an interrupt whose number isn't a constant. Like
+the flag liveness analysis, this assumes the code doesn't change while
+running.
+"""
+from collections import deque
+
+from .code import Opcode, Register, AddressingMode, SingleOperandInstruction, \
+        JumpInstruction, DoubleOperandInstruction
+from .cfg import CFG, intval
+from .liveness import is_ret, _constant_values
+
+
+UNLOCK_INTERRUPT = 0x7f
+GETS_INTERRUPT = 0x02
+
+
+def _value(mode, operand):
+    """
+    The value of a source operand, if it's a constant
+    """
+    if mode == AddressingMode.IMMEDIATE:
+        return intval(operand)
+    return _constant_values.get(mode)
+
+
+def _call_target(insn):
+    if insn.opcode != Opcode.CALL or \
+            insn.addressing_mode != AddressingMode.IMMEDIATE:
+        return None
+    return intval(insn.operand)
+
+
+def _interrupt_number(previous, insn, wrappers, interrupt_address):
+    """
+    The interrupt a call raises, if it's one this can tell: the number pushed
+    right before calling an INT wrapper, or the one put into SR right before
+    calling the callgate.
+    """
+    target = _call_target(insn)
+    if target is None or previous is None:
+        return None
+    if target in wrappers and previous.opcode == Opcode.PUSH:
+        return _value(previous.addressing_mode, previous.operand)
+    if target == interrupt_address and \
+            isinstance(previous, DoubleOperandInstruction) and \
+            previous.opcode == Opcode.MOV and \
+            previous.dest_register == Register.R2 and \
+            previous.dest_addressing_mode == AddressingMode.DIRECT:
+        value = _value(previous.source_addressing_mode, previous.source_operand)
+        if value is not None:
+            return (value >> 8) & 0x7f
+    return None
+
+
+class TargetDistances:
+    """
+    Distances from every known instruction to the closest target.
+
+    After analyze(), self.distances maps instruction addresses to distances,
+    self.unlocks holds the addresses of the calls that unlock, and
+    self.input_returns the rets of functions that read input.
+    self.unknown_exits holds the instructions that go somewhere the graph
+    doesn't know about.
+    """
+    def __init__(self, cfg, interrupt_address=0x10):
+        self.cfg = cfg
+        self.interrupt_address = interrupt_address
+        self.distances = {}
+        self.unlocks = set()
+        self.input_returns = set()
+        self.unknown_exits = set()
+        self._graph = {} # see _build_graphs
+        self._local = {}
+        self._calls = {}
+        self._return_sites = {} # function entry -> addresses after calls to it
+        self._rets = {} # function entry -> addresses of its rets
+
+        # function entry -> instructions, in order. The callgate shows up as
+        # a function with none, and is left out, so calls to it go on to the
+        # next instruction.
+        self._instructions = {}
+        for fn in cfg.functions:
+            instructions = sorted( \
+                    (insn for bb in fn.basic_blocks for insn in bb.instructions), \
+                    key=lambda insn: insn.address)
+            if instructions:
+                self._instructions[fn.entry_point] = instructions
+
+    def _wrappers(self):
+        """
+        The functions that call the callgate themselves (like INT)
+        """
+        return {entry for entry, instructions in self._instructions.items() \
+                if any(_call_target(insn) == self.interrupt_address \
+                    for insn in instructions)}
+
+    def _find_targets(self):
+        wrappers = self._wrappers()
+        readers = set() # functions that raise the gets interrupt
+        for entry, instructions in self._instructions.items():
+            previous = None
+            for insn in instructions:
+                number = _interrupt_number(previous, insn, wrappers, \
+                        self.interrupt_address)
+                if number == UNLOCK_INTERRUPT:
+                    self.unlocks.add(insn.address)
+                elif number == GETS_INTERRUPT:
+                    readers.add(entry)
+                elif number is None and entry not in wrappers and \
+                        (_call_target(insn) in wrappers or \
+                        _call_target(insn) == self.interrupt_address):
+                    self.unknown_exits.add(insn.address) # could be an unlock
+                previous = insn
+
+        for entry, instructions in self._instructions.items():
+            if entry in readers or entry in wrappers:
+                continue
+            if any(_call_target(insn) in readers for insn in instructions):
+                self.input_returns.update(insn.address \
+                        for insn in instructions if is_ret(insn))
+
+    def _build_graphs(self):
+        """
+        Fill in the graphs the searches run over, as instruction address ->
+        addresses of the instructions that can run right before it:
+            - self._graph has every edge, with rets going back to every
+              call site (what the distances are measured over)
+            - self._local has the edges within functions, with a call
+              going straight on to the next instruction if its callee can
+              return
+            - self._calls has the edges from calls to their callees
+        """
+        known = {insn.address for instructions in self._instructions.values() \
+                for insn in instructions}
+        def edge(src, dst, *graphs):
+            if dst not in known:
+                self.unknown_exits.add(src)
+            for graph in (self._graph,) + graphs:
+                graph.setdefault(dst, []).append(src)
+
+        for instructions in self._instructions.values():
+            for insn in instructions:
+                target = _call_target(insn)
+                if target in self._instructions:
+                    self._return_sites.setdefault(target, []).append( \
+                            insn.address + len(insn.raw))
+
+        for entry, instructions in self._instructions.items():
+            self._rets[entry] = [insn.address \
+                    for insn in instructions if is_ret(insn)]
+
+        for entry, instructions in self._instructions.items():
+            for insn in instructions:
+                address = insn.address
+                following = address + len(insn.raw)
+                if is_ret(insn):
+                    if entry not in self._return_sites:
+                        self.unknown_exits.add(address)
+                    for site in self._return_sites.get(entry, ()):
+                        edge(address, site)
+                elif isinstance(insn, JumpInstruction):
+                    edge(address, intval(insn.target), self._local)
+                    if insn.opcode != Opcode.JMP:
+                        edge(address, following, self._local)
+                elif isinstance(insn, SingleOperandInstruction) and \
+                        insn.opcode == Opcode.CALL:
+                    target = _call_target(insn)
+                    if target in self._instructions:
+                        edge(address, target, self._calls)
+                        if self._rets[target]:
+                            self._local.setdefault(following, []).append(address)
+                    else:
+                        if target is None:
+                            self.unknown_exits.add(address)
+                        edge(address, following, self._local)
+                elif isinstance(insn, DoubleOperandInstruction) and \
+                        insn.dest_register == Register.R0 and \
+                        insn.dest_addressing_mode == AddressingMode.DIRECT:
+                    # br somewhere the CFG doesn't know
+                    self.unknown_exits.add(address)
+                else:
+                    edge(address, following, self._local)
+
+    @staticmethod
+    def _search(targets, *graphs):
+        """
+        Breadth first backwards from targets through graphs: address ->
+        distance, for every address that reaches one of them
+        """
+        distances = {address: 0 for address in targets}
+        queue = deque(targets)
+        while queue:
+            address = queue.popleft()
+            distance = distances[address] + 1
+            for graph in graphs:
+                for src in graph.get(address, ()):
+                    if src not in distances:
+                        distances[src] = distance
+                        queue.append(src)
+        return distances
+
+    def analyze(self):
+        self._find_targets()
+        self._build_graphs()
+        self.distances = self._search(self.unlocks | self.input_returns, \
+                self._graph)
+        return self.distances
+
+    def dead_ends(self):
+        """
+        The addresses of the instructions (after analyze()) that can't reach
+        a target, even through somewhere the graph doesn't know about. If
+        there are no targets at all, that's taken to mean the analysis can't
+        see the program properly, and nothing is a dead end.
+
+        Unlike the distances, this keeps track of where calls return to: an
+        instruction is only alive if it reaches a target (maybe down in a
+        function it calls), or reaches a ret of its function that returns
+        somewhere alive.
+        """
+        if not self.distances:
+            return frozenset()
+
+        # without returning from the function it's in
+        targets = self.unlocks | self.input_returns | self.unknown_exits
+        alive = set(self._search(targets, self._local, self._calls))
+        while True:
+            returning = {ret for entry, rets in self._rets.items() \
+                    if any(site in alive \
+                        for site in self._return_sites.get(entry, ())) \
+                    for ret in rets}
+            more = set(self._search(alive | returning, self._local))
+            if more == alive:
+                break
+            alive = more
+
+        return frozenset(insn.address \
+                for instructions in self._instructions.values() \
+                for insn in instructions if insn.address not in alive)
+
+def target_distances(memory, entry_point):
+    """
+    Build the CFG of the program in memory starting at entry_point, and
+    return a dict of instruction address -> fewest instructions from there to
+    an unlock or a return from a function that read input. Instructions that
+    can't reach either aren't in it.
+    """
+    cfg = CFG(memory)
+    cfg.generate_all_functions(entry_point)
+    return TargetDistances(cfg).analyze()
+
+
+def dead_ends(memory, entry_point):
+    """
+    Build the CFG of the program in memory starting at entry_point, and
+    return the set of addresses of the instructions that can never lead to
+    an unlock or a return from a function that read input
+    """
+    cfg = CFG(memory)
+    cfg.generate_all_functions(entry_point)
+    distances = TargetDistances(cfg)
+    distances.analyze()
+    return distances.dead_ends()
@@ -0,0 +1,371 @@
+"""
+Static liveness analysis of the status flags (N, Z, C, V in SR).
+
+For every instruction in the functions of a CFG, this works out which flags
+might be read before they are next overwritten, once that instruction has
+executed. Flag-setting instructions only need to fork on (or compute) the
+flags that are live after them.
+
+The analysis is interprocedural and conservative:
+    - a call makes live whatever is live at the entry of the callee
+    - a ret makes live whatever is live after any call to its function
+    - anything the analysis can't follow (indirect calls and jumps, falling
+      off the end of the known code, returning from a function that has no
+      known callers) makes every flag live
+
+Saving SR on the stack (push sr ... pop sr, like the INT routine does) is
+tracked, by keeping the flags that are live after the pop live in a "saved"
+copy until the push. This assumes the saved SR is only read back by pop sr.
+
+It also assumes calls return to the instruction after the call, and that the
+code doesn't change while running.
+"""
+from .code import Opcode, Register, AddressingMode, SingleOperandInstruction, \
+        JumpInstruction, DoubleOperandInstruction
+from .cfg import CFG, intval
+
+
+ALL_FLAGS = frozenset({'N', 'Z', 'C', 'V'})
+NO_FLAGS = frozenset()
+
+# the flags in an SR that was pushed onto the stack
+_saved = {flag: 'saved ' + flag for flag in ALL_FLAGS}
+_unsaved = {saved: flag for flag, saved in _saved.items()}
+
+# flags read by each conditional jump
+_jump_uses = {
+    Opcode.JNZ: frozenset({'Z'}),
+    Opcode.JZ: frozenset({'Z'}),
+    Opcode.JNC: frozenset({'C'}),
+    Opcode.JC: frozenset({'C'}),
+    Opcode.JN: frozenset({'N'}),
+    Opcode.JGE: frozenset({'N', 'V'}),
+    Opcode.JL: frozenset({'N', 'V'}),
+    Opcode.JMP: NO_FLAGS,
+}
+
+# flags written by each instruction (as the CPU implements them)
+_opcode_defs = {
+    Opcode.ADD: ALL_FLAGS,
+    Opcode.SUB: ALL_FLAGS,
+    Opcode.CMP: ALL_FLAGS,
+    Opcode.BIT: ALL_FLAGS,
+    Opcode.XOR: ALL_FLAGS,
+    Opcode.SXT: ALL_FLAGS,
+    Opcode.RRC: frozenset({'C'}),
+}
+
+# flags read by instructions other than jumps
+_opcode_uses = {
+    Opcode.RRC: frozenset({'C'}),
+    Opcode.ADDC: frozenset({'C'}),
+    Opcode.SUBC: frozenset({'C'}),
+    Opcode.DADD: frozenset({'C'}),
+}
+
+def is_ret(insn):
+    # ret == mov @sp+, pc
+    return insn.opcode == Opcode.RETI or \
+            (insn.opcode == Opcode.MOV and \
+            insn.source_addressing_mode == AddressingMode.AUTOINCREMENT and \
+            insn.source_register == Register.R1 and \
+            insn.dest_register == Register.R0)
+
+
+def _reads_sr(insn):
+    """
+    Does insn read SR as a value (not as a constant generator)?
+    """
+    if isinstance(insn, SingleOperandInstruction):
+        return insn.register == Register.R2 and \
+                insn.addressing_mode == AddressingMode.DIRECT
+    if isinstance(insn, DoubleOperandInstruction):
+        if insn.source_register == Register.R2 and \
+                insn.source_addressing_mode == AddressingMode.DIRECT:
+            return True
+        # everything but mov reads its destination, but setting or clearing
+        # bits in SR (e.g. bis #0xf0, sr to halt) leaves the rest as they were
+        return insn.opcode not in {Opcode.MOV, Opcode.BIS, Opcode.BIC} and \
+                insn.dest_register == Register.R2 and \
+                insn.dest_addressing_mode == AddressingMode.DIRECT
+    return False
+
+
+# same masks as RegisterFile
+_flag_masks = {'C': 0b1, 'Z': 0b10, 'N': 0b100, 'V': 0b10000000}
+
+_constant_values = {
+    AddressingMode.CONSTANT0: 0,
+    AddressingMode.CONSTANT1: 1,
+    AddressingMode.CONSTANT2: 2,
+    AddressingMode.CONSTANT4: 4,
+    AddressingMode.CONSTANT8: 8,
+    AddressingMode.CONSTANTNEG1: 0xffff,
+}
+
+
+def _sr_bits_set(insn):
+    """
+    The flags that a bis or bic into SR sets or clears
+    """
+    if not (insn.opcode in {Opcode.BIS, Opcode.BIC} and \
+            insn.dest_register == Register.R2 and \
+            insn.dest_addressing_mode == AddressingMode.DIRECT):
+        return NO_FLAGS
+    if insn.source_addressing_mode == AddressingMode.IMMEDIATE:
+        value = intval(insn.source_operand)
+    elif insn.source_addressing_mode in _constant_values:
+        value = _constant_values[insn.source_addressing_mode]
+    else:
+        return NO_FLAGS
+    return frozenset(flag for flag, mask in _flag_masks.items() if value & mask)
+
+
+def _is_push_sr(insn):
+    return insn.opcode == Opcode.PUSH and insn.register == Register.R2 and \
+            insn.addressing_mode == AddressingMode.DIRECT
+
+
+def _is_pop_sr(insn):
+    # pop sr == mov @sp+, sr
+    return insn.opcode == Opcode.MOV and \
+            insn.source_addressing_mode == AddressingMode.AUTOINCREMENT and \
+            insn.source_register == Register.R1 and \
+            insn.dest_register == Register.R2 and \
+            insn.dest_addressing_mode == AddressingMode.DIRECT
+
+
+def _writes_sr(insn):
+    """
+    Does insn overwrite all of SR?
+    """
+    return isinstance(insn, DoubleOperandInstruction) and \
+            insn.opcode == Opcode.MOV and \
+            insn.dest_register == Register.R2 and \
+            insn.dest_addressing_mode == AddressingMode.DIRECT
+
+
+def _writes_pc(insn):
+    """
+    Is insn a jump that isn't a JumpInstruction (e.g. br r15)?
+    """
+    return isinstance(insn, DoubleOperandInstruction) and \
+            insn.dest_register == Register.R0 and \
+            insn.dest_addressing_mode == AddressingMode.DIRECT and \
+            not is_ret(insn)
+
+
+def _call_target(insn):
+    """
+    The address a call instruction calls, or None if it isn't known
+    """
+    if insn.addressing_mode != AddressingMode.IMMEDIATE:
+        return None
+    return intval(insn.operand)
+
+
+class FlagLiveness:
+    """
+    Flag liveness of every instruction in a CFG.
+
+    After analyze(), self.live_after maps instruction addresses to the
+    frozenset of flags that are live after that instruction, and self.raw
+    maps them to the bytes of the instruction that was analyzed.
+    """
+    def __init__(self, cfg, interrupt_address=0x10):
+        self.cfg = cfg
+        self.interrupt_address = interrupt_address
+        self.live_after = {}
+        self.raw = {}
+
+        self._entries = {} # function entry address -> function
+        self._blocks = {} # function entry address -> {start address -> block}
+        self._callers = {} # function entry address -> set of return addresses
+        for fn in cfg.functions:
+            self._entries[fn.entry_point] = fn
+            self._blocks[fn.entry_point] = \
+                    {bb.start_address: bb for bb in fn.basic_blocks}
+
+        for entry, blocks in self._blocks.items():
+            for bb in blocks.values():
+                ip = bb.start_address
+                for insn in bb.instructions:
+                    ip += len(insn.raw)
+                    if insn.opcode == Opcode.CALL:
+                        target = _call_target(insn)
+                        if target in self._entries:
+                            self._callers.setdefault(target, set()).add(ip)
+
+        self._block_live_in = {} # (function entry, block start) -> flags
+        self._function_live_in = {} # function entry -> flags
+        self._return_live = {} # function entry -> flags live after its rets
+        self._looking_up = set() # addresses _live_at_address is working on
+
+    def _live_at(self, entry, address):
+        """
+        Flags live at the start of address, a block in function entry
+        """
+        bb = self._blocks[entry].get(address)
+        if bb is None or not bb.instructions:
+            # not somewhere in this function, look everywhere else
+            return self._live_at_address(address)
+        return self._block_live_in.get((entry, address), NO_FLAGS)
+
+    def _transfer(self, entry, insn, live, record):
+        """
+        Flags live before insn, given the flags live after it
+        """
+        if record:
+            self.live_after[insn.address] = \
+                    self.live_after.get(insn.address, NO_FLAGS) | (live & ALL_FLAGS)
+            self.raw[insn.address] = insn.raw
+
+        saved = live - ALL_FLAGS
+        if _is_push_sr(insn):
+            # the flags live in the saved SR are live in SR again
+            return (live & ALL_FLAGS) | {_unsaved[flag] for flag in saved}
+        if _is_pop_sr(insn):
+            return frozenset(_saved[flag] for flag in live & ALL_FLAGS)
+
+        if insn.opcode == Opcode.CALL:
+            target = _call_target(insn)
+            if target == self.interrupt_address:
+                return live # interrupts don't touch the flags
+            if target not in self._entries:
+                return ALL_FLAGS | saved
+            return self._function_live_in.get(target, NO_FLAGS) | saved
+
+        if _writes_sr(insn):
+            live = saved
+        else:
+            live = live - _opcode_defs.get(insn.opcode, NO_FLAGS) - \
+                    _sr_bits_set(insn)
+        live = live | _opcode_uses.get(insn.opcode, NO_FLAGS)
+        if isinstance(insn, JumpInstruction):
+            live = live | _jump_uses[insn.opcode]
+        if _reads_sr(insn):
+            live = live | ALL_FLAGS
+        return live
+
+    def _block_live_out(self, entry, bb):
+        """
+        Flags live after the last instruction of bb
+        """
+        insn = bb.instructions[-1]
+        next_address = bb.end_address
+
+        if is_ret(insn):
+            if entry not in self._callers:
+                return ALL_FLAGS # we don't know where this goes
+            return self._return_live.get(entry, NO_FLAGS)
+        if isinstance(insn, JumpInstruction):
+            target = intval(insn.target)
+            if insn.opcode == Opcode.JMP:
+                return self._live_at(entry, target)
+            return self._live_at(entry, target) | \
+                    self._live_at(entry, next_address)
+        if _writes_pc(insn):
+            if insn.opcode == Opcode.MOV and \
+                    insn.source_addressing_mode == AddressingMode.IMMEDIATE:
+                # br #address
+                return self._live_at(entry, intval(insn.source_operand))
+            return ALL_FLAGS
+        return self._live_at(entry, next_address) # falls through
+
+    def _analyze_block(self, entry, bb, record=False):
+        live = self._block_live_out(entry, bb)
+        for insn in reversed(bb.instructions):
+            live = self._transfer(entry, insn, live, record)
+        return live
+
+    def _update_return_live(self):
+        """
+        Collect what is live after every call into the function it calls
+        """
+        return_live = {}
+        for entry, return_addresses in self._callers.items():
+            live = NO_FLAGS
+            for address in return_addresses:
+                live |= self._live_at_address(address)
+            return_live[entry] = live
+        return return_live
+
+    def _live_at_address(self, address):
+        """
+        Flags live before the instruction at address, in any function
+        """
+        if address in self._looking_up:
+            return ALL_FLAGS # jumping around outside of functions, give up
+        self._looking_up.add(address)
+        try:
+            return self._live_at_address_uncached(address)
+        finally:
+            self._looking_up.discard(address)
+
+    def _live_at_address_uncached(self, address):
+        live = NO_FLAGS
+        found = False
+        for entry, blocks in self._blocks.items():
+            for bb in blocks.values():
+                if not bb.start_address <= address < bb.end_address:
+                    continue
+                found = True
+                # run the block backwards until we get to address
+                block_live = self._block_live_out(entry, bb)
+                for insn in reversed(bb.instructions):
+                    if insn.address < address:
+                        break
+                    block_live = self._transfer(entry, insn, block_live, False)
+                live |= block_live
+        if not found:
+            return ALL_FLAGS
+        return live
+
+    def analyze(self):
+        """
+        Run the analysis to a fixed point, and return self.live_after
+        """
+        changed = True
+        while changed:
+            changed = False
+            for entry, blocks in self._blocks.items():
+                for bb in sorted(blocks.values(), \
+                        key=lambda bb: bb.start_address, reverse=True):
+                    if not bb.instructions:
+                        continue
+                    live = self._analyze_block(entry, bb)
+                    if live != self._block_live_in.get((entry, bb.start_address)):
+                        self._block_live_in[(entry, bb.start_address)] = live
+                        changed = True
+
+                function_live = self._live_at(entry, entry)
+                if function_live != self._function_live_in.get(entry):
+                    self._function_live_in[entry] = function_live
+                    changed = True
+
+            return_live = self._update_return_live()
+            if return_live != self._return_live:
+                self._return_live = return_live
+                changed = True
+
+        self.live_after = {}
+        self.raw = {}
+        for entry, blocks in self._blocks.items():
+            for bb in blocks.values():
+                if bb.instructions:
+                    self._analyze_block(entry, bb, record=True)
+        return self.live_after
+
+
+def flag_liveness(memory, entry_point):
+    """
+    Build the CFG of the program in memory starting at entry_point, and
+    return a dict of instruction address -> (raw bytes of the instruction,
+    flags live after it), suitable for CPU.live_flags
+    """
+    cfg = CFG(memory)
+    cfg.generate_all_functions(entry_point)
+    liveness = FlagLiveness(cfg)
+    live_after = liveness.analyze()
+    return {address: (liveness.raw[address], flags) \
+            for address, flags in live_after.items()}
@@ -0,0 +1,278 @@
+"""
+Summarizing loops that compare or scan memory, like strlen or a byte by byte
+password check.
+
+Stepping such a loop over symbolic input forks on every iteration: one state
+leaves the loop (the byte was the NUL, or didn't match) and one goes round
+again. Each of the states that left then runs the rest of the program on its
+own, so the number of states grows with the length of the input.
+
+summarize_loop runs a state through the whole loop at once, and folds all
+the states that leave it at the same exit into one. Which iteration the
+loop stopped on becomes a symbolic trip count n, an If chain over the
+conditions each iteration left on:
+
+    n = If(left at 0, 0, If(left at 1, 1, ...))
+
+Registers that count iterations (the loop's induction variables, the ones
+that go up by the same amount every time round) come out as base + step * n.
+Anything else (the last byte read, say) comes out as an If chain over the
+same conditions. The state's path gets a single new condition: that the
+first iteration that left the loop left it through this exit.
+
+The loops find_loops picks are the ones this works for: a run of code with a
+jump back to its start, that only reads memory and only writes registers
+(so every exit state has the same memory), and only jumps back to the start
+or out of the loop. No calls, so no interrupts and no IO.
+"""
+import z3
+
+from .code import Opcode, Register, AddressingMode, SingleOperandInstruction, \
+        JumpInstruction, DoubleOperandInstruction
+from .cfg import CFG, intval
+from .constants import word
+
+
+# how many iterations to run at once, before handing back a state still in
+# the loop (which gets summarized again from there)
+MAX_ITERATIONS = 0x100
+
+_register_ops = {Opcode.RRC, Opcode.RRA, Opcode.SWPB, Opcode.SXT}
+
+
+def _only_writes_registers(insn, head, end):
+    """
+    Whether insn writes nothing but registers (not SP or PC), and only jumps
+    back to head or out of [head, end)
+    """
+    if isinstance(insn, JumpInstruction):
+        target = intval(insn.target)
+        return target == head or not head <= target < end
+    if isinstance(insn, DoubleOperandInstruction):
+        if insn.source_addressing_mode == AddressingMode.AUTOINCREMENT and \
+                insn.source_register == Register.R1:
+            return False # pop
+        if insn.opcode in (Opcode.CMP, Opcode.BIT):
+            return True
+        return insn.dest_addressing_mode == AddressingMode.DIRECT and \
+                insn.dest_register not in (Register.R0, Register.R1)
+    if isinstance(insn, SingleOperandInstruction):
+        return insn.opcode in _register_ops and \
+                insn.addressing_mode == AddressingMode.DIRECT and \
+                insn.register not in (Register.R0, Register.R1)
+    return False
+
+
+_register_modes = {AddressingMode.DIRECT, AddressingMode.IMMEDIATE, \
+        AddressingMode.CONSTANT4, AddressingMode.CONSTANT8, \
+        AddressingMode.CONSTANT0, AddressingMode.CONSTANT1, \
+        AddressingMode.CONSTANT2, AddressingMode.CONSTANTNEG1}
+
+
+def _reads_memory(insn):
+    if not isinstance(insn, DoubleOperandInstruction):
+        return False
+    return insn.source_addressing_mode not in _register_modes or \
+            (insn.opcode in (Opcode.CMP, Opcode.BIT) and \
+            insn.dest_addressing_mode != AddressingMode.DIRECT)
+
+
+def _leaves(insn, head, end):
+    """
+    Whether insn (in the loop [head, end)) can go somewhere out of the loop
+    """
+    if not isinstance(insn, JumpInstruction):
+        return False
+    if not head <= intval(insn.target) < end:
+        return True
+    # falling through the last jump back
+    return insn.opcode != Opcode.JMP and insn.address + len(insn.raw) == end
+
+
+def find_loops(memory, entry_point):
+    """
+    Build the CFG of the program in memory starting at entry_point, and
+    return a dict of loop head -> end (the address after the last jump back
+    to the head), for the loops summarize_loop can run: ones that read memory
+    and have a way out (not, say, the jmp $ the program halts in)
+    """
+    cfg = CFG(memory)
+    cfg.generate_all_functions(entry_point)
+
+    loops = {}
+    for fn in cfg.functions:
+        instructions = {insn.address: insn \
+                for bb in fn.basic_blocks for insn in bb.instructions}
+        ends = {}
+        for insn in instructions.values():
+            if isinstance(insn, JumpInstruction) and \
+                    intval(insn.target) <= insn.address and \
+                    intval(insn.target) in instructions:
+                head = intval(insn.target)
+                ends[head] = max(ends.get(head, 0), insn.address + len(insn.raw))
+
+        for head, end in ends.items():
+            body = []
+            address = head
+            while address < end:
+                insn = instructions.get(address)
+                if insn is None or not _only_writes_registers(insn, head, end):
+                    break
+                body.append(insn)
+                address += len(insn.raw)
+            else:
+                if any(_reads_memory(insn) for insn in body) and \
+                        any(_leaves(insn, head, end) for insn in body):
+                    loops[head] = end
+    return loops
+
+
+def _impossible(state, since):
+    """
+    Whether one of the conditions state added to its path after the first
+    :since: simplifies to False
+    """
+    return any(condition is False or \
+            (z3.is_expr(condition) and z3.is_false(z3.simplify(condition))) \
+            for condition in state.path._path[since:])
+
+
+def _condition(state, since):
+    """
+    The conditions state added to its path after the first :since:, as one
+    """
+    conditions = [c for c in state.path._path[since:] if c is not True]
+    if not conditions:
+        return z3.BoolVal(True)
+    return z3.simplify(z3.And(*conditions))
+
+
+def _same(a, b):
+    if z3.is_expr(a) and z3.is_expr(b):
+        return a.eq(b)
+    return a is b or a == b
+
+
+def _chain(choices, otherwise):
+    """
+    If(c0, v0, If(c1, v1, ... otherwise)) of [(c0, v0), (c1, v1), ...]
+    """
+    value = otherwise
+    for condition, choice in reversed(choices):
+        value = z3.If(condition, choice, value)
+    return value
+
+
+def _fold(state, exits, left):
+    """
+    Fold exits, the [(iteration, condition, state)] that left the loop to the
+    same address, into one state. left is iteration -> the condition for
+    leaving the loop on it (through any exit).
+    """
+    if len(exits) == 1:
+        return exits[0][2]
+
+    # the first iteration that left, left through here
+    through_here = {}
+    for iteration, condition, _ in exits:
+        through_here.setdefault(iteration, []).append(condition)
+    condition = z3.BoolVal(False)
+    for iteration in sorted(left, reverse=True):
+        here = through_here.get(iteration)
+        condition = z3.If(left[iteration], \
+                z3.Or(*here) if here else z3.BoolVal(False), condition)
+
+    # the trip count, given that
+    trip = _chain([(c, word(iteration)) for iteration, c, _ in exits[:-1]], \
+            word(exits[-1][0]))
+
+    first = exits[0][2]
+    st = first.__class__(first.cpu.clone(), first.memory.clone(), \
+            state.path.clone(), first.sym_input.clone(), \
+            first.sym_output.clone(), first.unlocked, \
+            min(s.ticks for _, _, s in exits))
+    st.path.add(condition)
+
+    for i in range(16):
+        register = Register(i)
+        values = [s.cpu.registers[register] for _, _, s in exits]
+        if all(_same(value, values[0]) for value in values):
+            continue
+        concrete = [s.cpu.registers.concrete(register) for _, _, s in exits]
+        iterations = [iteration for iteration, _, _ in exits]
+        if None not in concrete and len(set(iterations)) == len(iterations):
+            # base + step * n, if it's the same step every iteration
+            step = (concrete[1] - concrete[0]) // (iterations[1] - iterations[0])
+            base = concrete[0] - step * iterations[0]
+            if all((base + step * n - value) & 0xffff == 0 \
+                    for n, value in zip(iterations, concrete)):
+                value = trip if step == 1 else word(step) * trip
+                if base & 0xffff:
+                    value = word(base) + value
+                st.cpu.registers[register] = value
+                continue
+        st.cpu.registers[register] = _chain( \
+                [(c, value) for (_, c, _), value in zip(exits, values)][:-1], \
+                values[-1])
+    return st
+
+
+def summarize_loop(state, end, enable_unsound_optimizations=True, \
+        blocks=None, max_iterations=MAX_ITERATIONS):
+    """
+    Run state (at the head of a loop from find_loops, that ends at end)
+    until it has left the loop, and return the states it left in, one per
+    exit address (plus the state still in the loop, after max_iterations).
+
+    Returns None if it can't: some state got a symbolic ip, or an iteration
+    can go round more than one way.
+    """
+    head = state.cpu.registers.concrete(Register.R0)
+    if head is None:
+        return None
+
+    current = state.clone()
+    current.ticks -= 1
+    exits = {} # address -> [(iteration, condition, state)]
+    left = {} # iteration -> condition for leaving on it
+    for iteration in range(max_iterations):
+        since = len(current.path._path)
+        running = [current]
+        back = []
+        leaving = []
+        while running:
+            st = running.pop()
+            for successor in st.step( \
+                    enable_unsound_optimizations=enable_unsound_optimizations, \
+                    blocks=blocks, summarize=False):
+                if _impossible(successor, since):
+                    continue
+                ip = successor.cpu.registers.concrete(Register.R0)
+                if ip is None:
+                    ip = z3.simplify(successor.cpu.registers[Register.R0])
+                    if not z3.is_bv_value(ip):
+                        return None
+                    ip = ip.as_long()
+                if ip == head:
+                    back.append(successor)
+                elif head <= ip < end:
+                    running.append(successor)
+                else:
+                    leaving.append((ip, successor))
+
+        if leaving:
+            conditions = []
+            for ip, successor in leaving:
+                condition = _condition(successor, since)
+                conditions.append(condition)
+                exits.setdefault(ip, []).append((iteration, condition, successor))
+            left[iteration] = z3.Or(*conditions)
+        if len(back) != 1:
+            if len(back) > 1 and iteration == 0:
+                return None
+            break
+        current, = back
+    else:
+        back = [current]
+
+    return [_fold(state, states, left) for states in exits.values()] + back
@@ -1,7 +1,22 @@
+import hashlib
 from copy import copy
-from z3 import simplify, is_bv, BitVecVal, BitVecNumRef
+from z3 import simplify, is_bv, is_bv_value, BitVecNumRef
 
 from .code import Register
+from .constants import BYTE_VALUES
+
+MEMORY_SIZE = 0x10000
+PAGE_SIZE = 0x100 # must be a power of two
+PAGE_SHIFT = PAGE_SIZE.bit_length() - 1
+PAGE_MASK = PAGE_SIZE - 1
+
+
+class SymbolicAddressError(ValueError):
+    """
+    Raised when memory is indexed with a symbolic address it can't resolve
+    """
+    pass
+
 
 class Memory:
     """
@@ -9,33 +24,96 @@ class Memory:
 
     Bytes coming out of this might be BitVecs or numbers in [0, 255]
 
-    Hopefully will implement a Copy-on-Write interface in the future,
-    where memory is old references until it needs to be changed,
-    at which point it copies off.
+    Concrete bytes live in a table of PAGE_SIZE-byte bytearray pages, and
+    only symbolic bytes are kept as z3 expressions, in a sparse overlay
+    keyed by address. Clones share all their pages and the overlay, and a
+    write only copies the page (or the overlay) it touches, the first time
+    that Memory writes to it.
+
+    Indexing with a single address gives a BitVec. Slices give plain ints
+    for concrete bytes and BitVecs for symbolic ones.
+
+    A single symbolic address raises SymbolicAddressError, unless addresses
+    is set to an AddressResolver (see addresses.py), which resolves it on
+    path, the path of the State this Memory belongs to.
     """
     def __init__(self, data):
         """
         data is a list of values to initalize this memory with.
         Can be bytes or BitVecs of length 8.
         """
-        self.data = data
-        # Is data a reference to one out of another Memory?
-        self.__needs_copying = False
+        concrete = bytearray(MEMORY_SIZE)
+        self._symbolic = {}
+        self._owns_symbolic = True
+        if isinstance(data, (bytes, bytearray)):
+            concrete[:len(data)] = data
+        else:
+            for addr, value in enumerate(data):
+                value = self._concrete_byte(value)
+                if isinstance(value, int):
+                    concrete[addr] = value
+                else:
+                    self._symbolic[addr] = value
+
+        self._pages = [concrete[base : base + PAGE_SIZE] \
+                for base in range(0, MEMORY_SIZE, PAGE_SIZE)]
+        # indices of the pages this Memory may write in place.
+        # Every other page might be shared with a clone.
+        self._owned_pages = set(range(len(self._pages)))
+        self.addresses = None
+        self.path = None
 
     def clone(self):
         """
         Return a copy of this memory state
 
-        NOTE: May not actually be a full copy, but a reference with
-        copy-on-write flags set.
+        NOTE: May not actually be a full copy, pages are shared between
+        clones until one of them writes to it.
         """
-        other = Memory(self.data)
-        other.__needs_copying = True
-        self.__needs_copying = True
+        other = Memory.__new__(Memory)
+        other._pages = copy(self._pages)
+        other._owned_pages = set()
+        other._symbolic = self._symbolic
+        other._owns_symbolic = False
+        self._owned_pages = set()
+        self._owns_symbolic = False
+        other.addresses = self.addresses
+        other.path = None
 
         return other
 
-    def _concretize(self, value):
+    def _visible_pages(self):
+        """
+        The pages, with the (stale) bytes under symbolic ones zeroed
+        """
+        masked = {}
+        for addr in self._symbolic:
+            page_number = addr >> PAGE_SHIFT
+            if page_number not in masked:
+                masked[page_number] = bytearray(self._pages[page_number])
+            masked[page_number][addr & PAGE_MASK] = 0
+        return [masked.get(page_number, page) \
+                for page_number, page in enumerate(self._pages)]
+
+    def content_hash(self):
+        """
+        A digest of the contents of memory, equal for Memories holding the
+        same bytes (whether or not they share pages). Symbolic bytes go in by
+        their addresses and AST ids, which stay valid as long as someone
+        keeps those expressions alive.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for page in self._visible_pages():
+            digest.update(page)
+        for addr, value in sorted(self._symbolic.items()):
+            digest.update(b'%d:%d,' % (addr, value.get_id()))
+        return digest.digest()
+
+    def _concretize(self, value, symbolic_ok=False):
+        """
+        value as an int (or a slice of ints). A symbolic value is returned
+        as is (simplified) if symbolic_ok, and raises otherwise.
+        """
         if isinstance(value, slice):
             # for now, just concretize each of the values
             # We could probably get a lot of milage out of doing a search on
@@ -46,34 +124,92 @@ class Memory:
             step = self._concretize(value.step)
             value = slice(start, stop, step)
         if is_bv(value): # try to simplify and deal with BV's that come in...
-            value = simplify(value)
+            if not is_bv_value(value):
+                value = simplify(value)
             if isinstance(value, BitVecNumRef):
                 value = value.as_long() # if this succeeds, we had a single value! yay
-            else:
-                # symbolic accesses are hard!!
-                # TODO: deal with symbolic values
-                raise ValueError('UH OH, THAT WAS A SYMBOLIC VARIABLE YOU TRIED TO INDEX MEMORY WITH D:')
+            elif not symbolic_ok:
+                raise SymbolicAddressError( \
+                        'symbolic address {} (see addresses.py)'.format(value))
+
+        return value
 
+    @staticmethod
+    def _concrete_byte(value):
+        """
+        Turn value into an int if it is a concrete byte, otherwise return the
+        (unchanged) symbolic value
+        """
+        if isinstance(value, int):
+            return value & 0xff
+        if is_bv_value(value):
+            return value.as_long()
+        concrete = simplify(value)
+        if is_bv_value(concrete):
+            return concrete.as_long()
+        # keep the original expression, callers may rely on its identity
         return value
 
+    def _writable_page(self, page_number):
+        """
+        Get a page that is safe to write to, copying it if it may be shared
+        """
+        if page_number not in self._owned_pages:
+            self._pages[page_number] = copy(self._pages[page_number])
+            self._owned_pages.add(page_number)
+        return self._pages[page_number]
+
+    def _writable_symbolic(self):
+        """
+        Get a symbolic overlay that is safe to write to
+        """
+        if not self._owns_symbolic:
+            self._symbolic = copy(self._symbolic)
+            self._owns_symbolic = True
+        return self._symbolic
+
+    def _read(self, addr):
+        """
+        Read one byte, as an int if it is concrete
+        """
+        if addr in self._symbolic:
+            return self._symbolic[addr]
+        return self._pages[addr >> PAGE_SHIFT][addr & PAGE_MASK]
 
     def __getitem__(self, key):
-        key = self._concretize(key)
-        return self.data[key]
+        key = self._concretize(key, symbolic_ok=self.addresses is not None)
+        if isinstance(key, slice):
+            return [self._read(addr) for addr in range(*key.indices(MEMORY_SIZE))]
+        if not isinstance(key, int):
+            return self.addresses.read(self, key)
+        value = self._read(key)
+        if isinstance(value, int):
+            return BYTE_VALUES[value]
+        return value
 
     def __setitem__(self, key, value):
-        if self.__needs_copying:
-            self.data = copy(self.data)
-            self.__needs_copying = False
-        key = self._concretize(key)
-        self.data[key] = value
+        key = self._concretize(key, symbolic_ok=self.addresses is not None)
+        if isinstance(key, slice):
+            for addr, v in zip(range(*key.indices(MEMORY_SIZE)), value):
+                self[addr] = v
+            return
+        if not isinstance(key, int):
+            self.addresses.write(self, key, value)
+            return
+        value = self._concrete_byte(value)
+        if isinstance(value, int):
+            if key in self._symbolic:
+                del self._writable_symbolic()[key]
+            self._writable_page(key >> PAGE_SHIFT)[key & PAGE_MASK] = value
+        else:
+            self._writable_symbolic()[key] = value
 
 
 def parse_mc_memory_dump(dump):
     """
     Pares a microcorruption memory dump, returns a Memory with that data
     """
-    memory = [0 for _ in range(0, 0xffff+1)] # memory, initialized to 0's
+    memory = bytearray(0xffff+1) # memory, initialized to 0's
     lines = dump.split('\n')
     for line in lines:
         line = line.strip()
@@ -84,8 +220,6 @@ def parse_mc_memory_dump(dump):
         else:
             data = ''.join(data)
             d = bytes.fromhex(data)
-            for i,b in enumerate(d):
-                memory[line_address + i] = b
+            memory[line_address : line_address + len(d)] = d
 
-    # BVVs for all the values in memory
-    return Memory([BitVecVal(x, 8) for x in memory])
+    return Memory(memory)
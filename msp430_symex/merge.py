@@ -0,0 +1,141 @@
+"""
+Merging states that meet at control flow join points.
+
+After a conditional jump, both successors often end up at the same place a
+few instructions later (e.g. after an if/else). Exploring them separately
+doubles the work from there on, and a loop full of branches does it again
+on every iteration.
+
+Two states at the same join point, with the same stack pointer (so the same
+call depth), the same inputs read so far and as much output written, can be
+merged into one: values that differ become If(condition, a, b), where
+condition picks the first state's part of the path, and the merged path is
+the part both paths share plus Or(a's conditions, b's conditions).
+
+Join points come from the CFG: basic blocks that can be entered from more
+than one place.
+"""
+import z3
+
+from .code import Register, Opcode, AddressingMode
+from .cfg import CFG
+from .memory import BYTE_VALUES, PAGE_SHIFT
+
+
+_conditional_jumps = {Opcode.JNZ, Opcode.JZ, Opcode.JNC, Opcode.JC, \
+        Opcode.JN, Opcode.JGE, Opcode.JL}
+
+
+def _falls_through(bb):
+    """
+    Whether execution can run off the end of basic block bb into the next one
+    """
+    if not bb.instructions:
+        return False
+    insn = bb.instructions[-1]
+    if insn.opcode in (Opcode.JMP, Opcode.RETI):
+        return False
+    is_ret = insn.opcode == Opcode.MOV and \
+            insn.source_addressing_mode == AddressingMode.AUTOINCREMENT and \
+            insn.source_register == Register.R1 and \
+            insn.dest_register == Register.R0
+    # conditional jumps have their fall through edge in outgoing_edges already
+    return not is_ret and insn.opcode not in _conditional_jumps
+
+
+def join_points(memory, entry_point):
+    """
+    Build the CFG of the program in memory starting at entry_point, and
+    return the set of addresses of the basic blocks that have more than one
+    predecessor
+    """
+    cfg = CFG(memory)
+    cfg.generate_all_functions(entry_point)
+
+    points = set()
+    for function in cfg.functions:
+        ends = {bb.end_address: bb for bb in function.basic_blocks}
+        for bb in function.basic_blocks:
+            predecessors = set(bb.incoming_edges)
+            before = ends.get(bb.start_address)
+            if before is not None and _falls_through(before):
+                predecessors.add(before.start_address)
+            if len(predecessors) > 1:
+                points.add(bb.start_address)
+    return frozenset(points)
+
+
+def _same(a, b):
+    if z3.is_expr(a) and z3.is_expr(b):
+        return a.eq(b)
+    return a is b or a == b
+
+
+def mergeable(a, b):
+    """
+    Whether states a and b (at the same ip) can be merged
+    """
+    if a.unlocked != b.unlocked or a.cpu.lazy_flags != b.cpu.lazy_flags:
+        return False
+    if not a.path.diverges_from(b.path):
+        return False
+    if not _same(z3.simplify(a.cpu.registers[Register.R1]), \
+            z3.simplify(b.cpu.registers[Register.R1])):
+        return False
+    # the inputs are variables, so both have to have read the same ones
+    if len(a.sym_input.data) != len(b.sym_input.data) or \
+            [len(g) for g in a.sym_input.grouped_inputs] != \
+            [len(g) for g in b.sym_input.grouped_inputs]:
+        return False
+    if not all(_same(x, y) for x, y in zip(a.sym_input.data, b.sym_input.data)):
+        return False
+    return len(a.sym_output.data) == len(b.sym_output.data)
+
+
+def _merge_memory(a, b, choose):
+    memory = a.clone()
+    for page_number, (page, b_page) in enumerate(zip(a._pages, b._pages)):
+        if page is b_page or page == b_page:
+            continue
+        base = page_number << PAGE_SHIFT
+        for offset, (value, b_value) in enumerate(zip(page, b_page)):
+            # the page bytes under a symbolic byte are stale, those are
+            # merged below
+            if value != b_value and base + offset not in a._symbolic and \
+                    base + offset not in b._symbolic:
+                memory[base + offset] = \
+                        choose(BYTE_VALUES[value], BYTE_VALUES[b_value])
+    for addr in set(a._symbolic) | set(b._symbolic):
+        value, b_value = a[addr], b[addr]
+        if not _same(value, b_value):
+            memory[addr] = choose(value, b_value)
+    return memory
+
+
+def merge_states(a, b):
+    """
+    Merge states a and b (which must be mergeable) into a new state
+    """
+    path, condition = a.path.merge(b.path)
+
+    def choose(value, b_value):
+        if _same(value, b_value):
+            return value
+        value, b_value = z3.simplify(value), z3.simplify(b_value)
+        if _same(value, b_value):
+            return value
+        return z3.If(condition, value, b_value)
+
+    cpu = a.cpu.clone()
+    for i in range(16):
+        cpu.registers[Register(i)] = \
+                choose(a.cpu.registers[Register(i)], b.cpu.registers[Register(i)])
+
+    memory = _merge_memory(a.memory, b.memory, choose)
+
+    sym_output = a.sym_output.clone()
+    sym_output.data = [choose(value, b_value) for value, b_value in \
+            zip(a.sym_output.data, b.sym_output.data)]
+
+    return a.__class__(cpu, memory, path, a.sym_input.clone(), sym_output, \
+            a.unlocked, min(a.ticks, b.ticks))
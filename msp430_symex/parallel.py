@@ -0,0 +1,204 @@
+"""
+Exploring a PathGroup with a pool of worker processes.
+
+Each step, ParallelPathGroup takes a batch of active states per worker,
+serializes them (see serialize.py) and hands them to a process pool. Every
+worker steps its batch for a while in its own PathGroup, and sends back what
+came out of it: the states that are still active, the ones that got
+unlocked, and which of them have a symbolic ip.
+
+Workers search and merge the way the parent does: their PathGroups get the
+parent's merge points, and a copy of its strategy (without the queued
+states, see strategy.py).
+"""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+
+from .memory import Memory
+from .state import PathGroup, start_path_group
+from .serialize import serialize_state, deserialize_state
+
+
+# per-process state of a worker, set by _init_worker
+_worker_base_memory = None
+_worker_avoid = None
+_worker_dead_ends = None
+_worker_live_flags = None
+_worker_merge_points = None
+_worker_strategy = None
+
+
+def _init_worker(base_image, avoid, dead_ends, live_flags, merge_points, \
+        strategy):
+    global _worker_base_memory, _worker_avoid, _worker_dead_ends, \
+            _worker_live_flags, _worker_merge_points, _worker_strategy
+    _worker_base_memory = Memory(base_image)
+    _worker_avoid = avoid
+    _worker_dead_ends = dead_ends
+    _worker_live_flags = live_flags
+    _worker_merge_points = merge_points
+    _worker_strategy = strategy
+
+
+def _deserialize(serialized, base_memory, live_flags):
+    """
+    deserialize_state, with the flag liveness table (which isn't serialized)
+    put back
+    """
+    state = deserialize_state(serialized, base_memory)
+    state.cpu.live_flags = live_flags
+    return state
+
+
+def _step_batch(serialized_states, steps, enable_unsound_optimizations):
+    """
+    Step a batch of states up to :steps: times, in a worker process
+
+    Returns (active, symbolic, unlocked, n_unsat, ticks, merges), where
+    symbolic is indices into active. States still waiting at a merge point
+    are sent back as active, for the parent to merge with the rest.
+    """
+    states = [_deserialize(s, _worker_base_memory, _worker_live_flags) \
+            for s in serialized_states]
+    pg = PathGroup(states, avoid=_worker_avoid, strategy=_worker_strategy, \
+            merge_points=_worker_merge_points, dead_ends=_worker_dead_ends)
+
+    for _ in range(steps):
+        # stop when there's something the parent needs to look at
+        if not pg.active or pg.unlocked or pg.symbolic:
+            break
+        pg.step(enable_unsound_optimizations=enable_unsound_optimizations)
+
+    active = list(pg.active)
+    for waiting in pg.waiting.values():
+        active.extend(waiting)
+    symbolic = [i for i, state in enumerate(active) if state in pg.symbolic]
+    serialize = lambda st: serialize_state(st, _worker_base_memory)
+    return [serialize(st) for st in active], symbolic, \
+            [serialize(st) for st in pg.unlocked], len(pg.unsat), \
+            pg.tick_count, pg.merge_count
+
+
+class ParallelPathGroup(PathGroup):
+    """
+    A PathGroup that steps its states in a pool of worker processes.
+
+    Every call to step() sends up to :batch_size: states to each of the
+    :workers: processes, and each worker steps its batch up to :steps: times
+    (stopping early when it unlocks or finds a symbolic ip).
+
+    Unsat states are dropped in the workers, so self.unsat stays empty and
+    self.unsat_count counts them instead.
+
+    Call close() (or use this as a context manager) to shut the pool down.
+    """
+    def __init__(self, active, avoid=None, strategy=None, workers=None, \
+            batch_size=4, steps=64, base_memory=None, dedupe=False, \
+            merge_points=None, max_resident=None, spill_dir=None, \
+            dead_ends=None):
+        active = list(active)
+        super().__init__(active, avoid=avoid, strategy=strategy, \
+                dedupe=dedupe, merge_points=merge_points, \
+                max_resident=max_resident, spill_dir=spill_dir, \
+                dead_ends=dead_ends)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.batch_size = batch_size
+        self.steps = steps
+
+        if base_memory is None and active:
+            base_memory = active[0].memory
+        # a clone that nothing writes to, for taking memory deltas against.
+        # A group made by load() starts out empty, and uses the checkpoint's.
+        self._base_memory = None
+        if base_memory is not None:
+            self._base_memory = base_memory.clone()
+        # the flag liveness table the states were started with, given to
+        # every state that comes back from a worker
+        self._live_flags = active[0].cpu.live_flags if active else None
+        self._pool = None
+
+    def _get_pool(self):
+        if self._base_memory is None:
+            self._base_memory = self._checkpoint_base.clone()
+            self._live_flags = self._checkpoint_live_flags
+        if self._pool is None:
+            base_image = bytearray().join(self._base_memory._pages)
+            self._pool = ProcessPoolExecutor(self.workers, \
+                    mp_context=multiprocessing.get_context('spawn'), \
+                    initializer=_init_worker, \
+                    initargs=(base_image, self.avoid, self.dead_ends, \
+                        self._live_flags, self.merge_points, self.strategy))
+        return self._pool
+
+    def close(self):
+        """
+        Shut down the worker processes
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def step(self, enable_unsound_optimizations=True):
+        pool = self._get_pool()
+
+        batches = [[] for _ in range(self.workers)]
+        n_states = min(len(self.active), self.workers * self.batch_size)
+        for i in range(n_states):
+            state = self.select_next_state()
+            batches[i % self.workers].append( \
+                    serialize_state(state, self._base_memory))
+
+        futures = [pool.submit(_step_batch, batch, self.steps, \
+                enable_unsound_optimizations) for batch in batches if batch]
+
+        successors = set()
+        for future in futures:
+            active, symbolic, unlocked, n_unsat, ticks, merges = \
+                    future.result()
+            active = [_deserialize(s, self._base_memory, self._live_flags) \
+                    for s in active]
+            successors.update(active)
+            self.symbolic.update(active[i] for i in symbolic)
+            self.unlocked.update(_deserialize(s, self._base_memory, \
+                    self._live_flags) for s in unlocked)
+            self.unsat_count += n_unsat
+            self.tick_count += ticks
+            self.merge_count += merges
+
+        self.active.update(successors)
+        if self.dedupe:
+            successors = self.deduplicate(successors)
+        if self.merge_points:
+            successors = self.merge(successors)
+        self.recently_added = successors
+        self.strategy.add(successors)
+        self.load_pending()
+        self.balance_resident()
+
+
+def start_parallel_path_group(memory_dump, start_ip, avoid=None, \
+        lazy_flags=False, strategy=None, dedupe=False, merge=False, \
+        concrete=True, directed=False, auto_avoid=False, summaries=False, \
+        loops=False, symbolic_memory=False, **kwargs):
+    """
+    Like start_path_group, but returns a ParallelPathGroup.
+
+    Extra keyword arguments (workers, batch_size, steps, max_resident,
+    spill_dir) are passed on to ParallelPathGroup.
+    """
+    pg = start_path_group(memory_dump, start_ip, avoid=avoid, \
+            lazy_flags=lazy_flags, strategy=strategy, merge=merge, \
+            concrete=concrete, directed=directed, auto_avoid=auto_avoid, \
+            summaries=summaries, loops=loops, symbolic_memory=symbolic_memory)
+    return ParallelPathGroup(pg.active, avoid=pg.avoid, strategy=pg.strategy, \
+            dedupe=dedupe, merge_points=pg.merge_points, \
+            dead_ends=pg.dead_ends, **kwargs)
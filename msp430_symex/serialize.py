@@ -0,0 +1,333 @@
+"""
+Turning States into plain python data and back, so they can be shipped to
+other processes (or written to disk).
+
+z3 expressions don't pickle, so every expression in a state (registers,
+symbolic memory, path conditions, IO bytes) goes into one SMT-LIB2 script,
+as an assertion binding a fresh constant to it. The rest of the state
+refers to those expressions by index. Concrete bitvectors are common and
+cheap, so they are stored as plain (value, size) pairs instead.
+
+The path is stored as its (simplified) predicate rather than the list of
+conditions, which is all a deserialized state needs to keep checking it.
+
+Memory is stored as a delta against a base Memory (normally the memory image
+the PathGroup started from): only pages that differ from the base, plus the
+symbolic overlay. Deserializing with the same base gets the full memory back.
+
+A checkpoint file (see PathGroup.save) is a stream of pickles: a header dict,
+then one record per state, so it can be read back a state at a time.
+
+A SpillFile holds the states a PathGroup has too many of to keep in memory
+(see PathGroup's max_resident), in the same form.
+"""
+import heapq
+import os
+import pickle
+import tempfile
+from itertools import count
+
+import z3
+
+from .addresses import AddressResolver
+from .code import Register
+from .cpu import CPU, RegisterFile
+from .memory import Memory
+from .symio import IO, IOKind
+from .state import Path, State
+from .summaries import SUMMARIES
+
+
+class _ExpressionTable:
+    """
+    Collects expressions while serializing, and gives out their indices
+    """
+    def __init__(self):
+        self.exprs = []
+        self._indices = {} # id(expr) -> index, so shared exprs are stored once
+
+    def add(self, expr):
+        """
+        Add expr, and return a reference to it for the serialized state
+        """
+        if isinstance(expr, bool):
+            expr = z3.BoolVal(expr)
+        elif z3.is_bv_value(expr):
+            return (expr.as_long(), expr.size())
+        key = id(expr)
+        if key not in self._indices:
+            self._indices[key] = len(self.exprs)
+            self.exprs.append(expr)
+        return self._indices[key]
+
+    def to_smt2(self):
+        # one assertion binding all of them, so subexpressions shared between
+        # expressions are only printed once
+        bindings = []
+        for i, expr in enumerate(self.exprs):
+            name = 'ser!{}'.format(i)
+            if z3.is_bool(expr):
+                bindings.append(z3.Bool(name) == expr)
+            else:
+                bindings.append(z3.Const(name, expr.sort()) == expr)
+        solver = z3.Solver()
+        solver.add(z3.And(*bindings))
+        return solver.sexpr()
+
+
+def expressions_to_smt2(exprs):
+    """
+    Serialize a list of z3 expressions to an SMT-LIB2 string
+    """
+    table = _ExpressionTable()
+    for expr in exprs:
+        table.add(expr)
+    return table.to_smt2()
+
+
+def expressions_from_smt2(smt2):
+    """
+    Parse a string from expressions_to_smt2 back into a list of expressions
+    """
+    def index(expr):
+        if z3.is_const(expr) and expr.decl().name().startswith('ser!'):
+            return int(expr.decl().name()[4:])
+        return None
+
+    exprs = {}
+    for assertion in z3.parse_smt2_string(smt2):
+        bindings = assertion.children() if z3.is_and(assertion) else [assertion]
+        for binding in bindings:
+            # z3 may print the equality either way around
+            lhs, rhs = binding.arg(0), binding.arg(1)
+            if index(lhs) is not None:
+                exprs[index(lhs)] = rhs
+            else:
+                exprs[index(rhs)] = lhs
+    return [exprs[i] for i in range(len(exprs))]
+
+
+def _resolve(ref, exprs):
+    """
+    Turn a reference from _ExpressionTable.add back into an expression
+    """
+    if isinstance(ref, tuple):
+        return z3.BitVecVal(*ref)
+    return exprs[ref]
+
+
+def _serialize_io(io, table):
+    data_indices = {}
+    data = []
+    for i, value in enumerate(io.data):
+        data_indices[id(value)] = i
+        data.append(table.add(value))
+    # grouped inputs are runs of bytes from data
+    grouped = [[data_indices[id(value)] for value in group] \
+            for group in io.grouped_inputs]
+    return {'data': data, 'grouped': grouped}
+
+
+def _deserialize_io(kind, serialized, exprs):
+    data = [_resolve(ref, exprs) for ref in serialized['data']]
+    io = IO(kind, data)
+    io.grouped_inputs = [[data[i] for i in group] \
+            for group in serialized['grouped']]
+    return io
+
+
+def serialize_state(state, base_memory):
+    """
+    Turn state into a dict of plain python data (that can be pickled)
+
+    base_memory is the Memory the memory delta is taken against
+    """
+    table = _ExpressionTable()
+
+    registers = [table.add(state.cpu.registers[Register(i)]) for i in range(16)]
+
+    memory = state.memory
+    pages = {}
+    for page_number, page in enumerate(memory._pages):
+        base_page = base_memory._pages[page_number]
+        if page is not base_page and page != base_page:
+            pages[page_number] = bytes(page)
+    symbolic = {addr: table.add(value) for addr, value in memory._symbolic.items()}
+
+    path = table.add(state.path.pred())
+
+    serialized = {
+        'registers': registers,
+        'lazy_flags': state.cpu.lazy_flags,
+        'concrete': state.cpu.concrete,
+        'summaries': {address: summary.__name__ \
+                for address, summary in state.cpu.summaries.items()},
+        'loops': state.cpu.loops,
+        'addresses': memory.addresses.settings() \
+                if memory.addresses is not None else None,
+        'pages': pages,
+        'symbolic': symbolic,
+        'path': path,
+        'input': _serialize_io(state.sym_input, table),
+        'output': _serialize_io(state.sym_output, table),
+        'unlocked': state.unlocked,
+        'ticks': state.ticks,
+    }
+    # last, so every expression is in the table
+    serialized['exprs'] = table.to_smt2()
+    return serialized
+
+
+def deserialize_state(serialized, base_memory):
+    """
+    Rebuild a State from serialize_state's output, using the same base_memory
+    """
+    exprs = expressions_from_smt2(serialized['exprs'])
+
+    registers = RegisterFile({Register(i): _resolve(ref, exprs) \
+            for i, ref in enumerate(serialized['registers'])})
+    cpu = CPU(registers, lazy_flags=serialized['lazy_flags'], \
+            concrete=serialized['concrete'], \
+            summaries={address: SUMMARIES[name] \
+                for address, name in serialized.get('summaries', {}).items()}, \
+            loops=serialized.get('loops'))
+
+    memory = base_memory.clone()
+    for page_number, page in serialized['pages'].items():
+        memory._pages[page_number] = bytearray(page)
+        memory._owned_pages.add(page_number)
+    if serialized['symbolic']:
+        memory._symbolic = {addr: _resolve(ref, exprs) \
+                for addr, ref in serialized['symbolic'].items()}
+        memory._owns_symbolic = True
+    addresses = serialized.get('addresses')
+    memory.addresses = AddressResolver(**addresses) \
+            if addresses is not None else None
+
+    path = Path([_resolve(serialized['path'], exprs)])
+
+    sym_input = _deserialize_io(IOKind.INPUT, serialized['input'], exprs)
+    sym_output = _deserialize_io(IOKind.OUTPUT, serialized['output'], exprs)
+
+    return State(cpu, memory, path, sym_input, sym_output, \
+            serialized['unlocked'], serialized['ticks'])
+
+
+CHECKPOINT_VERSION = 1
+
+
+def write_checkpoint(path, header, records):
+    """
+    Write header and then each record in records to the file at path.
+
+    The file is written next to path and then moved over it, so path always
+    holds a complete checkpoint, even if this gets interrupted.
+    """
+    header = dict(header, version=CHECKPOINT_VERSION)
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        for record in records:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path):
+    """
+    Read a file written by write_checkpoint.
+
+    Returns (header, records), where records is an iterator that reads the
+    records from the file one at a time
+    """
+    f = open(path, 'rb')
+    try:
+        header = pickle.load(f)
+        if header.get('version') != CHECKPOINT_VERSION:
+            raise ValueError('{} is not a version {} checkpoint'.format( \
+                    path, CHECKPOINT_VERSION))
+    except Exception:
+        f.close()
+        raise
+
+    def records():
+        with f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+    return header, records()
+
+
+class SpillFile:
+    """
+    States written out to an append-only temporary file, to be read back
+    lowest rank first.
+
+    Only the rank and file offset of each state is kept in memory. The file
+    is truncated whenever it's emptied, and deleted by close(). States are
+    stored against the memory image of the first state spilled.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.base = None
+        self.live_flags = None
+        self._file = None
+        self._heap = [] # (rank, seq, offset)
+        self._seq = count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, state, rank):
+        """
+        Write state to the file, to be read back by rank
+        """
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='msp430_symex_spill', \
+                    dir=self.directory)
+        if self.base is None:
+            self.base = Memory(bytearray().join(state.memory._pages))
+            self.live_flags = state.cpu.live_flags
+
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        pickle.dump(serialize_state(state, self.base), self._file, \
+                protocol=pickle.HIGHEST_PROTOCOL)
+        heapq.heappush(self._heap, (rank, next(self._seq), offset))
+
+    def best_rank(self):
+        """
+        The lowest rank of the states in here (None if there aren't any)
+        """
+        return self._heap[0][0] if self._heap else None
+
+    def _read(self, offset):
+        self._file.seek(offset)
+        state = deserialize_state(pickle.load(self._file), self.base)
+        state.cpu.live_flags = self.live_flags
+        return state
+
+    def pop(self):
+        """
+        Read back (and forget) the state with the lowest rank
+        """
+        _, _, offset = heapq.heappop(self._heap)
+        state = self._read(offset)
+        if not self._heap:
+            self._file.seek(0)
+            self._file.truncate()
+        return state
+
+    def states(self):
+        """
+        Read back every state in here, one at a time, without forgetting them
+        """
+        for _, _, offset in sorted(self._heap):
+            yield self._read(offset)
+
+    def close(self):
+        self._heap = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,363 @@
+"""
+Solver sessions for path predicates.
+
+A SolverSession wraps a single incremental z3 solver that is shared by a whole
+lineage of Paths. Instead of building a fresh solver and re-asserting the
+entire predicate on every check, the session keeps the conditions of the last
+path it checked on its assertion stack, pops back to the longest prefix the
+next path shares with it, and only asserts what is new.
+
+Before going to the solver at all, a session looks the query up in its
+CounterexampleCache, which remembers the results of earlier queries by the
+set of constraints in them.
+
+Paths don't send all their conditions to the session, only the ones that can
+affect the result: ConstraintGroups splits a path's conditions into groups
+that share no symbolic variables, and a group that was sat stays sat until a
+condition touching its variables gets added.
+"""
+from collections import deque
+
+import z3
+
+
+def constraint_id(condition):
+    """
+    An id for a constraint. z3 shares structurally equal expressions, so
+    equal constraints get equal ids (for as long as someone keeps them alive).
+    """
+    return condition.get_id()
+
+
+def free_variables(condition, memo=None):
+    """
+    The ids of the symbolic variables (uninterpreted constants) in condition
+
+    :memo: maps ast ids to their variables. Passing the same dict in again
+    skips the parts of the expression that were already seen, but the caller
+    has to keep the expressions alive for their ids to stay valid.
+    """
+    if isinstance(condition, bool):
+        return frozenset()
+    if memo is None:
+        memo = {}
+
+    # straight to the C API, wrapping every subexpression is too slow
+    ctx = condition.ctx_ref()
+    todo = [condition.as_ast()]
+    while todo:
+        ast = todo[-1]
+        ast_id = z3.Z3_get_ast_id(ctx, ast)
+        if ast_id in memo:
+            todo.pop()
+            continue
+        if z3.Z3_get_ast_kind(ctx, ast) != z3.Z3_APP_AST:
+            memo[ast_id] = frozenset()
+            todo.pop()
+            continue
+
+        n_args = z3.Z3_get_app_num_args(ctx, ast)
+        if n_args == 0:
+            decl = z3.Z3_get_app_decl(ctx, ast)
+            if z3.Z3_get_decl_kind(ctx, decl) == z3.Z3_OP_UNINTERPRETED:
+                memo[ast_id] = frozenset((ast_id,))
+            else:
+                memo[ast_id] = frozenset()
+            todo.pop()
+            continue
+
+        args = [z3.Z3_get_app_arg(ctx, ast, i) for i in range(n_args)]
+        arg_ids = [z3.Z3_get_ast_id(ctx, arg) for arg in args]
+        pending = [arg for arg, arg_id in zip(args, arg_ids) if arg_id not in memo]
+        if pending:
+            todo.extend(pending)
+            continue
+        todo.pop()
+        memo[ast_id] = frozenset().union(*(memo[arg_id] for arg_id in arg_ids))
+
+    return memo[z3.Z3_get_ast_id(ctx, condition.as_ast())]
+
+
+class ConstraintGroups:
+    """
+    An incremental union-find over the conditions of a path: conditions that
+    share a symbolic variable (directly or through other conditions) end up
+    in the same group, and groups are independent of each other.
+
+    A group is a (variables, indices) tuple, where indices are positions of
+    conditions in the path. Groups are never modified, only replaced, so
+    copy() only has to copy the dict that maps variables to their group.
+    """
+    def __init__(self):
+        self._groups = {} # variable id -> group containing it
+        self.n_conditions = 0 # how many conditions of the path have been added
+
+    def copy(self):
+        new_groups = ConstraintGroups()
+        new_groups._groups = dict(self._groups)
+        new_groups.n_conditions = self.n_conditions
+        return new_groups
+
+    def add(self, variables):
+        """
+        Add the next condition of the path, which mentions :variables:
+        """
+        index = self.n_conditions
+        self.n_conditions += 1
+        if not variables:
+            return
+
+        merged = {id(group): group for group in \
+                (self._groups.get(variable) for variable in variables) \
+                if group is not None}
+        all_variables = set(variables)
+        indices = [index]
+        for group_variables, group_indices in merged.values():
+            all_variables |= group_variables
+            indices.extend(group_indices)
+        if len(merged) > 1:
+            indices.sort()
+        else:
+            # still in path order, the new condition is always the last one
+            indices.append(indices.pop(0))
+
+        group = (frozenset(all_variables), tuple(indices))
+        for variable in all_variables:
+            self._groups[variable] = group
+
+    def groups_of(self, variables):
+        """
+        The distinct groups containing any of :variables:
+        """
+        groups = {}
+        for variable in variables:
+            group = self._groups[variable]
+            groups[id(group)] = group
+        return list(groups.values())
+
+
+class CounterexampleCache:
+    """
+    Results of earlier solver queries, stored as sets of constraint ids.
+
+    - If a set of constraints known to be unsat is a subset of a query, the
+      query is unsat too. Unsat sets are indexed by one of their constraints,
+      so only sets sharing a constraint with the query get looked at.
+    - If a set of constraints known to be sat is a superset of a query, or
+      one of the recent models satisfies the query, the query is sat.
+
+    Constraints are kept alive while their ids are in here, so an id can't
+    be reused for a different constraint. Once there are more than
+    max_constraints of them, or more than max_unsat unsat sets, the session
+    clears the cache (see clear).
+    """
+    def __init__(self, max_models=16, max_evaluations=8, \
+            max_constraints=1 << 16, max_unsat=1 << 14):
+        self._exprs = {} # id -> constraint, keeps the ids valid
+        self._unsat = {} # id -> unsat sets indexed under that id
+        self._n_unsat = 0
+        self.max_constraints = max_constraints
+        self.max_unsat = max_unsat
+        self._sat = deque(maxlen=max_models) # (ids, model) of recent sat queries
+        self.max_evaluations = max_evaluations
+        self.hits = 0
+        self.misses = 0
+
+    def ids(self, conditions):
+        """
+        The set of constraint ids for conditions, remembering the conditions
+        """
+        ids = set()
+        for condition in conditions:
+            i = constraint_id(condition)
+            self._exprs.setdefault(i, condition)
+            ids.add(i)
+        return frozenset(ids)
+
+    def full(self):
+        return len(self._exprs) > self.max_constraints or \
+                self._n_unsat > self.max_unsat
+
+    def clear(self, keep=()):
+        """
+        Forget everything, except the constraints in keep (the ones a
+        session still has asserted, whose ids it holds on to)
+        """
+        self._exprs = {}
+        self._unsat = {}
+        self._n_unsat = 0
+        self._sat.clear()
+        self.ids(keep)
+
+    def _lookup_unsat(self, ids):
+        for i in ids:
+            for unsat_ids in self._unsat.get(i, ()):
+                if unsat_ids <= ids:
+                    return True
+        return False
+
+    def _lookup_sat(self, ids):
+        candidates = []
+        for known_ids, model in self._sat:
+            missing = ids - known_ids
+            if not missing:
+                return model
+            if len(missing) <= self.max_evaluations:
+                candidates.append((len(missing), missing, model))
+
+        # try the models that have the fewest constraints left to check
+        candidates.sort(key=lambda candidate: candidate[0])
+        for _, missing, model in candidates:
+            if all(z3.is_true(model.eval(self._exprs[i], model_completion=True)) \
+                    for i in missing):
+                self._sat.append((ids, model))
+                return model
+        return None
+
+    def lookup(self, ids):
+        """
+        A model if this set of constraint ids is known to be sat, False if it
+        is known to be unsat, and None if it isn't known
+        """
+        if self._lookup_unsat(ids):
+            self.hits += 1
+            return False
+        model = self._lookup_sat(ids)
+        if model is not None:
+            self.hits += 1
+            return model
+        self.misses += 1
+        return None
+
+    def add_unsat(self, ids):
+        if ids:
+            self._unsat.setdefault(max(ids), []).append(ids)
+            self._n_unsat += 1
+
+    def add_sat(self, ids, model):
+        self._sat.append((ids, model))
+
+
+class SolverSession:
+    """
+    An incremental solver shared between related paths.
+
+    The assertion stack is a list of scopes. Each scope holds the conditions
+    that were pushed by a single check() call, so a check only ever pops whole
+    scopes and pushes at most one new scope.
+
+    The session also remembers the variables of every condition it was asked
+    about (see variables). Those, and the conditions holding their ids, are
+    dropped along with the cache once it is full, or once the memo has more
+    than max_memo expressions in it.
+    """
+    def __init__(self, cache=None, max_memo=1 << 18):
+        self.solver = z3.Solver()
+        self._scopes = [] # lists of conditions, one per solver.push()
+        self._scope_ids = [] # ids of all conditions up to and including each scope
+        if cache is None:
+            cache = CounterexampleCache()
+        self.cache = cache
+        self._variables = {} # memo for free_variables
+        self._conditions = [] # keeps the memo's ids valid
+        self.max_memo = max_memo
+
+    def _common_scopes(self, conditions):
+        """
+        Return (n_scopes, n_conditions): how many of the current scopes are
+        entirely a prefix of :conditions:, and how many conditions they hold.
+        """
+        n_conditions = 0
+        for n_scopes, scope in enumerate(self._scopes):
+            end = n_conditions + len(scope)
+            if end > len(conditions):
+                return n_scopes, n_conditions
+            # Paths share their condition objects until one of them adds
+            # something, so identity is enough to detect a common prefix
+            for asserted, condition in zip(scope, conditions[n_conditions:end]):
+                if asserted is not condition:
+                    return n_scopes, n_conditions
+            n_conditions = end
+        return len(self._scopes), n_conditions
+
+    def check(self, conditions):
+        """
+        Check whether the conjunction of :conditions: is satisfiable.
+        """
+        return self.solve(conditions) is not None
+
+    def solve(self, conditions):
+        """
+        Return a model for the conjunction of :conditions:, or None if it is
+        unsat.
+        """
+        for condition in conditions:
+            if condition is False:
+                return None
+        conditions = [c for c in conditions if c is not True]
+
+        n_scopes, n_conditions = self._common_scopes(conditions)
+
+        if n_scopes < len(self._scopes):
+            self.solver.pop(len(self._scopes) - n_scopes)
+            del self._scopes[n_scopes:]
+            del self._scope_ids[n_scopes:]
+
+        # keep the assertion stack following the queries even when the
+        # cache answers them, so the next query only has a little to add
+        new_conditions = conditions[n_conditions:]
+        if self.cache.full():
+            self._clear()
+        ids = self._scope_ids[-1] if self._scope_ids else frozenset()
+        if new_conditions:
+            ids = ids | self.cache.ids(new_conditions)
+            self.solver.push()
+            self.solver.add(*new_conditions)
+            self._scopes.append(new_conditions)
+            self._scope_ids.append(ids)
+
+        result = self.cache.lookup(ids)
+        if result is not None:
+            return None if result is False else result
+
+        if self.solver.check() == z3.sat:
+            model = self.solver.model()
+            self.cache.add_sat(ids, model)
+            return model
+        self.cache.add_unsat(ids)
+        return None
+
+    def variables(self, condition):
+        """
+        The symbolic variables in condition (see free_variables), remembering
+        them for the rest of the session
+        """
+        if isinstance(condition, bool):
+            return frozenset()
+        condition_id = condition.get_id()
+        if condition_id not in self._variables:
+            if len(self._variables) > self.max_memo:
+                self._clear()
+            self._conditions.append(condition)
+            free_variables(condition, self._variables)
+        return self._variables[condition_id]
+
+    def _clear(self):
+        """
+        Empty the cache and the variables memo, keeping only the conditions
+        still asserted: the ids of the open scopes have to stay valid
+        """
+        keep = [c for scope in self._scopes for c in scope]
+        self.cache.clear(keep)
+        self._variables = {}
+        self._conditions = keep
+        for condition in keep:
+            free_variables(condition, self._variables)
+
+    def reset(self):
+        """
+        Drop everything asserted in this session
+        """
+        self.solver.reset()
+        self._scopes = []
+        self._scope_ids = []
@@ -1,11 +1,57 @@
 from copy import copy
 import random
+import weakref
 import z3
 
 from .code import decode_instruction, Opcode, AddressingMode, Register
 from .memory import Memory, parse_mc_memory_dump
 from .cpu import CPU
 from .symio import IO, IOKind
+from .solver import SolverSession, ConstraintGroups, constraint_id
+from .strategy import TickStrategy, DirectedStrategy, state_ip
+from .liveness import flag_liveness
+from .merge import join_points, mergeable, merge_states
+from .directed import target_distances, dead_ends
+from .concrete import step_concrete, run_block, BlockCache
+from .summaries import SUMMARIES, find_summaries
+from .loops import find_loops, summarize_loop
+from .addresses import AddressResolver
+
+# how many fingerprints dedupe remembers, before it forgets them all
+MAX_SEEN = 1 << 14
+
+
+def _ids_alive(state):
+    """
+    The expressions whose ids are in state's fingerprint and path constraint
+    ids (other than the registers, whose _ExpressionKeys hold on to theirs),
+    to keep those ids from being reused once the state is gone
+    """
+    return (tuple(state.path._path), tuple(state.memory._symbolic.values()), \
+            tuple(state.sym_input.data), tuple(state.sym_output.data))
+
+
+class _ExpressionKey:
+    """
+    Stands in for a register value in fingerprints: equal for structurally
+    equal expressions once simplified (registers pick up chains like
+    ip + 2 + 4), and keeps the simplified expression alive so its id stays
+    valid.
+    """
+    __slots__ = ('expr', 'id')
+
+    def __init__(self, expr):
+        if not z3.is_bv_value(expr):
+            expr = z3.simplify(expr)
+        self.expr = expr
+        self.id = expr.get_id()
+
+    def __hash__(self):
+        return self.id
+
+    def __eq__(self, other):
+        return isinstance(other, _ExpressionKey) and self.id == other.id
+
 
 class Path:
     """
@@ -16,15 +62,34 @@ class Path:
     Call .pred() to get a predicate suitable for Z3
 
     Call .clone() to get a copy-on-write version of the path
+
+    All clones of a path share a SolverSession, so checking a child path only
+    asserts the conditions it added on top of what was last checked. And only
+    the conditions that share variables with what was added since the path
+    was last sat get checked at all.
     """
-    def __init__(self, paths=None):
+    def __init__(self, paths=None, session=None):
         if paths is None:
             self._path = []
         else:
             self._path = paths
+        if session is None:
+            session = SolverSession()
         self.__needs_copying = False
-        self.model = None
+        self._model = None
         self._model_cache = {}
+        self._pred = None # simplified conjunction of self._path[:self._pred_len]
+        self._pred_len = 0
+        self._session = session
+        self._groups = ConstraintGroups()
+        self._groups_need_copying = False
+        self._sat_len = 0 # self._path[:self._sat_len] is known to be sat
+        # a model satisfying self._path[:self._witness_len]. Not the same as
+        # self._model, which is what inputs get dumped from
+        self._witness = None
+        self._witness_len = 0
+        self._constraint_ids = frozenset()
+        self._constraint_ids_len = 0
         self.sat = None # unknown
 
     def add(self, condition):
@@ -35,7 +100,7 @@ class Path:
             self._path = copy(self._path)
             self.__needs_copying = False
         self._path.append(condition)
-        self.model = None
+        self._model = None
         self.sat = None
 
     def make_unsat(self):
@@ -43,56 +108,250 @@ class Path:
         Helper function to make this state unsat
         """
         self.add(False)
+        self.sat = False # no need to ask the solver
 
     def pred(self):
         """
         Get the predicate for this path, suitable to throw at Z3
         """
         # Cache the predicate, as testing has found this gives
-        # a 3-4x improvement to execution speed
-        pred = z3.And(*self._path)
-        # simplifying here makes things a bit (~5-10%) faster...
-        # strange that Z3 doesn't do that internally
-        pred = z3.simplify(pred)
-        self._path = [pred]
-        self.__needs_copying = False
-        return pred
+        # a 3-4x improvement to execution speed. Only the conditions added
+        # since the last call need to be folded in.
+        if self._pred is None or self._pred_len < len(self._path):
+            conditions = self._path[self._pred_len:]
+            if self._pred is not None:
+                conditions = [self._pred] + conditions
+            # simplifying here makes things a bit (~5-10%) faster...
+            # strange that Z3 doesn't do that internally
+            self._pred = z3.simplify(z3.And(*conditions))
+            self._pred_len = len(self._path)
+        return self._pred
 
     def is_sat(self):
         # if we've cached whether we're sat, just return that
         if self.sat is not None:
             return self.sat
+        # the model we inherited usually satisfies whatever got added since
+        if self._witness_holds():
+            # keep folding the predicate as we go, so our children don't all
+            # have to fold the same long list of conditions later
+            self.pred()
+            self.sat = True
+            return True
         # if we're in the global cache, use that
         if self.pred() in self._model_cache:
-            self.sat, self.model = self._model_cache[self.pred()]
+            self.sat, self._model = self._model_cache[self.pred()]
+            if self.sat:
+                self._sat_len = len(self._path)
             return self.sat
-        solver = z3.Solver()
-        solver.add(self.pred())
-        is_sat = solver.check() == z3.sat
-        self.sat = is_sat
-        if is_sat:
-            self.model = solver.model()
+
+        self.sat = self._check_groups()
 
         # Save sat results back to global cache
-        self._model_cache[self.pred()] = (self.sat, self.model)
+        self._model_cache[self.pred()] = (self.sat, self._model)
 
-        return is_sat
+        return self.sat
+
+    def _witness_holds(self):
+        """
+        Check whether the witness model satisfies the conditions it hasn't
+        seen yet, without going to the solver
+        """
+        if self._witness is None:
+            return False
+        for condition in self._path[self._witness_len:]:
+            if condition is True:
+                continue
+            if condition is False or not z3.is_true( \
+                    self._witness.eval(condition, model_completion=True)):
+                return False
+        self._witness_len = self._sat_len = len(self._path)
+        return True
+
+    def _update_witness(self, variables, models):
+        """
+        Make a new witness out of the old one, with the values of :variables:
+        taken from :models: instead
+        """
+        witness = z3.Model()
+        if self._witness is not None:
+            for decl in self._witness.decls():
+                if decl.arity() == 0 and decl().get_id() not in variables:
+                    witness.update_value(decl, self._witness[decl])
+        for model in models:
+            for decl in model.decls():
+                if decl.arity() == 0 and decl().get_id() in variables:
+                    witness.update_value(decl, model[decl])
+        self._witness = witness
+        self._witness_len = len(self._path)
+
+    def _check_groups(self):
+        """
+        Check the groups of conditions (see ConstraintGroups) that were
+        touched since this path was last known to be sat; the rest are
+        still sat.
+        """
+        path = self._path
+        first = min(self._sat_len, self._groups.n_conditions)
+        if self._groups_need_copying and self._groups.n_conditions < len(path):
+            self._groups = self._groups.copy()
+            self._groups_need_copying = False
+
+        touched = set()
+        for index in range(first, len(path)):
+            condition = path[index]
+            if condition is False:
+                return False
+            variables = self._session.variables(condition)
+            if index >= self._groups.n_conditions:
+                self._groups.add(variables)
+            if index >= self._sat_len:
+                if variables:
+                    touched |= variables
+                elif not self._session.check([condition]):
+                    return False
+
+        models = []
+        variables = set()
+        for group_variables, indices in self._groups.groups_of(touched):
+            model = self._session.solve([path[i] for i in indices])
+            if model is None:
+                return False
+            models.append(model)
+            variables |= group_variables
+
+        # groups don't share variables, so the old witness still holds for
+        # the untouched ones, as long as it covered everything before
+        if self._witness_len == self._sat_len:
+            self._update_witness(variables, models)
+        self._sat_len = len(path)
+        return True
+
+    @property
+    def model(self):
+        """
+        A model for this path, or None if it is unsat.
+
+        Models come from a fresh solver over pred() rather than the shared
+        session, so they don't depend on which paths the session happened to
+        check before this one.
+        """
+        if self._model is None and self.is_sat():
+            solver = z3.Solver()
+            solver.add(self.pred())
+            solver.check()
+            self._model = solver.model()
+            self._model_cache[self.pred()] = (self.sat, self._model)
+        return self._model
 
     def clone(self):
-        new_path = Path(self._path)
+        new_path = Path(self._path, session=self._session)
         new_path.__needs_copying = True
         self.__needs_copying = True
         # pass along our model so sat checks quick-exit as long as nothing is added
-        new_path.model = self.model
+        new_path._model = self._model
         new_path.sat = self.sat
+        new_path._pred = self._pred
+        new_path._pred_len = self._pred_len
+        new_path._groups = self._groups
+        new_path._groups_need_copying = True
+        self._groups_need_copying = True
+        new_path._sat_len = self._sat_len
+        new_path._witness = self._witness
+        new_path._witness_len = self._witness_len
+        new_path._constraint_ids = self._constraint_ids
+        new_path._constraint_ids_len = self._constraint_ids_len
 
         new_path._model_cache = self._model_cache # NOT A COPY -- GLOBAL CACHE
         return new_path
 
+    def _common_length(self, other):
+        n_common = 0
+        for mine, theirs in zip(self._path, other._path):
+            if mine is not theirs:
+                break
+            n_common += 1
+        return n_common
+
+    def diverges_from(self, other):
+        """
+        Whether both this path and :other: have conditions past the ones they
+        share (i.e. they split at some branch, rather than one of them
+        carrying on from the other)
+        """
+        n_common = self._common_length(other)
+        return n_common < len(self._path) and n_common < len(other._path)
+
+    def merge(self, other):
+        """
+        Return (path, condition): a path that holds whenever this path or
+        :other: does, and a condition over the inputs that holds on this
+        path but not on :other: (for picking between the two paths' values).
+
+        Both paths must be sat. The conditions they share are kept as they
+        are, and the rest is Or'ed together.
+        """
+        n_common = self._common_length(other)
+        condition = z3.simplify(z3.And(self._path[n_common:]))
+        other_condition = z3.simplify(z3.And(other._path[n_common:]))
+        path = Path(self._path[:n_common] + \
+                [z3.Or(condition, other_condition)], session=self._session)
+        path._model_cache = self._model_cache
+        path.sat = True
+        return path, condition
+
+    def constraint_ids(self):
+        """
+        The set of ids of the conditions on this path (see
+        solver.constraint_id). A path whose set contains another's is at
+        least as constrained.
+
+        The ids stay valid for as long as this path is alive.
+        """
+        if self._constraint_ids_len < len(self._path):
+            new_ids = (condition if isinstance(condition, bool) \
+                    else constraint_id(condition) \
+                    for condition in self._path[self._constraint_ids_len:])
+            self._constraint_ids = self._constraint_ids.union(new_ids)
+            self._constraint_ids_len = len(self._path)
+        return self._constraint_ids
+
     def __repr__(self):
         return 'Path({})'.format(self._path)
 
 
+# the CPU method that runs each opcode
+_step_functions = {
+    Opcode.RRC: 'step_rrc',
+    Opcode.SWPB: 'step_swpb',
+    Opcode.RRA: 'step_rra',
+    Opcode.SXT: 'step_sxt',
+    Opcode.PUSH: 'step_push',
+    Opcode.CALL: 'step_call',
+    Opcode.RETI: 'step_reti',
+    Opcode.JNZ: 'step_jnz',
+    Opcode.JZ: 'step_jz',
+    Opcode.JNC: 'step_jnc',
+    Opcode.JC: 'step_jc',
+    Opcode.JN: 'step_jn',
+    Opcode.JGE: 'step_jge',
+    Opcode.JL: 'step_jl',
+    Opcode.JMP: 'step_jmp',
+    Opcode.MOV: 'step_mov',
+    Opcode.ADD: 'step_add',
+    Opcode.ADDC: 'step_addc',
+    Opcode.SUBC: 'step_subc',
+    Opcode.SUB: 'step_sub',
+    Opcode.CMP: 'step_cmp',
+    Opcode.DADD: 'step_dadd',
+    Opcode.BIT: 'step_bit',
+    Opcode.BIC: 'step_bic',
+    Opcode.BIS: 'step_bis',
+    Opcode.XOR: 'step_xor',
+    Opcode.AND: 'step_and',
+}
+
+
 class State:
     """
     Entire encapsulation of the current state of the machine (register, memory),
@@ -102,20 +361,56 @@ class State:
         self.cpu = cpu
         self.memory = memory
         self.path = path
+        # symbolic addresses are resolved on this state's path
+        memory.path = path
         self.sym_input = sym_input
         self.sym_output = sym_output
         self.unlocked = unlocked
         self.ticks = ticks
 
-    def step(self, enable_unsound_optimizations=True):
+    def step(self, enable_unsound_optimizations=True, blocks=None, \
+            summarize=True):
         """
         Tick the cpu forward one instruction.
 
+        If the cpu runs concrete instructions on ints and blocks (a
+        concrete.BlockCache) is given, the whole basic block from here is run
+        at once, as far as it is concrete.
+
+        If the cpu has a summary of the function starting here (see
+        summaries.py), the whole function is run at once instead, if the
+        summary can be used. Likewise, at the head of one of the cpu's loops,
+        the whole loop is run (see loops.py). summarize=False turns both off.
+
         Returns a list of successor states.
         """
-        instruction_pointer = self.cpu.registers[Register.R0]
-        if z3.is_bv(instruction_pointer):
-            instruction_pointer = z3.simplify(instruction_pointer).as_long()
+        instruction_pointer = self.cpu.registers.concrete(Register.R0)
+        if instruction_pointer is None:
+            instruction_pointer = \
+                    z3.simplify(self.cpu.registers[Register.R0]).as_long()
+
+        if summarize:
+            summary = self.cpu.summaries.get(instruction_pointer)
+            if summary is not None:
+                successors = summary(self)
+                if successors is not None:
+                    return successors
+            end = self.cpu.loops.get(instruction_pointer)
+            if end is not None:
+                successors = summarize_loop(self, end, \
+                        enable_unsound_optimizations=enable_unsound_optimizations, \
+                        blocks=blocks)
+                if successors is not None:
+                    return successors
+
+        if self.cpu.concrete and blocks is not None:
+            block = blocks.get(self.memory, instruction_pointer)
+            if block is not None:
+                successor = run_block(self, block, \
+                        enable_unsound_optimizations=enable_unsound_optimizations)
+                if successor is not None:
+                    return [successor]
+
 # pull enough to encode any instruction
         raw_instruction = \
                 self.memory[instruction_pointer : instruction_pointer + 6]
@@ -123,37 +418,15 @@ class State:
                 decode_instruction(instruction_pointer, raw_instruction)
         #print(instruction, instruction_length)
 
-        step_functions = {
-            Opcode.RRC: self.cpu.step_rrc,
-            Opcode.SWPB: self.cpu.step_swpb,
-            Opcode.RRA: self.cpu.step_rra,
-            Opcode.SXT: self.cpu.step_sxt,
-            Opcode.PUSH: self.cpu.step_push,
-            Opcode.CALL: self.cpu.step_call,
-            Opcode.RETI: self.cpu.step_reti,
-            Opcode.JNZ: self.cpu.step_jnz,
-            Opcode.JZ: self.cpu.step_jz,
-            Opcode.JNC: self.cpu.step_jnc,
-            Opcode.JC: self.cpu.step_jc,
-            Opcode.JN: self.cpu.step_jn,
-            Opcode.JGE: self.cpu.step_jge,
-            Opcode.JL: self.cpu.step_jl,
-            Opcode.JMP: self.cpu.step_jmp,
-            Opcode.MOV: self.cpu.step_mov,
-            Opcode.ADD: self.cpu.step_add,
-            Opcode.ADDC: self.cpu.step_addc,
-            Opcode.SUBC: self.cpu.step_subc,
-            Opcode.SUB: self.cpu.step_sub,
-            Opcode.CMP: self.cpu.step_cmp,
-            Opcode.DADD: self.cpu.step_dadd,
-            Opcode.BIT: self.cpu.step_bit,
-            Opcode.BIC: self.cpu.step_bic,
-            Opcode.BIS: self.cpu.step_bis,
-            Opcode.XOR: self.cpu.step_xor,
-            Opcode.AND: self.cpu.step_and,
-        }
-        self.cpu.registers[Register.R0] += instruction_length # preincrement ip
-        instruction_fn = step_functions[instruction.opcode]
+        if self.cpu.concrete and blocks is None:
+            successor = step_concrete(self, instruction, instruction_length, \
+                    enable_unsound_optimizations=enable_unsound_optimizations)
+            if successor is not None:
+                return [successor]
+
+        # preincrement ip
+        self.cpu.registers[Register.R0] = instruction_pointer + instruction_length
+        instruction_fn = getattr(self.cpu, _step_functions[instruction.opcode])
         successor_states = instruction_fn(self, instruction, \
                 enable_unsound_optimizations=enable_unsound_optimizations)
         return successor_states
@@ -161,7 +434,28 @@ class State:
     def clone(self):
          return self.__class__(self.cpu.clone(), self.memory.clone(), self.path.clone(), self.sym_input.clone(), self.sym_output.clone(), self.unlocked, self.ticks+1)
 
+    def fingerprint(self):
+        """
+        A hashable summary of everything about this state except its path:
+        registers, memory, IO and whether it's unlocked. States with the same
+        fingerprint run the same from here on, for inputs satisfying both of
+        their paths.
+        """
+        # everything but the registers is used as is, and kept alive by the
+        # state itself
+        registers = tuple(_ExpressionKey(self.cpu.registers[Register(i)]) \
+                for i in range(16))
+        symbolic = tuple(sorted((addr, constraint_id(value)) \
+                for addr, value in self.memory._symbolic.items()))
+        io = tuple(tuple(constraint_id(value) for value in io.data) \
+                for io in (self.sym_input, self.sym_output))
+        groups = tuple(len(group) for group in self.sym_input.grouped_inputs)
+        return (registers, self.memory.content_hash(), symbolic, io, groups, \
+                self.unlocked)
+
     def has_symbolic_ip(self):
+        if self.cpu.registers.concrete(Register.R0) is not None:
+            return False
         ip = self.cpu.registers[Register.R0]
         return z3.is_bv(ip) and not isinstance(z3.simplify(ip), z3.BitVecNumRef)
 
@@ -195,16 +489,78 @@ class State:
 
 
 class PathGroup:
-    def __init__(self, active, avoid=None):
+    """
+    The states being explored, sorted by what happened to them.
+
+    With dedupe set, a new state is dropped when it has the same fingerprint
+    as a state seen before and at least the same path conditions (it can't
+    do anything the other one couldn't), and a state that is less
+    constrained than an active one with the same fingerprint replaces it.
+    What's remembered of a state seen is its fingerprint, its path condition
+    ids and the expressions those ids belong to, but not the state itself
+    (its memory is only in there as a digest). Past MAX_SEEN fingerprints,
+    the lot is forgotten and dedupe starts over.
+
+    merge_points is a set of addresses (see merge.join_points). A state
+    arriving at one of them waits there (in self.waiting, not self.active)
+    for the other states to catch up, and is merged with the ones it can be
+    merged with (see merge.py). Once every state is waiting, they're all
+    released again.
+
+    save() writes a checkpoint of the whole group to a file, and load()
+    resumes from one. A loaded group only reads states from the file as it
+    needs them (see load_pending).
+
+    States arriving at an address in avoid or dead_ends (see
+    directed.dead_ends) are made unsat straight away.
+
+    With max_resident set, at most about that many active states are kept in
+    memory. Past it, the ones the strategy would step last are written out
+    to a temporary file (self.spilled, in spill_dir) and read back in as the
+    active states run low (see balance_resident).
+    """
+    def __init__(self, active, avoid=None, strategy=None, dedupe=False, \
+            merge_points=None, max_resident=None, spill_dir=None, dead_ends=None):
+        active = list(active)
         self.active = set(active)
         self.unlocked = set() # states with the lock unlocked
         self.unsat = set()
         self.symbolic = set() # paths with symbolic control data
         self.recently_added = set()
         self.tick_count = 0
+        self.unsat_count = 0 # unsat states that aren't kept in self.unsat
         if isinstance(avoid, int):
             avoid = (avoid,) # wrap int avoid in a tuple
         self.avoid = avoid
+        self.dead_ends = frozenset(dead_ends or ())
+        if strategy is None:
+            strategy = TickStrategy()
+        self.strategy = strategy # picks which active state to step next
+        self.strategy.reset(active)
+        self.dedupe = dedupe
+        self.duplicate_count = 0
+        # fingerprint -> [(constraint ids, weakref to the state, the
+        # expressions whose ids are in the fingerprint and constraint ids)]
+        self._seen = {}
+        self.merge_points = merge_points
+        self.merge_count = 0
+        self.waiting = {} # merge point -> states waiting there
+        # states with a concrete CPU run whole blocks per step, but have to
+        # stop where this PathGroup looks at them
+        # (dead ends don't need to stop them, everything after one is dead)
+        self.blocks = BlockCache(set(avoid or ()) | set(merge_points or ()))
+        # records of states in a checkpoint that haven't been loaded yet
+        self.pending = None
+        self.pending_batch = 64
+        self._checkpoint_base = None # the Memory they're deltas against
+        self._checkpoint_live_flags = None
+        self.max_resident = max_resident
+        self.spilled = None
+        if max_resident is not None:
+            from .serialize import SpillFile
+            self.spilled = SpillFile(spill_dir)
+        if dedupe:
+            self.deduplicate(active)
 
     def prune(self):
         """
@@ -234,42 +590,259 @@ class PathGroup:
         self.unlocked.update(unlocked_states)
         self.symbolic.update(symbolic_states)
 
+    def deduplicate(self, states):
+        """
+        Drop the states that are subsumed by a state seen before from the
+        active set, and return the rest
+        """
+        kept = set()
+        for state in states:
+            ids = state.path.constraint_ids()
+            if len(self._seen) >= MAX_SEEN:
+                self._seen.clear()
+            seen = self._seen.setdefault(state.fingerprint(), [])
+            if any(seen_ids <= ids for seen_ids, _, _ in seen):
+                self.active.discard(state)
+                self.duplicate_count += 1
+                continue
+
+            for seen_ids, ref, _ in seen:
+                other = ref()
+                if ids <= seen_ids and other in self.active:
+                    self.active.discard(other)
+                    self.duplicate_count += 1
+            seen[:] = [entry for entry in seen if not ids <= entry[0]]
+            seen.append((ids, weakref.ref(state), _ids_alive(state)))
+            kept.add(state)
+        return kept
+
+    def merge(self, states):
+        """
+        Take the states that are at a merge point out of the active set, and
+        merge each with a waiting state at the same point if it can be. When
+        there are no active states left, the waiting ones are released.
+
+        Returns the states that should stay (or become) active.
+        """
+        active = set()
+        for state in states:
+            ip = state_ip(state)
+            if ip not in self.merge_points:
+                active.add(state)
+                continue
+
+            self.active.discard(state)
+            waiting = self.waiting.setdefault(ip, [])
+            for other in list(waiting):
+                if mergeable(other, state):
+                    waiting.remove(other)
+                    state = merge_states(other, state)
+                    self.merge_count += 1
+            waiting.append(state)
+
+        if not self.active and self.waiting:
+            for waiting in self.waiting.values():
+                active.update(waiting)
+            self.waiting = {}
+            self.active.update(active)
+        return active
+
     def select_next_state(self):
         """
         Select the next state to simulate from the active group, removing it
         from that group
         """
-        # TODO: more effective strategies?
-        if len(self.active) > 64:
-            choice = max(self.active, key=lambda st: st.ticks)
-        else:
-            choice = min(self.active, key=lambda st: st.ticks)
+        choice = self.strategy.select(self.active)
         self.active.discard(choice)
         return choice
 
     def step(self, enable_unsound_optimizations=True):
         path_to_sim = self.select_next_state()
-        successors = set(path_to_sim.step(enable_unsound_optimizations=enable_unsound_optimizations))
+        successors = set(path_to_sim.step( \
+                enable_unsound_optimizations=enable_unsound_optimizations, \
+                blocks=self.blocks))
         self.active.update(successors)
         self.recently_added = successors
         self.tick_count += 1
 
-        for state in successors:
-            # make states at an avoid_addr unsat
-            # TODO: maybe check recent states?
-            if self.avoid:
-                def simplify(v):
-                    if z3.is_bv(v):
-                        v = z3.simplify(v).as_long()
-                    return v
-                try:
-                    ip = simplify(state.cpu.registers[Register.R0])
-                    if ip in self.avoid:
-                        state.path.make_unsat()
-                except AttributeError:
-                    pass # symbolic ip!! Ignore for now...
+        if self.avoid or self.dead_ends:
+            # make states at an avoid_addr or a dead end unsat
+            for state in successors:
+                ip = state_ip(state)
+                if ip is None:
+                    continue # symbolic ip!! Ignore for now...
+                if (ip in self.dead_ends and not state.unlocked) or \
+                        (self.avoid and ip in self.avoid):
+                    state.path.make_unsat()
 
         self.prune() # prune unsat successors
+        successors &= self.active
+        if self.dedupe:
+            successors = self.deduplicate(successors)
+        if self.merge_points:
+            successors = self.merge(successors)
+        self.strategy.add(successors)
+        self.load_pending()
+        self.balance_resident()
+
+    def balance_resident(self):
+        """
+        Once there are more than max_resident active states, spill the ones
+        the strategy ranks last to self.spilled until a quarter of the budget
+        is free again. Once there are only a quarter of it left, read the best
+        ranked spilled states back in until half of it is used.
+
+        States with a symbolic ip are never spilled, they're in self.symbolic
+        too.
+        """
+        if self.max_resident is None:
+            return
+
+        if len(self.active) > self.max_resident:
+            keep = self.max_resident - self.max_resident // 4
+            candidates = [st for st in self.active if st not in self.symbolic]
+            ranks = {st: self.strategy.rank(st, self.active) for st in candidates}
+            candidates.sort(key=ranks.__getitem__)
+            spill = candidates[max(len(candidates) - (len(self.active) - keep), 0):]
+            for state in spill:
+                self.spilled.add(state, ranks[state])
+                self.active.discard(state)
+            # the strategy's queues would keep the spilled states alive
+            self.strategy.reset(self.active)
+
+        elif len(self.active) <= self.max_resident // 4 and self.spilled:
+            loaded = set()
+            while self.spilled and \
+                    len(self.active) < max(self.max_resident // 2, 1):
+                state = self.spilled.pop()
+                self.active.add(state)
+                loaded.add(state)
+            self.strategy.add(loaded)
+
+    def save(self, path):
+        """
+        Write a checkpoint of this PathGroup to the file at path: every
+        active (or waiting or spilled), unlocked and symbolic state, how many
+        states were unsat, and the counters. Unsat states themselves aren't
+        saved, and neither is what dedupe has seen.
+
+        States are stored with serialize_state, as memory deltas against
+        one base memory image that's stored once. Records are written one at
+        a time as they're made, and the ones that haven't been loaded yet are
+        read back from the new checkpoint afterwards, so neither spilled nor
+        pending states are all held in memory at once.
+        """
+        from .serialize import serialize_state, write_checkpoint, \
+                read_checkpoint
+
+        active = set(self.active)
+        for waiting in self.waiting.values():
+            active.update(waiting)
+        states = list(self.unlocked) + list(self.symbolic - self.unlocked) + \
+                list(active - self.unlocked - self.symbolic)
+
+        spilled = self.spilled if self.spilled else ()
+        base = self._checkpoint_base
+        if base is None and not states and spilled:
+            base = spilled.base
+        if base is None:
+            image = bytearray().join(states[0].memory._pages) if states else b''
+            base = Memory(image)
+
+        # records that haven't been loaded yet are written out as they are,
+        # after n_loaded of the others
+        n_loaded = 0
+
+        def records():
+            nonlocal n_loaded
+            for state in states:
+                groups = [name for name, group in (('active', active), \
+                        ('unlocked', self.unlocked), ('symbolic', self.symbolic)) \
+                        if state in group]
+                yield groups, serialize_state(state, base)
+                n_loaded += 1
+            if spilled:
+                for state in spilled.states():
+                    yield ['active'], serialize_state(state, base)
+                    n_loaded += 1
+            if self.pending is not None:
+                yield from self.pending
+
+        header = {
+            'base': bytes(bytearray().join(base._pages)),
+            'live_flags': next((st.cpu.live_flags for st in states), \
+                    spilled.live_flags if spilled else self._checkpoint_live_flags),
+            'avoid': self.avoid,
+            'dead_ends': self.dead_ends,
+            'merge_points': self.merge_points,
+            'tick_count': self.tick_count,
+            'unsat_count': len(self.unsat) + self.unsat_count,
+            'duplicate_count': self.duplicate_count,
+            'merge_count': self.merge_count,
+        }
+        write_checkpoint(path, header, records())
+
+        if self.pending is not None:
+            # the file they were being read from may just have been replaced
+            _, self.pending = read_checkpoint(path)
+            for _ in range(n_loaded):
+                next(self.pending)
+
+    @classmethod
+    def load(cls, path, strategy=None, dedupe=False, batch_size=64, **kwargs):
+        """
+        Resume from a checkpoint written by save().
+
+        The unlocked states are loaded right away, and then active states up
+        to batch_size of them. The rest are only read from the file as the
+        active states run out.
+
+        Extra keyword arguments are passed on to the constructor.
+        """
+        from .serialize import read_checkpoint
+
+        header, records = read_checkpoint(path)
+        pg = cls([], avoid=header['avoid'], strategy=strategy, dedupe=dedupe, \
+                merge_points=header['merge_points'], \
+                dead_ends=header.get('dead_ends'), **kwargs)
+        pg.tick_count = header['tick_count']
+        pg.unsat_count = header['unsat_count']
+        pg.duplicate_count = header['duplicate_count']
+        pg.merge_count = header['merge_count']
+
+        pg.pending = records
+        pg.pending_batch = batch_size
+        pg._checkpoint_base = Memory(header['base'])
+        pg._checkpoint_live_flags = header['live_flags']
+        pg.load_pending()
+        return pg
+
+    def load_pending(self):
+        """
+        Load states from the checkpoint this PathGroup was loaded from, until
+        there are pending_batch active states (or none left to load)
+        """
+        if self.pending is None:
+            return
+        from .serialize import deserialize_state
+
+        loaded = set()
+        while len(self.active) < self.pending_batch:
+            record = next(self.pending, None)
+            if record is None:
+                self.pending = None
+                break
+            groups, serialized = record
+            state = deserialize_state(serialized, self._checkpoint_base)
+            state.cpu.live_flags = self._checkpoint_live_flags
+            if 'active' in groups:
+                self.active.add(state)
+                loaded.add(state)
+            if 'unlocked' in groups:
+                self.unlocked.add(state)
+            if 'symbolic' in groups:
+                self.symbolic.add(state)
+        self.strategy.add(loaded)
 
     def step_until_symbolic_ip(self, enable_unsound_optimizations=True, debug_print=False):
         while self.active and not self.symbolic:
@@ -302,31 +875,93 @@ class PathGroup:
 
 
 
-def start_path_group(memory_dump, start_ip, avoid=None):
+def start_path_group(memory_dump, start_ip, avoid=None, lazy_flags=False, \
+        strategy=None, analyze_flags=True, dedupe=False, merge=False, \
+        concrete=True, max_resident=None, spill_dir=None, directed=False, \
+        auto_avoid=False, summaries=False, loops=False, symbolic_memory=False):
     """
     Parse a memory dump, construct a base state, and return a PathGroup.
+
+    If lazy_flags is set, arithmetic instructions keep their flags symbolic
+    in SR instead of forking on every flag combination.
+
+    strategy is a search strategy from msp430_symex.strategy, deciding which
+    state to step next (by default, a TickStrategy).
+
+    If analyze_flags is set, the program's flag liveness is worked out up
+    front, so instructions only compute the flags that are read later.
+
+    If dedupe is set, states that are subsumed by one seen before are dropped
+    (see PathGroup).
+
+    If merge is set, states that meet where control flow joins are merged
+    (see merge.py).
+
+    If concrete is set, instructions that only touch concrete values are run
+    on plain ints (see concrete.py), and only the rest build z3 expressions.
+
+    If max_resident is set, active states past that many are spilled to a
+    temporary file in spill_dir (see PathGroup).
+
+    If directed is set (and no strategy is given), the states closest in the
+    CFG to unlocking the door or to returning from a function that read input
+    are stepped first (see directed.py).
+
+    If auto_avoid is set, states are dropped as soon as they get somewhere
+    that can't lead to either (see directed.dead_ends), on top of avoid.
+
+    If summaries is set, library routines (puts, getsn, strcpy, memset) are
+    run in one step each where possible (see summaries.py). True finds them
+    by their code, or it can be a dict of function address -> name of the
+    summary in summaries.SUMMARIES.
+
+    If loops is set, loops that scan or compare memory are run in one step
+    each, leaving one state per way out of the loop, however many times
+    round it went (see loops.py).
+
+    If symbolic_memory is set, memory can be read and written at symbolic
+    addresses, instead of raising SymbolicAddressError (see addresses.py).
+    True uses an AddressResolver with its defaults, or it can be an
+    AddressResolver.
     """
     mem = parse_mc_memory_dump(memory_dump)
-    cpu = CPU()
+    if symbolic_memory is True:
+        symbolic_memory = AddressResolver()
+    mem.addresses = symbolic_memory or None
+    live_flags = flag_liveness(mem, start_ip) if analyze_flags else None
+    if summaries is True:
+        summaries = find_summaries(mem, start_ip)
+    elif summaries:
+        summaries = {address: SUMMARIES[name] \
+                for address, name in summaries.items()}
+    cpu = CPU(lazy_flags=lazy_flags, live_flags=live_flags, concrete=concrete, \
+            summaries=summaries or None, \
+            loops=find_loops(mem, start_ip) if loops else None)
     cpu.registers[Register.R0] = z3.BitVecVal(start_ip, 16)
+    if directed and strategy is None:
+        strategy = DirectedStrategy(target_distances(mem, start_ip))
     path = Path()
     inp = IO(IOKind.INPUT, [])
     out = IO(IOKind.OUTPUT, [])
 
 
     entry_state = State(cpu, mem, path, inp, out, False)
-    pg = PathGroup([entry_state], avoid=avoid)
+    merge_points = join_points(mem, start_ip) if merge else None
+    dead = dead_ends(mem, start_ip) if auto_avoid else None
+    pg = PathGroup([entry_state], avoid=avoid, strategy=strategy, \
+            dedupe=dedupe, merge_points=merge_points, \
+            max_resident=max_resident, spill_dir=spill_dir, dead_ends=dead)
     return pg
 
 # shared instance of the backing memory so we don't need to keep building this
 # make sure blank_state returns a clone of it's state so we don't accidentally
 # reuse this instance!!
-__memory_data = [z3.BitVecVal(0, 8) for _ in range(0xFFFF)]
+__memory = Memory([])
 def blank_state():
     cpu = CPU()
-    memory = Memory(__memory_data)
+    memory = __memory.clone()
     path = Path()
     inp = IO(IOKind.INPUT, [])
     out = IO(IOKind.OUTPUT, [])
-    # return a clone because we cache __memory_data
+    # return a clone because we cache __memory
     return State(cpu, memory, path, inp, out, False).clone()
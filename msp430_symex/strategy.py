@@ -0,0 +1,413 @@
+"""
+Search strategies, for picking which active state a PathGroup steps next.
+
+A strategy keeps the states it has been given in priority queues, so picking
+the next state is O(log n) instead of a scan over every active state.
+
+PathGroup.active stays a plain set that anything can remove states from (or
+that prune() rebuilds), so queue entries are deleted lazily: select() just
+skips over entries whose state is no longer active. If the queues run dry
+while there are still active states (e.g. states were added to the active
+set directly), the strategy rebuilds its queues from the active set.
+
+A strategy is pickled without its queues, so a copy of it can be sent to
+the workers of a ParallelPathGroup.
+"""
+from heapq import heappush, heappop, heapify
+from itertools import count
+import random
+
+import z3
+
+from .code import Register
+
+
+def state_ip(state):
+    """
+    The concrete instruction pointer of a state, or None if it is symbolic
+    """
+    ip = state.cpu.registers.concrete(Register.R0)
+    if ip is not None:
+        return ip
+    ip = state.cpu.registers[Register.R0]
+    if z3.is_bv(ip):
+        ip = z3.simplify(ip)
+        if not z3.is_bv_value(ip):
+            return None
+        ip = ip.as_long()
+    return ip
+
+
+class _StateQueue:
+    """
+    A heap of states ordered by a priority, with lazy deletion
+    """
+    def __init__(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, priority, seq, state):
+        # seq is unique, so states themselves never get compared
+        heappush(self._heap, (priority, seq, state))
+
+    def pop(self, active):
+        """
+        Pop the best entry whose state is in :active:,
+        or None if there is none
+        """
+        while self._heap:
+            entry = heappop(self._heap)
+            if entry[2] in active:
+                return entry
+        return None
+
+    def compact(self, active):
+        """
+        Throw away the entries of states that are no longer active
+        """
+        self._heap = [entry for entry in self._heap if entry[2] in active]
+        heapify(self._heap)
+
+
+class SearchStrategy:
+    """
+    Base class for search strategies.
+
+    Subclasses implement priority(state), which returns a key to sort states
+    by. The state with the lowest key is stepped next, ties go to the state
+    that was added first.
+    """
+    def __init__(self):
+        self._queue = _StateQueue()
+        self._seq = count()
+
+    # what's left out when pickling, and rebuilt by reset()
+    _transient = ('_queue', '_seq')
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in self._transient:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._seq = count()
+        self.reset(())
+
+    def priority(self, state):
+        raise NotImplementedError
+
+    def rank(self, state, active):
+        """
+        A key for how soon :state: would be stepped out of :active:, lowest
+        first. PathGroup uses this to pick which states to spill to disk when
+        there are too many. By default, this is just the priority.
+        """
+        return self.priority(state)
+
+    def add(self, states):
+        """
+        Tell the strategy about new active states
+        """
+        for state in states:
+            self._queue.push(self.priority(state), next(self._seq), state)
+
+    def reset(self, states):
+        """
+        Forget every queued state, and start over with :states:
+        """
+        self._queue = _StateQueue()
+        self.add(states)
+
+    def _pop(self, active):
+        """
+        Pop the next (priority, seq, state) entry, rebuilding the queue from
+        :active: if needed. Does not remove the state from :active:
+        """
+        if len(self._queue) > 4 * len(active) + 64:
+            self._queue.compact(active)
+        entry = self._queue.pop(active)
+        if entry is None:
+            self.reset(active)
+            entry = self._queue.pop(active)
+        return entry
+
+    def select(self, active):
+        """
+        Pick the next state to step out of the set :active:
+        """
+        entry = self._pop(active)
+        if entry is None:
+            raise ValueError('No active states to select from')
+        return entry[2]
+
+
+class TickStrategy(SearchStrategy):
+    """
+    The default strategy: step the state that has been stepped the least,
+    unless there are more than :threshold: active states, then step the
+    state that has been stepped the most to cut down on the number of states.
+    """
+    _transient = SearchStrategy._transient + ('_deepest',)
+
+    def __init__(self, threshold=64):
+        super().__init__()
+        self.threshold = threshold
+        self._deepest = _StateQueue()
+
+    def priority(self, state):
+        return state.ticks
+
+    def rank(self, state, active):
+        if len(active) <= self.threshold:
+            return state.ticks
+        return -state.ticks
+
+    def add(self, states):
+        for state in states:
+            seq = next(self._seq)
+            self._queue.push(state.ticks, seq, state)
+            self._deepest.push(-state.ticks, seq, state)
+
+    def reset(self, states):
+        self._deepest = _StateQueue()
+        super().reset(states)
+
+    def select(self, active):
+        if len(active) <= self.threshold:
+            return super().select(active)
+
+        if len(self._deepest) > 4 * len(active) + 64:
+            self._deepest.compact(active)
+        entry = self._deepest.pop(active)
+        if entry is None:
+            self.reset(active)
+            entry = self._deepest.pop(active)
+        if entry is None:
+            raise ValueError('No active states to select from')
+        return entry[2]
+
+
+class DFSStrategy(SearchStrategy):
+    """
+    Depth-first: step the most recently added state
+    """
+    def priority(self, state):
+        return 0
+
+    def rank(self, state, active):
+        return -state.ticks # the newest states are usually the deepest
+
+    def add(self, states):
+        for state in states:
+            seq = next(self._seq)
+            self._queue.push(-seq, seq, state)
+
+
+class BFSStrategy(SearchStrategy):
+    """
+    Breadth-first: step states in the order they were added
+    """
+    def priority(self, state):
+        return 0
+
+    def rank(self, state, active):
+        return state.ticks
+
+
+class RandomStateStrategy(SearchStrategy):
+    """
+    Step an active state picked uniformly at random.
+
+    Pass a seed to get the same order every run.
+    """
+    def __init__(self, seed=None):
+        super().__init__()
+        self.random = random.Random(seed)
+
+    def priority(self, state):
+        return self.random.random()
+
+
+class _ForkNode:
+    """
+    A node of RandomPathStrategy's fork tree: a leaf holds a state, and the
+    rest hold the states that forked off it
+    """
+    __slots__ = ('parent', 'children', 'state', 'depth')
+
+    def __init__(self, parent, state=None):
+        self.parent = parent
+        self.children = []
+        self.state = state
+        self.depth = 0 if parent is None else parent.depth + 1
+
+
+class RandomPathStrategy(SearchStrategy):
+    """
+    Random-path search: walk down the tree of forks from the root, taking a
+    random branch at every fork, and step the state at the end of it.
+
+    A state is picked with probability 1/2 for every fork (of two) on its
+    way down, so states deep in a loop that keeps forking don't crowd out
+    the ones that forked off it early. Branches whose states are all gone
+    are cut off, and the other side of the fork gets their share.
+
+    The states added after a select() are taken to be what the selected
+    state stepped to (as in PathGroup.step). States added any other way,
+    or found in the active set but not in the tree, hang off the root.
+
+    Pass a seed to get the same order every run.
+    """
+    _transient = SearchStrategy._transient + ('_root', '_leaves', '_last')
+
+    def __init__(self, seed=None):
+        super().__init__()
+        self.random = random.Random(seed)
+        self.reset(())
+
+    def priority(self, state):
+        return 0
+
+    def rank(self, state, active):
+        # the deeper a state is, the less likely it is to be picked
+        leaf = self._leaves.get(state)
+        return leaf.depth if leaf is not None else 0
+
+    def add(self, states):
+        parent, self._last = self._last, None
+        states = list(states)
+        if parent is None or parent.state is None:
+            parent = self._root
+        elif len(states) == 1:
+            # no fork, the state just moved on
+            del self._leaves[parent.state]
+            parent.state = states[0]
+            self._leaves[parent.state] = parent
+            return
+        elif states:
+            del self._leaves[parent.state]
+            parent.state = None
+        for state in states:
+            leaf = _ForkNode(parent, state)
+            parent.children.append(leaf)
+            self._leaves[state] = leaf
+
+    def reset(self, states):
+        self._root = _ForkNode(None)
+        self._leaves = {} # state -> its leaf
+        self._last = None
+        self.add(states)
+
+    def _cut(self, node):
+        """
+        Take node out of the tree, and the forks it leaves empty
+        """
+        if node.state is not None:
+            self._leaves.pop(node.state, None)
+            node.state = None
+        while node.parent is not None and not node.children:
+            node.parent.children.remove(node)
+            node = node.parent
+
+    def select(self, active):
+        if len(self._leaves) > 4 * len(active) + 64:
+            for state in [st for st in self._leaves if st not in active]:
+                self._cut(self._leaves[state])
+        node = self._root
+        while True:
+            if node.state is not None:
+                if node.state in active:
+                    break
+                self._cut(node)
+                node = self._root
+            elif node.children:
+                node = self.random.choice(node.children)
+            elif not active:
+                raise ValueError('No active states to select from')
+            else:
+                self.reset(active)
+                node = self._root
+        self._last = node
+        return node.state
+
+
+class CoverageStrategy(SearchStrategy):
+    """
+    Prefer states sitting at instructions that have been stepped the fewest
+    times, so code that has not been covered yet gets stepped first.
+    """
+    def __init__(self):
+        super().__init__()
+        self.visits = {} # ip -> number of times a state at ip was selected
+
+    def priority(self, state):
+        ip = state_ip(state)
+        return (self.visits.get(ip, 0), state.ticks)
+
+    def select(self, active):
+        while True:
+            entry = self._pop(active)
+            if entry is None:
+                raise ValueError('No active states to select from')
+            priority, seq, state = entry
+            # visit counts only go up, so a stale entry only ever needs to
+            # move back in the queue
+            current = self.priority(state)
+            if current == priority:
+                break
+            self._queue.push(current, seq, state)
+
+        ip = state_ip(state)
+        self.visits[ip] = self.visits.get(ip, 0) + 1
+        return state
+
+
+def byte_distance(ip, targets):
+    """
+    How many bytes ip is away from the closest of targets
+    """
+    return min(abs(ip - target) for target in targets)
+
+
+class DistanceStrategy(SearchStrategy):
+    """
+    Step the state closest to one of :targets:
+
+    :distance: is a function (ip, targets) -> distance, byte_distance by
+    default. States with a symbolic ip come last.
+    """
+    def __init__(self, targets, distance=None):
+        super().__init__()
+        if isinstance(targets, int):
+            targets = (targets,)
+        self.targets = tuple(targets)
+        if distance is None:
+            distance = byte_distance
+        self.distance = distance
+
+    def priority(self, state):
+        ip = state_ip(state)
+        if ip is None:
+            return (float('inf'), state.ticks)
+        return (self.distance(ip, self.targets), state.ticks)
+
+
+class DirectedStrategy(SearchStrategy):
+    """
+    Step the state with the fewest instructions left to run to a target.
+
+    :distances: maps instruction addresses to how far they are from one
+    (see directed.target_distances). States anywhere else come last, and
+    ties go to the state that has been stepped the least.
+    """
+    def __init__(self, distances):
+        super().__init__()
+        self.distances = distances
+
+    def priority(self, state):
+        ip = state_ip(state)
+        return (self.distances.get(ip, float('inf')), state.ticks)
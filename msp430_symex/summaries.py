@@ -0,0 +1,305 @@
+"""
+Summaries of the library routines the lock firmware is built with.
+
+Stepping puts over a 40 character string takes hundreds of steps (a clone
+each, and a trip through the INT wrapper per character), even though nothing
+about it is symbolic. A summary does what the routine would do in one step:
+it's called with a state at the routine's entry, and returns the state the
+routine would be in once its loop is done, or None if it can't tell (say the
+string has symbolic bytes in it), in which case the routine is stepped
+normally.
+
+Summaries stop short of the routine's epilogue (popping saved registers,
+returning) and leave the state there, so the routine's own code still does
+that part. Everything else is done exactly, on ints, like concrete.py does:
+the registers, the memory written (down to the stack frames of the calls to
+INT, even though they're dead), the output, and the number of instructions
+run (the ticks). Flags are set as if every flag the last flag-setting
+instruction sets were live.
+
+Routines are found by their code: find_summaries matches the functions in
+the CFG against the byte signatures here. The address of INT is left out of
+signatures, but has to match INT's own signature. Summaries are registered
+with a CPU by address, in CPU.summaries. Code can be overwritten after that,
+so a summary checks the signature again every time it's used, and leaves a
+routine that doesn't match any more to run normally.
+"""
+import functools
+
+from .code import Register, OperandWidth
+from .cfg import CFG
+from .concrete import ConcreteStep, HandOff
+from .constants import BYTE_VALUES
+
+
+# byte signatures: hex, where ???? is the address of INT
+INT_SIGNATURE = '1e41 0200 0212 0f4e 8f10 024f 32d0 0080 b012 1000 3241 3041'
+
+_signatures = {
+    'puts': '0b12 0b4f 073c 1b53 8f11 0f12 0312 b012 ???? 2152 6f4b 4f93 f623'
+            '3012 0a00 0312 b012 ???? 2152 0f43 3b41 3041',
+    'getsn': '0e12 0f12 2312 b012 ???? 3150 0600 3041',
+    'strcpy': '0d4f 023c 1e53 1d53 6c4e cd4c 0000 4c93 f923 3041',
+    'memset': '0b12 0a12 0912 0812 0b4f 3d90 0600 082c 043c cb4e 0000 1b53'
+              '3d53 0d93 fa23 1e3c 4a4e 0a93 0324 0c4a 8c10 0adc 1fb3 0524'
+              '3d53 cf4e 0000 0b4f 1b53 0c4d 12c3 0c10 084b 094c 884a 0000'
+              '2853 3953 fb23 0c5c 0c5b 1df3 0d99 0224 cc4e 0000 3841 3941'
+              '3a41 3b41 3041',
+}
+
+# strings longer than this are left to run normally
+MAX_LENGTH = 0x1000
+
+
+def _words(signature):
+    """
+    A signature as a list of words: bytes, or None for INT's address
+    """
+    signature = signature.replace(' ', '')
+    words = [signature[i : i + 4] for i in range(0, len(signature), 4)]
+    return [None if word == '????' else bytes.fromhex(word) for word in words]
+
+
+def _length(name):
+    return 2 * len(_words(_signatures[name]))
+
+
+def _matches(memory, address, signature):
+    """
+    Whether the code at address in memory matches signature
+    """
+    for word in _words(signature):
+        values = [memory._read((address + i) & 0xffff) for i in (0, 1)]
+        if not all(isinstance(value, int) for value in values):
+            return False
+        if word is None:
+            target = values[0] | (values[1] << 8)
+            if not _matches(memory, target, INT_SIGNATURE):
+                return False
+        elif bytes(values) != word:
+            return False
+        address += 2
+    return True
+
+
+def _summary(run):
+    """
+    Wrap run(state, step, entry) into a summary, which returns None instead
+    of raising HandOff, or if the code at entry isn't the routine's
+    """
+    signature = _signatures[run.__name__]
+
+    @functools.wraps(run)
+    def summary(state):
+        step = ConcreteStep(state)
+        try:
+            entry = step.reg(Register.R0)
+            if not _matches(state.memory, entry, signature):
+                return None
+            return run(state, step, entry)
+        except HandOff:
+            return None
+    return summary
+
+
+def _push(step, value):
+    sp = (step.reg(Register.R1) - 2) & 0xffff
+    step.set_reg(Register.R1, sp)
+    step.write(sp, value, OperandWidth.WORD)
+
+
+def _call_int(step, number, return_address):
+    """
+    The stack frame of calling INT with interrupt number on the stack, as it
+    is when the interrupt runs, and the registers INT sets
+    """
+    _push(step, return_address)
+    _push(step, step.reg(Register.R2)) # push sr
+    step.set_reg(Register.R14, number)
+    step.set_reg(Register.R15, number << 8)
+
+
+def _clear_of(address, length, start, end):
+    """
+    Make sure [address, address+length) doesn't wrap around the end of
+    memory, or overlap [start, end)
+    """
+    if address + length > 0x10000:
+        raise HandOff('wraps around')
+    if address < end and start < address + length:
+        raise HandOff('overlaps {:04x}-{:04x}'.format(start, end))
+
+
+def _string(step, address):
+    """
+    The bytes of the NUL-terminated string at address (without the NUL)
+    """
+    string = []
+    while True:
+        byte = step.read(address + len(string), OperandWidth.BYTE)
+        if byte == 0:
+            return string
+        string.append(byte)
+        if len(string) > MAX_LENGTH:
+            raise HandOff('string too long')
+
+
+def _flags_after_cmp_zero(step, dst):
+    """
+    The flags of cmp #0, dst (C is clear, like the CPU does it)
+    """
+    step.set_flags({'N', 'Z', 'C', 'V'}, n=False, z=dst == 0, c=False, \
+            v=False)
+
+
+@_summary
+def puts(state, step, entry):
+    """
+    puts(r15): print the string at r15 and a newline. Stops before the
+    add #4, sp after putting the newline.
+    """
+    sp = step.reg(Register.R1)
+    _push(step, step.reg(Register.R11))
+    address = step.reg(Register.R15)
+    string = _string(step, address)
+    # the stack frames of the calls to INT go where the string can't be
+    _clear_of(address, len(string) + 1, sp - 10, sp - 2)
+
+    # the last call to INT, for the newline, leaves its frame behind
+    _push(step, 0x0a)
+    _push(step, 0)
+    step.set_reg(Register.R11, address + len(string))
+    _flags_after_cmp_zero(step, 0)
+    _call_int(step, 0, entry + 0x24)
+    step.set_reg(Register.R1, sp - 6)
+    step.set_reg(Register.R0, entry + 0x24)
+
+    # push, mov, jmp; mov.b, cmp.b, jnz for every byte and the NUL; 5 for
+    # each putchar, 9 in INT and add #4, sp; then 3 and 9 for the newline
+    st = step.apply(3 + 3 * (len(string) + 1) + 15 * len(string) + 12)
+    for byte in string + [0x0a]:
+        st.sym_output.add(BYTE_VALUES[byte])
+    return [st]
+
+
+@_summary
+def getsn(state, step, entry):
+    """
+    getsn(r15, r14): read up to r14 bytes of input into r15. Stops before
+    the add #6, sp after the interrupt.
+    """
+    sp = step.reg(Register.R1)
+    _push(step, step.reg(Register.R14))
+    _push(step, step.reg(Register.R15))
+    _push(step, 0x02)
+    _call_int(step, 0x02, entry + 0x0a)
+    step.set_reg(Register.R0, entry + 0x0a)
+
+    # 3 pushes, the call, and 8 of INT before the interrupt, which is run
+    # with the stack as INT has it
+    st = step.apply(12)
+    st, = st.cpu.int_gets(st)
+    st.cpu.registers[Register.R1] = (sp - 6) & 0xffff
+    return [st]
+
+
+@_summary
+def strcpy(state, step, entry):
+    """
+    strcpy(r15, r14): copy the string at r14 (with its NUL) to r15. Stops at
+    the ret.
+    """
+    dest, src = step.reg(Register.R15), step.reg(Register.R14)
+    length = 0
+    while True:
+        byte = step.read(src + length, OperandWidth.BYTE)
+        step.write(dest + length, byte, OperandWidth.BYTE)
+        if byte == 0:
+            break
+        length += 1
+        if length > MAX_LENGTH:
+            raise HandOff('string too long')
+    _clear_of(dest, length + 1, entry, entry + _length('strcpy'))
+
+    step.set_reg(Register.R12, 0)
+    step.set_reg(Register.R13, dest + length)
+    step.set_reg(Register.R14, src + length)
+    _flags_after_cmp_zero(step, 0)
+    step.set_reg(Register.R0, entry + 0x12)
+
+    # mov, jmp; mov.b, mov.b, cmp.b, jnz for every byte and the NUL, and
+    # inc, inc for every byte
+    return [step.apply(2 + 4 * (length + 1) + 2 * length)]
+
+
+@_summary
+def memset(state, step, entry):
+    """
+    memset(r15, r14, r13): fill r13 bytes at r15 with the byte r14. Stops at
+    the pops.
+    """
+    dest = step.reg(Register.R15)
+    byte = step.reg(Register.R14) & 0xff
+    count = step.reg(Register.R13)
+    if count > MAX_LENGTH:
+        raise HandOff('memset too long')
+    _clear_of(dest, count, entry, entry + _length('memset'))
+    for register in (Register.R11, Register.R10, Register.R9, Register.R8):
+        _push(step, step.reg(register))
+    for i in range(count):
+        step.write(dest + i, byte, OperandWidth.BYTE)
+
+    # 4 pushes, mov, cmp, jc
+    instructions = 7
+    if count < 6:
+        # a byte at a time
+        step.set_reg(Register.R11, dest + count)
+        step.set_reg(Register.R13, 0)
+        instructions += 1 + 2 * (count + 1) + 3 * count + 1
+    else:
+        # a word at a time, from the first even address, and the last byte
+        # on its own if there's one left over
+        instructions += 3 + 2 + 5 + 5
+        pattern = byte | (byte << 8)
+        if byte:
+            instructions += 3
+        start = dest
+        if dest & 1:
+            start, count = dest + 1, count - 1
+            instructions += 4
+        words = count >> 1
+        instructions += 4 * words + (count & 1)
+        step.set_reg(Register.R8, start + 2 * words)
+        step.set_reg(Register.R9, 0)
+        step.set_reg(Register.R10, pattern)
+        step.set_reg(Register.R11, start)
+        step.set_reg(Register.R12, start + 2 * words)
+        step.set_reg(Register.R13, count & 1)
+    _flags_after_cmp_zero(step, step.registers[Register.R13])
+    step.set_reg(Register.R0, entry + 0x5c)
+    return [step.apply(instructions)]
+
+
+# name -> summary, for everything there's a signature of
+SUMMARIES = {
+    'puts': puts,
+    'getsn': getsn,
+    'strcpy': strcpy,
+    'memset': memset,
+}
+
+
+def find_summaries(memory, entry_point):
+    """
+    Build the CFG of the program in memory starting at entry_point, and
+    return a dict of function address -> summary, for the functions that
+    match one of the signatures
+    """
+    cfg = CFG(memory)
+    cfg.generate_all_functions(entry_point)
+    found = {}
+    for fn in cfg.functions:
+        for name, signature in _signatures.items():
+            if _matches(memory, fn.entry_point, signature):
+                found[fn.entry_point] = SUMMARIES[name]
+    return found
@@ -0,0 +1,59 @@
+from z3 import BitVecVal, simplify
+
+from msp430_symex.memory import Memory
+from msp430_symex.code import Register
+from msp430_symex.state import blank_state
+
+
+def program_memory(program, address=0x4400):
+    """
+    A Memory holding program (hex, spaces allowed) at address, and zeroes
+    everywhere else
+    """
+    image = bytearray(0x10000)
+    program = bytes.fromhex(program.replace(' ', ''))
+    image[address : address + len(program)] = program
+    return Memory(image)
+
+
+def program_state(program, ip=0x4400, address=0x4400, **cpu):
+    """
+    A blank state about to run program (see program_memory) from ip, with a
+    stack at 0x4000. Keyword arguments are set on its CPU.
+    """
+    state = blank_state()
+    state.memory = program_memory(program, address)
+    state.cpu.registers[Register.R0] = BitVecVal(ip, 16)
+    state.cpu.registers[Register.R1] = BitVecVal(0x4000, 16)
+    for name, value in cpu.items():
+        setattr(state.cpu, name, value)
+    return state
+
+
+def intval(value):
+    """
+    The value of a constant z3 expression (or an int) as an int
+    """
+    if isinstance(value, int):
+        return value
+    return simplify(value).as_long()
+
+
+def ip(state):
+    """
+    The concrete ip of state
+    """
+    return intval(state.cpu.registers[Register.R0])
+
+
+def run_to(state, address, blocks=None):
+    """
+    Step state until it gets to address, with no forks on the way (see
+    State.step for blocks)
+    """
+    while ip(state) != address:
+        successors = [st for st in state.step(blocks=blocks) \
+                if st.path.is_sat()]
+        assert len(successors) == 1
+        state, = successors
+    return state
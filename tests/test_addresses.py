@@ -0,0 +1,155 @@
+import unittest
+
+from z3 import BitVec, BitVecVal, ZeroExt, ULE, Solver, sat, unsat
+
+from msp430_symex.addresses import AddressResolver
+from msp430_symex.memory import Memory, SymbolicAddressError
+from msp430_symex.code import Register
+from msp430_symex.state import PathGroup
+from msp430_symex.serialize import serialize_state, deserialize_state
+
+from tests.helpers import program_state, intval
+
+
+# 4400: mov.b 0x2400(r15), r14
+# 4404: cmp.b #0x42, r14
+# 4408: jnz 0x4414
+# 440a: mov #0xff00, sr
+# 440e: call #0x10 (unlock)
+# 4412: jmp $
+# 4414: jmp $
+TABLE_PROGRAM = '5e4f 0024 7e90 4200 0520 3240 00ff b012 1000 ff3f ff3f'
+
+
+def table_state(resolver):
+    """
+    A state with a table of 0x100 bytes at 0x2400, where only 0x2437 holds
+    0x42, and TABLE_PROGRAM at 0x4400
+    """
+    state = program_state(TABLE_PROGRAM)
+    for i in range(0x100):
+        state.memory[0x2400 + i] = i ^ 0x75
+    state.memory.addresses = resolver
+    state.memory.path = state.path
+    return state
+
+
+def solve(state, *conditions):
+    solver = Solver()
+    solver.add(state.path.pred(), *conditions)
+    return solver
+
+
+class TestAddressResolver(unittest.TestCase):
+
+    def test_no_resolver(self):
+        memory = Memory([])
+        with self.assertRaises(SymbolicAddressError):
+            memory[BitVec('x', 16)]
+        with self.assertRaises(SymbolicAddressError):
+            memory[BitVec('x', 16)] = BitVecVal(0, 8)
+
+    def test_range(self):
+        state = table_state(AddressResolver())
+        x = BitVec('x', 16)
+        state.path.add(ULE(x, 0x20))
+        state.path.add(ULE(0x10, x))
+        resolver = state.memory.addresses
+        self.assertEqual(resolver.range(x + 0x2400, state.path), \
+                (0x2410, 0x2420))
+
+        # cached
+        self.assertEqual(len(resolver._ranges), 1)
+        resolver.range(x + 0x2400, state.path)
+        self.assertEqual(len(resolver._ranges), 1)
+
+        state.path.add(x == 0x18)
+        self.assertEqual(resolver.range(x + 0x2400, state.path), \
+                (0x2418, 0x2418))
+        self.assertEqual(intval(state.memory[x + 0x2400]), 0x18 ^ 0x75)
+
+    def test_small_range(self):
+        state = table_state(AddressResolver())
+        x = BitVec('x', 16)
+        state.path.add(ULE(x, 0xff))
+
+        # the If chain has every byte in the table
+        byte = state.memory[x + 0x2400]
+        for i in (0, 0x37, 0xff):
+            solver = solve(state, byte == (i ^ 0x75))
+            self.assertEqual(solver.check(), sat)
+            self.assertEqual(solver.model().eval(x).as_long(), i)
+        self.assertEqual(len(state.path._path), 1)
+
+        # a write updates every byte it could have gone to
+        state.memory[x + 0x2400] = BitVecVal(0xaa, 8)
+        self.assertEqual(solve(state, x == 3, \
+                state.memory[0x2403] != 0xaa).check(), unsat)
+        self.assertEqual(solve(state, x == 3, \
+                state.memory[0x2404] != 0x04 ^ 0x75).check(), unsat)
+
+    def test_array(self):
+        state = table_state(AddressResolver(max_range=0x10))
+        x = BitVec('x', 16)
+        byte = state.memory[x]
+        for address, value in ((0x2437, 0x42), (0x4400, 0x5e), (0x1000, 0)):
+            solver = solve(state, x == address, byte != value)
+            self.assertEqual(solver.check(), unsat)
+        self.assertEqual(len(state.path._path), 0)
+
+    def test_policies(self):
+        x = BitVec('x', 16)
+        for policy, values in (('min', {0x10}), ('max', {0x80}), \
+                ('solutions', None)):
+            with self.subTest(policy=policy):
+                state = table_state(AddressResolver(max_range=0x10, \
+                        policy=policy, max_solutions=4))
+                state.path.add(ULE(0x10, x))
+                state.path.add(ULE(x, 0x80))
+                byte = state.memory[x + 0x2400]
+
+                # the path is narrowed down to the values picked
+                found = set()
+                solver = solve(state)
+                while solver.check() == sat:
+                    value = solver.model().eval(x).as_long()
+                    found.add(value)
+                    solver.add(x != value)
+                if values is not None:
+                    self.assertEqual(found, values)
+                else:
+                    self.assertEqual(len(found), 4)
+                for value in found:
+                    self.assertEqual(solve(state, x == value, \
+                            byte != (value ^ 0x75)).check(), unsat)
+
+                state.memory[x + 0x2400] = BitVecVal(0xaa, 8)
+                for value in found:
+                    self.assertEqual(solve(state, x == value, \
+                            state.memory[0x2400 + value] != 0xaa).check(), \
+                            unsat)
+
+    def test_serialize(self):
+        state = table_state(AddressResolver(max_range=0x10, policy='min'))
+        base = Memory([])
+        state = deserialize_state(serialize_state(state, base), base)
+        self.assertEqual(state.memory.addresses.settings(), \
+                {'max_range': 0x10, 'policy': 'min', 'max_solutions': 8})
+        self.assertIs(state.memory.path, state.path)
+
+    def test_path_group(self):
+        # the table is indexed by an input byte, which has to be 0x37 to get
+        # 0x42 out of it
+        for resolver in (AddressResolver(), AddressResolver(max_range=0x10)):
+            with self.subTest(max_range=resolver.max_range):
+                state = table_state(resolver)
+                i = BitVec('i', 8)
+                state.cpu.registers[Register.R15] = ZeroExt(8, i)
+                pg = PathGroup([state], avoid=0x4414)
+                pg.step_until_unlocked()
+                unlocked, = pg.unlocked
+                self.assertEqual(unlocked.path.model.eval(i).as_long(), 0x37)
+
+
+if __name__ == '__main__':
+    unittest.main()
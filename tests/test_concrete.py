@@ -0,0 +1,95 @@
+import unittest
+
+from z3 import BitVec, simplify
+
+from msp430_symex.code import Register, decode_instruction
+from msp430_symex.concrete import step_concrete, run_block, BlockCache
+
+from tests.helpers import program_memory, program_state, run_to
+
+
+# 4400: mov #0x4500, r15
+# 4404: mov #3, r14
+# 4408: mov.b #0x41, 0(r15)
+# 440e: add #1, r15
+# 4410: sub #1, r14
+# 4412: jnz 0x4408
+# 4414: jmp $
+# 4416: ret (so flag lookahead stops here)
+PROGRAM = '3f40 0045 3e40 0300 ff40 4100 0000 1f53 1e83 fa23 ff3f 3041'
+
+
+class TestConcreteStep(unittest.TestCase):
+
+    def test_same_as_symbolic(self):
+        concrete = run_to(program_state(PROGRAM, concrete=True), 0x4414)
+        symbolic = run_to(program_state(PROGRAM, concrete=False), 0x4414)
+
+        for i in range(16):
+            self.assertEqual(concrete.cpu.registers[Register(i)].as_long(), \
+                    simplify(symbolic.cpu.registers[Register(i)]).as_long())
+        self.assertEqual(concrete.memory[0x4500 : 0x4504], [0x41, 0x41, 0x41, 0])
+        self.assertEqual(concrete.memory.content_hash(), \
+                symbolic.memory.content_hash())
+
+    def test_no_forks(self):
+        state = run_to(program_state(PROGRAM, concrete=True), 0x4410)
+        # the symbolic CPU would fork on Z, and leave the solver one to drop
+        successors = state.step()
+        self.assertEqual(len(successors), 1)
+        self.assertEqual(successors[0].path._path, [])
+
+    def test_hands_off_symbolic_values(self):
+        state = run_to(program_state(PROGRAM, concrete=True), 0x4410)
+        state.cpu.registers[Register.R14] = BitVec('r14', 16)
+        insn, length = decode_instruction(0x4410, state.memory[0x4410 : 0x4416])
+        self.assertIsNone(step_concrete(state, insn, length))
+
+        # so the symbolic CPU runs it instead
+        self.assertEqual(len(state.step()), 2)
+
+    def test_hands_off_interrupts(self):
+        state = program_state('b012 1000') # call #0x10
+        insn, length = decode_instruction(0x4400, state.memory[0x4400 : 0x4406])
+        self.assertIsNone(step_concrete(state, insn, length))
+
+
+class TestBlocks(unittest.TestCase):
+
+    def test_block_boundaries(self):
+        memory = program_memory(PROGRAM)
+        block = BlockCache().get(memory, 0x4408)
+        self.assertEqual([insn.address for insn, _ in block.instructions], \
+                [0x4408, 0x440e, 0x4410, 0x4412])
+        # stops end blocks early
+        block = BlockCache(stops={0x4410}).get(memory, 0x4408)
+        self.assertEqual(block.end, 0x4410)
+
+    def test_run_block(self):
+        state = run_to(program_state(PROGRAM, concrete=True), 0x4408)
+        blocks = BlockCache()
+        successor, = state.step(blocks=blocks)
+        self.assertEqual(successor.cpu.registers[Register.R0].as_long(), 0x4408)
+        self.assertEqual(successor.cpu.registers[Register.R14].as_long(), 2)
+        self.assertEqual(successor.ticks, state.ticks + 4)
+
+        # the cached block isn't used once the code changes
+        # 440e: add #1, r15 -> add #2, r15
+        successor.memory[0x440e] = 0x2f
+        successor, = successor.step(blocks=blocks)
+        self.assertEqual(successor.cpu.registers[Register.R15].as_long(), 0x4503)
+
+    def test_hand_off_mid_block(self):
+        state = run_to(program_state(PROGRAM, concrete=True), 0x4408)
+        state.cpu.registers[Register.R14] = BitVec('r14', 16)
+        block = BlockCache().get(state.memory, 0x4408)
+
+        # stops before the sub, which the symbolic CPU has to run
+        successor = run_block(state, block)
+        self.assertEqual(successor.cpu.registers[Register.R0].as_long(), 0x4410)
+        self.assertIsNone(run_block(successor, BlockCache().get( \
+                successor.memory, 0x4410)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from z3 import BitVec, Extract, Concat
+
+from msp430_symex import constants
+from msp430_symex.constants import bv, word, extract, concat, BYTE_VALUES
+
+
+class TestConstants(unittest.TestCase):
+
+    def test_shared_values(self):
+        self.assertIs(bv(0x41, 8), BYTE_VALUES[0x41])
+        self.assertIs(word(0x4400), bv(0x4400, 16))
+        # values wrap around like BitVecVal's
+        self.assertIs(bv(-1, 16), word(0xffff))
+        self.assertEqual(bv(1, 1).size(), 1)
+
+    def test_shapes(self):
+        x = BitVec('x', 16)
+        self.assertIs(extract(7, 0, x), extract(7, 0, x))
+        self.assertTrue(extract(7, 0, x).eq(Extract(7, 0, x)))
+        self.assertTrue(extract(15, 8, x).eq(Extract(15, 8, x)))
+
+        high, low = BYTE_VALUES[0x12], BYTE_VALUES[0x34]
+        self.assertIs(concat(high, low), concat(high, low))
+        self.assertTrue(concat(high, low).eq(Concat(high, low)))
+        self.assertFalse(concat(low, high).eq(Concat(high, low)))
+
+    def test_shapes_limit(self):
+        limit = constants.MAX_SHAPES
+        try:
+            constants.MAX_SHAPES = 2
+            constants._shapes.clear()
+            x, y = BitVec('x', 16), BitVec('y', 16)
+            extract(7, 0, x)
+            extract(7, 0, y)
+            # full, so this starts over
+            self.assertTrue(extract(15, 8, x).eq(Extract(15, 8, x)))
+            self.assertEqual(len(constants._shapes), 1)
+        finally:
+            constants.MAX_SHAPES = limit
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,10 @@
 import unittest
 from z3 import simplify
 
-from msp430_symex.code import decode_instruction, DoubleOperandInstruction, \
-        SingleOperandInstruction, JumpInstruction, Opcode, OperandWidth, \
-        AddressingMode, Register
+from msp430_symex.code import decode_instruction, clear_decode_cache, \
+        decode_image, get_template, \
+        DoubleOperandInstruction, SingleOperandInstruction, JumpInstruction, \
+        Opcode, OperandWidth, AddressingMode, Register
 
 
 class TestSingleOperandDecode(unittest.TestCase):
@@ -239,5 +240,64 @@ class TestDoubleOperandDecode(unittest.TestCase):
         self.assertEqual(dest_operand, 0x2400)
 
 
+class TestDecodeCache(unittest.TestCase):
+
+    def setUp(self):
+        clear_decode_cache()
+
+    def test_decode_cache_hit(self):
+        raw = b'\xb0\x12\x58\x45' # call #0x4558
+        ip = 0x4458
+
+        first = decode_instruction(ip, raw + b'\xFF\xFF')
+        second = decode_instruction(ip, list(raw) + [0, 0])
+        self.assertIs(first[0], second[0])
+
+    def test_decode_cache_rewritten_code(self):
+        ip = 0x4458
+
+        call, _ = decode_instruction(ip, b'\xb0\x12\x58\x45\xFF\xFF')
+        self.assertEqual(call.opcode, Opcode.CALL)
+
+        # same address, different code (e.g. self-modifying firmware)
+        jmp, _ = decode_instruction(ip, b'\x00\x3c\xFF\xFF\xFF\xFF')
+        self.assertEqual(jmp.opcode, Opcode.JMP)
+
+
+class TestDecodeTable(unittest.TestCase):
+
+    def setUp(self):
+        clear_decode_cache()
+
+    def test_decode_table_shares_templates(self):
+        # same instruction word at two addresses shares one template
+        a, _ = decode_instruction(0x4400, b'\x3f\x40\x00\x44\xFF\xFF')
+        b, _ = decode_instruction(0x4500, b'\x3f\x40\x34\x12\xFF\xFF')
+        self.assertIs(get_template(0x403f), get_template(0x403f))
+        self.assertEqual(simplify(a.source_operand).as_long(), 0x4400)
+        self.assertEqual(simplify(b.source_operand).as_long(), 0x1234)
+
+    def test_decode_table_invalid_word(self):
+        # 0x1380 would be a single-operand instruction with opcode 0b111
+        with self.assertRaises(AssertionError):
+            decode_instruction(0x4400, b'\x80\x13\xFF\xFF\xFF\xFF')
+
+    def test_decode_image(self):
+        data = bytearray(0x10)
+        data[0:4] = b'\xb0\x12\x58\x45' # call #0x4558
+        data[4:6] = b'\x80\x13' # not an instruction
+        data[6:8] = b'\x00\x3c' # jmp $+2
+
+        decoded = decode_image(data, end=8)
+
+        self.assertEqual(decoded[0][0].opcode, Opcode.CALL)
+        self.assertEqual(decoded[0][1], 4)
+        self.assertNotIn(4, decoded)
+        self.assertEqual(decoded[6][0].opcode, Opcode.JMP)
+        # batch decodes are picked up by later single decodes
+        self.assertIs(decode_instruction(6, b'\x00\x3c\xFF\xFF\xFF\xFF')[0], \
+                decoded[6][0])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,111 @@
+import gc
+import unittest
+import weakref
+from unittest import mock
+
+from z3 import BitVec, BitVecVal
+
+from msp430_symex.state import PathGroup
+from msp430_symex.strategy import DFSStrategy
+
+from tests.helpers import program_state
+
+
+class TestDeduplication(unittest.TestCase):
+
+    def test_fingerprint(self):
+        a = program_state('3f40 0100')
+        b = program_state('3f40 0100')
+        # ip + 0 simplifies to the same thing as ip
+        b.cpu.registers['R0'] = b.cpu.registers['R0'] + 0
+        self.assertEqual(a.fingerprint(), b.fingerprint())
+
+        b.memory[0x2400] = 1
+        self.assertNotEqual(a.fingerprint(), b.fingerprint())
+
+    def test_stale_bytes_under_symbolic_memory(self):
+        # the same symbolic byte, over different stale concrete ones
+        s = BitVec('s', 8)
+        a = program_state('3f40 0100')
+        a.memory[0x2400] = 5
+        a.memory[0x2400] = s
+        b = program_state('3f40 0100')
+        b.memory[0x2400] = 7
+        b.memory[0x2400] = s
+        self.assertEqual(a.memory.content_hash(), b.memory.content_hash())
+        self.assertEqual(a.fingerprint(), b.fingerprint())
+
+        b.memory[0x2400] = BitVec('t', 8)
+        self.assertNotEqual(a.memory.content_hash(), b.memory.content_hash())
+
+    def test_seen_states_not_kept(self):
+        # only the fingerprints and path conditions of states seen are kept,
+        # not the states
+        state = program_state('3f40 0100 ff3f')
+        pg = PathGroup([state], dedupe=True)
+        ref = weakref.ref(state)
+        del state
+        pg.step()
+        pg.step()
+        self.assertEqual(len(pg.active), 0) # the jmp $ went nowhere new
+        # the strategy's queue drops stepped states lazily
+        pg.strategy.reset(pg.active)
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_seen_bounded(self):
+        state = program_state('3f40 0100 ff3f')
+        with mock.patch('msp430_symex.state.MAX_SEEN', 2):
+            pg = PathGroup([state], dedupe=True)
+            for _ in range(4):
+                if pg.active:
+                    pg.step()
+                self.assertLessEqual(len(pg._seen), 2)
+            self.assertGreater(pg.duplicate_count, 0)
+
+    def make_pair(self):
+        x = BitVec('x', 16)
+        # mov #1, r15; jmp $
+        general = program_state('3f40 0100 ff3f')
+        general.cpu.registers['R14'] = x
+        general.path.add(x > 4)
+        narrow = general.clone()
+        narrow.path.add(x < 8)
+        return general, narrow
+
+    def test_subsumed_state_dropped(self):
+        general, narrow = self.make_pair()
+        pg = PathGroup([general, narrow], dedupe=True)
+        self.assertEqual(pg.active, {general})
+        self.assertEqual(pg.duplicate_count, 1)
+
+    def test_general_state_replaces_narrow_one(self):
+        general, narrow = self.make_pair()
+        # narrow is already past the mov
+        narrow.cpu.registers['R0'] = BitVecVal(0x4404, 16)
+        narrow.cpu.registers['R15'] = BitVecVal(1, 16)
+
+        pg = PathGroup([narrow, general], strategy=DFSStrategy(), dedupe=True)
+        pg.step() # general catches up with narrow
+        self.assertEqual(pg.duplicate_count, 1)
+        state, = pg.active
+        self.assertEqual(len(state.path._path), 1)
+
+    def test_loop_without_progress_ends(self):
+        state = program_state('ff3f') # jmp $
+        pg = PathGroup([state], dedupe=True)
+        pg.step()
+        self.assertEqual(pg.active, set())
+        self.assertEqual(pg.duplicate_count, 1)
+
+    def test_dedupe_off_by_default(self):
+        state = program_state('3f40 0100 ff3f')
+        pg = PathGroup([state, state.clone()])
+        pg.step()
+        pg.step()
+        self.assertEqual(len(pg.active), 2)
+        self.assertEqual(pg.duplicate_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+
+from z3 import BitVec
+
+from msp430_symex.cfg import CFG
+from msp430_symex.state import PathGroup
+from msp430_symex.directed import TargetDistances, target_distances, dead_ends
+
+from tests.helpers import program_memory, program_state
+
+
+# main:
+#   4400: call #0x440a
+#   4404: jmp $
+# login:
+#   440a: sub #0x10, sp
+#   440e: mov sp, r15
+#   4410: call #0x441c
+#   4414: add #0x10, sp
+#   4418: ret
+# getsn:
+#   441c: push #2
+#   441e: call #0x4426
+#   4422: incd sp
+#   4424: ret
+# INT:
+#   4426: call #0x10
+#   442a: ret
+GETS_PROGRAM = 'b012 0a44 ff3f 3041 3041 3180 1000 0f41 b012 1c44 3150 1000' \
+        '3041 3041 2312 b012 2644 2153 3041 b012 1000 3041'
+
+# 4400: cmp #0x1234, r15
+# 4404: jnz 0x4420
+# 4406: mov #0xff00, sr
+# 440a: call #0x10
+# 440e: ret
+UNLOCK_PROGRAM = '3f90 3412 0d20 3240 00ff b012 1000 3041'
+
+# 4400: cmp #0x1234, r15
+# 4404: jnz 0x4410
+# 4406: mov #0xff00, sr
+# 440a: call #0x10
+# 440e: jmp $
+# 4410: call #0x4416
+# 4414: jmp $
+# 4416: ret
+DEAD_END_PROGRAM = '3f90 3412 0520 3240 00ff b012 1000 ff3f b012 1644 ff3f 3041'
+
+
+class TestTargetDistances(unittest.TestCase):
+
+    def test_return_after_input(self):
+        cfg = CFG(program_memory(GETS_PROGRAM))
+        cfg.generate_all_functions(0x4400)
+        distances = TargetDistances(cfg)
+        distances.analyze()
+
+        # login's ret, not the ones in getsn or INT
+        self.assertEqual(distances.input_returns, {0x4418})
+        self.assertEqual(distances.unlocks, set())
+        # through getsn and INT, and back
+        self.assertEqual(distances.distances[0x4410], 8)
+        self.assertEqual(distances.distances[0x4400], 11)
+        # nothing after main's jmp $ gets anywhere
+        self.assertNotIn(0x4404, distances.distances)
+
+    def test_unlock_through_callgate(self):
+        distances = target_distances(program_memory(UNLOCK_PROGRAM), 0x4400)
+        self.assertEqual(distances[0x440a], 0)
+        self.assertEqual(distances[0x4400], 3)
+        self.assertNotIn(0x440e, distances)
+
+    def test_dead_ends(self):
+        dead = dead_ends(program_memory(DEAD_END_PROGRAM), 0x4400)
+        # the ret at 0x4416 only ever returns into the jmp $ at 0x4414
+        self.assertEqual(dead, {0x440e, 0x4410, 0x4414, 0x4416})
+
+        # main's ret has nowhere known to go, so it might go anywhere
+        self.assertEqual(dead_ends(program_memory(GETS_PROGRAM), 0x4400), \
+                {0x4404})
+
+    def test_no_targets(self):
+        # e.g. the code is packed, and this can't see any of it
+        self.assertEqual(dead_ends(program_memory('ff3f 3041'), 0x4400), \
+                frozenset())
+
+
+class TestAutoAvoid(unittest.TestCase):
+
+    def test_dead_ends_are_unsat(self):
+        state = program_state(DEAD_END_PROGRAM)
+        memory = state.memory
+        state.cpu.registers['R15'] = BitVec('r15', 16)
+
+        pg = PathGroup([state], dead_ends=dead_ends(memory, 0x4400))
+        pg.step_until_unlocked()
+        self.assertEqual(len(pg.unlocked), 1)
+        # the jnz into the dead end was dropped, not stepped
+        dead = [st for st in pg.unsat \
+                if st.cpu.registers['R0'].as_long() == 0x4410]
+        self.assertTrue(dead)
+        self.assertEqual(pg.active, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
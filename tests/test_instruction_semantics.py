@@ -1,6 +1,6 @@
 import unittest
 
-from z3 import simplify, BitVecVal, Concat
+from z3 import simplify, BitVec, BitVecVal, Concat, Solver, is_bv_value, unsat
 
 from msp430_symex.state import State, blank_state
 from msp430_symex.code import decode_instruction
@@ -1122,6 +1122,58 @@ class TestXorInstruction(unittest.TestCase):
             self.assertFalse(v_flag)
 
 
+class TestLazyFlags(unittest.TestCase):
+
+    def test_lazy_flags_cmp_does_not_fork(self):
+        # cmp.b #0x21, r15
+        raw = b'\x7f\x90\x21\x00'
+        ip = 0x1234
+
+        ins, _ = decode_instruction(ip, raw)
+
+        state = blank_state()
+        state.cpu.lazy_flags = True
+        x = BitVec('x', 8)
+        state.cpu.registers['R15'] = Concat(BitVecVal(0, 8), x)
+
+        new_states = state.cpu.step_cmp(state, ins, enable_unsound_optimizations=False)
+
+        self.assertEqual(len(new_states), 1)
+
+        # the flags are left in SR as expressions of x, not split on
+        flag_reg = simplify(new_states[0].cpu.registers['R2'])
+        self.assertFalse(is_bv_value(flag_reg))
+        z_flag = flag_reg & state.cpu.registers.mask_Z != 0
+        solver = Solver()
+        solver.add(z_flag != (x == 0x21))
+        self.assertEqual(solver.check(), unsat)
+        self.assertEqual(new_states[0].path._path, [])
+
+    def test_lazy_flags_split_at_jump(self):
+        # cmp.b #0x21, r15
+        raw = b'\x7f\x90\x21\x00'
+        cmp_ins, _ = decode_instruction(0x1230, raw)
+        # jz #0x1446
+        raw = b'\x08\x25'
+        jz_ins, _ = decode_instruction(0x1234, raw)
+
+        state = blank_state()
+        state.cpu.lazy_flags = True
+        state.cpu.registers['R15'] = Concat(BitVecVal(0, 8), BitVec('x', 8))
+
+        cmp_states = state.cpu.step_cmp(state, cmp_ins)
+        self.assertEqual(len(cmp_states), 1)
+
+        new_states = cmp_states[0].cpu.step_jz(cmp_states[0], jz_ins)
+        self.assertEqual(len(new_states), 2)
+
+        taken_states = [st for st in new_states if intval(st.cpu.registers['R0']) == 0x1446]
+        self.assertEqual(len(taken_states), 1)
+        taken = taken_states[0]
+        self.assertTrue(taken.path.is_sat())
+        self.assertEqual(taken.path.model[BitVec('x', 8)].as_long(), 0x21)
+
+
 # TODO: Test these!!
 """
 AND
@@ -0,0 +1,72 @@
+import unittest
+
+from z3 import BitVec, BitVecVal
+
+from msp430_symex.code import decode_instruction
+from msp430_symex.state import blank_state
+from msp430_symex.liveness import flag_liveness
+
+from tests.helpers import program_memory
+
+
+# main:
+#   4400: call #0x4410
+#   4404: jnz 0x440a
+#   4406: add #1, r15
+#   4408: jmp $
+#   440a: jmp $
+# 4410:
+#   4410: cmp #5, r15
+#   4414: add #1, r14
+#   4416: ret
+PROGRAM = 'b012 1044 0220 1f53 ff3f ff3f 0000 0000 3f90 0500 1e53 3041'
+
+
+class TestFlagLiveness(unittest.TestCase):
+
+    def test_liveness_across_calls(self):
+        live = flag_liveness(program_memory(PROGRAM), 0x4400)
+
+        # add kills everything the cmp set
+        self.assertEqual(live[0x4410][1], frozenset())
+        # ret goes back to the jnz
+        self.assertEqual(live[0x4414][1], frozenset({'Z'}))
+        self.assertEqual(live[0x4406][1], frozenset())
+
+    def test_saved_sr(self):
+        # 4400: cmp #0, r15
+        # 4402: push sr
+        # 4404: mov #0x8000, sr
+        # 4408: call #0x10
+        # 440c: pop sr
+        # 440e: jz 0x4412
+        # 4410: jmp $
+        # 4412: jmp $
+        program = '0f93 0212 3240 0080 b012 1000 3241 0124 ff3f ff3f'
+        live = flag_liveness(program_memory(program), 0x4400)
+        self.assertEqual(live[0x4400][1], frozenset({'Z'}))
+
+    def test_cpu_uses_liveness(self):
+        state = blank_state()
+        state.memory = program_memory(PROGRAM)
+        state.cpu.live_flags = flag_liveness(state.memory, 0x4400)
+        state.cpu.registers['R0'] = BitVecVal(0x4414, 16)
+        state.cpu.registers['R14'] = BitVec('r14', 16)
+
+        # only Z is live, so the add forks twice, not 16 times
+        self.assertEqual(len(state.step()), 2)
+
+    def test_cpu_ignores_rewritten_code(self):
+        state = blank_state()
+        state.memory = program_memory(PROGRAM)
+        state.cpu.live_flags = flag_liveness(state.memory, 0x4400)
+
+        # add #1, r14 -> add #2, r14
+        state.memory[0x4414] = BitVecVal(0x2e, 8)
+        insn, _ = decode_instruction(0x4414, state.memory[0x4414 : 0x441a])
+        self.assertEqual(state.cpu.flags_needed(state, insn, \
+                enable_unsound_optimizations=False), {'N', 'Z', 'C', 'V'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+
+from z3 import BitVec, BitVecVal, Solver, sat
+
+from msp430_symex.code import Register
+from msp430_symex.state import PathGroup
+from msp430_symex.loops import find_loops, summarize_loop
+
+from tests.helpers import program_memory, program_state, ip
+
+
+# 4400: mov #0x2400, r15
+# 4404: clr r12
+# strlen, counting the NUL:
+# 4406: mov.b @r15, r14
+# 4408: inc r15
+# 440a: inc r12
+# 440c: tst r14
+# 440e: jnz 0x4406
+# 4410: cmp #9, r12
+# 4414: jnz 0x4420
+# 4416: mov #0xff00, sr
+# 441a: call #0x10 (unlock)
+# 441e: jmp $
+# 4420: jmp $
+STRLEN_PROGRAM = '3f40 0024 0c43 6e4f 1f53 1c53 0e93 fb23 3c90 0900 0520' \
+        '3240 00ff b012 1000 ff3f ff3f'
+
+# 4400: clr r14
+# memcmp(r15, 0x2400, 8):
+# 4402: mov r15, r13
+# 4404: add r14, r13
+# 4406: cmp.b @r13, 0x2400(r14)
+# 440a: jnz 0x4412
+# 440c: inc r14
+# 440e: cmp #8, r14
+# 4410: jnz 0x4402
+# 4412: jmp $
+# 4414: ret (so flag lookahead stops here)
+COMPARE_PROGRAM = '0e43 0d4f 0d5e ee9d 0024 0320 1e53 3e92 f823 ff3f 3041'
+
+# 4400: mov.b #0x41, 0(r15) (writes memory)
+# 4404: inc r15
+# 4406: sub #1, r14
+# 4408: jnz 0x4400
+# 440a: bis #0xf0, sr (halts, no way out)
+# 440e: jmp 0x440a
+OTHER_LOOPS_PROGRAM = 'ff40 4100 0000 1f53 1e83 fb23 32d0 f000 fd3f'
+
+
+def symbolic_string(state, address, length):
+    """
+    length symbolic bytes at address, and a NUL after them
+    """
+    string = [BitVec('b{}'.format(i), 8) for i in range(length)]
+    for i, byte in enumerate(string):
+        state.memory[address + i] = byte
+    state.memory[address + length] = BitVecVal(0, 8)
+    return string
+
+
+class TestFindLoops(unittest.TestCase):
+
+    def test_find_loops(self):
+        self.assertEqual(find_loops(program_memory(STRLEN_PROGRAM), 0x4400), \
+                {0x4406: 0x4410})
+        self.assertEqual(find_loops(program_memory(COMPARE_PROGRAM), 0x4400), \
+                {0x4402: 0x4412})
+
+    def test_other_loops(self):
+        self.assertEqual(find_loops(program_memory(OTHER_LOOPS_PROGRAM), \
+                0x4400), {})
+
+
+class TestSummarizeLoop(unittest.TestCase):
+
+    def test_strlen(self):
+        state = program_state(STRLEN_PROGRAM, 0x4406)
+        state.cpu.registers[Register.R15] = BitVecVal(0x2400, 16)
+        state.cpu.registers[Register.R12] = BitVecVal(0, 16)
+        string = symbolic_string(state, 0x2400, 16)
+
+        # one state for every length
+        left, = summarize_loop(state, 0x4410)
+        self.assertEqual(ip(left), 0x4410)
+
+        # where r12 is how far it got
+        for length in (0, 5, 16):
+            solver = Solver()
+            solver.add(left.path.pred())
+            solver.add(left.cpu.registers[Register.R12] == length + 1)
+            self.assertEqual(solver.check(), sat)
+            model = solver.model()
+            values = [model.eval(b, model_completion=True).as_long() \
+                    for b in string]
+            self.assertNotIn(0, values[:length])
+            if length < 16:
+                self.assertEqual(values[length], 0)
+            self.assertEqual(model.eval(left.cpu.registers[Register.R15]) \
+                    .as_long(), 0x2400 + length + 1)
+
+    def test_compare(self):
+        state = program_state(COMPARE_PROGRAM, 0x4402)
+        state.cpu.registers[Register.R14] = BitVecVal(0, 16)
+        state.cpu.registers[Register.R15] = BitVecVal(0x3000, 16)
+        for i, byte in enumerate(b'password'):
+            state.memory[0x2400 + i] = BitVecVal(byte, 8)
+        string = symbolic_string(state, 0x3000, 8)
+
+        # a mismatch and getting to the end both leave to 0x4412 (through the
+        # jnz out, or falling through the jnz back), in one state
+        left, = summarize_loop(state, 0x4412)
+        self.assertEqual(ip(left), 0x4412)
+
+        # where r14 is how many bytes matched
+        for matched in (0, 3, 8):
+            solver = Solver()
+            solver.add(left.path.pred())
+            solver.add(left.cpu.registers[Register.R14] == matched)
+            self.assertEqual(solver.check(), sat)
+            model = solver.model()
+            values = bytes(model.eval(b, model_completion=True).as_long() \
+                    for b in string)
+            self.assertEqual(values[:matched], b'password'[:matched])
+            if matched < 8:
+                self.assertNotEqual(values[matched], b'password'[matched])
+
+    def test_path_group(self):
+        # the loop leaves one state, whatever the length of the string
+        for loops in ({}, {0x4406: 0x4410}):
+            state = program_state(STRLEN_PROGRAM, 0x4400, loops=loops)
+            string = symbolic_string(state, 0x2400, 32)
+            pg = PathGroup([state], avoid=0x4420)
+            pg.step_until_unlocked()
+            unlocked, = pg.unlocked
+            model = unlocked.path.model
+            values = [model.eval(b, model_completion=True).as_long() \
+                    for b in string]
+            self.assertNotIn(0, values[:8])
+            self.assertEqual(values[8], 0)
+            if loops:
+                self.assertLess(pg.tick_count, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
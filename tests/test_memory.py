@@ -0,0 +1,64 @@
+import unittest
+
+from z3 import BitVec, BitVecVal, Extract
+
+from msp430_symex.memory import Memory, PAGE_SIZE, parse_mc_memory_dump
+
+from tests.helpers import intval
+
+
+class TestMemoryCopyOnWrite(unittest.TestCase):
+
+    def test_clone_write_copies_one_page(self):
+        memory = Memory([])
+        memory[0x1234] = BitVecVal(0x41, 8)
+
+        other = memory.clone()
+        other[0x1234] = BitVecVal(0x42, 8)
+
+        self.assertEqual(intval(memory[0x1234]), 0x41)
+        self.assertEqual(intval(other[0x1234]), 0x42)
+
+        # only the written page got copied
+        written = 0x1234 // PAGE_SIZE
+        for i, (a, b) in enumerate(zip(memory._pages, other._pages)):
+            if i == written:
+                self.assertIsNot(a, b)
+            else:
+                self.assertIs(a, b)
+
+    def test_slice_across_pages(self):
+        memory = Memory([])
+        base = PAGE_SIZE - 2
+        for i in range(4):
+            memory[base + i] = BitVecVal(i + 1, 8)
+
+        self.assertEqual([intval(x) for x in memory[base : base + 4]], [1, 2, 3, 4])
+
+    def test_slice_past_end(self):
+        memory = Memory([])
+        self.assertEqual(len(memory[0xfffe : 0x10004]), 2)
+
+    def test_symbolic_overlay_copy_on_write(self):
+        memory = Memory([])
+        x = BitVec('x', 8)
+        memory[0x10] = x
+
+        other = memory.clone()
+        other[0x10] = BitVecVal(0x42, 8)
+
+        self.assertIs(memory[0x10], x)
+        self.assertEqual(intval(other[0x10]), 0x42)
+
+
+class TestMemoryConcreteBytes(unittest.TestCase):
+
+    def test_slices_are_ints(self):
+        memory = parse_mc_memory_dump('4400:   3140 0044 1542 5c01 75f3 35d0 085a 3f40   1@.D.B\\.u.5..Z?@')
+        self.assertEqual(memory[0x4400 : 0x4404], [0x31, 0x40, 0x00, 0x44])
+
+    def test_concrete_expressions_stored_as_bytes(self):
+        memory = Memory([])
+        memory[0x10] = Extract(7, 0, BitVecVal(0x1234, 16) + 1)
+        self.assertEqual(memory[0x10 : 0x11], [0x35])
+        self.assertEqual(memory._symbolic, {})
@@ -0,0 +1,64 @@
+import unittest
+
+from z3 import BitVec, BitVecVal, If, Solver, sat
+
+from msp430_symex.memory import Memory
+from msp430_symex.state import PathGroup
+from msp430_symex.liveness import flag_liveness
+from msp430_symex.merge import join_points, _merge_memory
+
+from tests.helpers import program_memory, program_state
+
+
+# 4400: cmp #5, r15
+# 4404: jz 0x440a
+# 4406: mov #1, r14
+# 4408: jmp 0x440c
+# 440a: mov #2, r14
+# 440c: jmp $
+PROGRAM = '3f90 0500 0224 1e43 013c 2e43 ff3f'
+
+
+class TestStateMerging(unittest.TestCase):
+
+    def test_join_points(self):
+        self.assertEqual(join_points(program_memory(PROGRAM), 0x4400), {0x440c})
+
+    def test_if_else_merged(self):
+        state = program_state(PROGRAM)
+        memory = state.memory
+        state.cpu.live_flags = flag_liveness(memory, 0x4400)
+        r15 = BitVec('r15', 16)
+        state.cpu.registers['R15'] = r15
+
+        pg = PathGroup([state], merge_points=join_points(memory, 0x4400))
+        while pg.merge_count == 0:
+            pg.step()
+
+        state, = pg.active
+        self.assertEqual(state.cpu.registers['R0'].as_long(), 0x440c)
+        # r14 depends on which way the jz went
+        r14 = state.cpu.registers['R14']
+        for value, expected in ((5, 2), (6, 1)):
+            solver = Solver()
+            solver.add(state.path.pred(), r15 == value, r14 != expected)
+            self.assertNotEqual(solver.check(), sat)
+        self.assertTrue(state.path.is_sat())
+
+    def test_symbolic_byte_over_stale_pages(self):
+        # the same symbolic byte, over different (stale) concrete bytes
+        s = BitVec('s', 8)
+        a = Memory([])
+        a[0x2400] = BitVecVal(5, 8)
+        a[0x2400] = s
+        b = Memory([])
+        b[0x2400] = BitVecVal(7, 8)
+        b[0x2400] = s
+        x = BitVec('x', 16)
+        merged = _merge_memory(a, b, \
+                lambda value, b_value: If(x == 1, value, b_value))
+        self.assertTrue(merged[0x2400].eq(s))
+
+
+if __name__ == '__main__':
+    unittest.main()
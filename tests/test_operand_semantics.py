@@ -1,6 +1,6 @@
 import unittest
 
-from z3 import BitVecVal, simplify
+from z3 import BitVec, BitVecVal, simplify
 
 from msp430_symex.code import Opcode, OperandWidth, Register, AddressingMode, \
         SingleOperandInstruction, DoubleOperandInstruction, JumpInstruction, \
@@ -1085,5 +1085,31 @@ class TestGetDoubleOperandDestLocation(unittest.TestCase):
         self.assertFalse(state.path.is_sat())
 
 
+class TestRegisterFile(unittest.TestCase):
+
+    def test_keys(self):
+        registers = RegisterFile()
+        registers['r15'] = BitVecVal(0x1234, 16)
+        self.assertEqual(registers[Register.R15].as_long(), 0x1234)
+        self.assertEqual(registers['R15'].as_long(), 0x1234)
+        self.assertEqual(registers[15].as_long(), 0x1234)
+
+    def test_concrete_and_symbolic(self):
+        registers = RegisterFile()
+        x = BitVec('x', 16)
+        registers[Register.R4] = 0x12345
+        registers[Register.R5] = x
+        self.assertEqual(registers.concrete(Register.R4), 0x2345)
+        self.assertIsNone(registers.concrete(Register.R5))
+        self.assertTrue(registers[Register.R5].eq(x))
+
+    def test_clone(self):
+        registers = RegisterFile({Register.R4: BitVecVal(1, 16)})
+        clone = registers.clone()
+        clone[Register.R4] = 2
+        self.assertEqual(registers.concrete(Register.R4), 1)
+        self.assertEqual(clone.concrete(Register.R4), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
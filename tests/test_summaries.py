@@ -0,0 +1,180 @@
+import unittest
+
+from z3 import BitVec, BitVecVal, simplify
+
+from msp430_symex.memory import Memory
+from msp430_symex.code import Register
+from msp430_symex.state import blank_state
+from msp430_symex.concrete import BlockCache
+from msp430_symex.serialize import serialize_state, deserialize_state
+from msp430_symex.summaries import find_summaries, puts, getsn, strcpy, \
+        memset
+
+from tests.helpers import ip, run_to
+
+
+# the routines as the firmware has them, with INT at 0x4500
+ROUTINES = {
+    # INT
+    0x4500: '1e41 0200 0212 0f4e 8f10 024f 32d0 0080 b012 1000 3241 3041',
+    # puts
+    0x4520: '0b12 0b4f 073c 1b53 8f11 0f12 0312 b012 0045 2152 6f4b 4f93 f623'
+            '3012 0a00 0312 b012 0045 2152 0f43 3b41 3041',
+    # getsn
+    0x4560: '0e12 0f12 2312 b012 0045 3150 0600 3041',
+    # strcpy
+    0x4580: '0d4f 023c 1e53 1d53 6c4e cd4c 0000 4c93 f923 3041',
+    # memset
+    0x45a0: '0b12 0a12 0912 0812 0b4f 3d90 0600 082c 043c cb4e 0000 1b53'
+            '3d53 0d93 fa23 1e3c 4a4e 0a93 0324 0c4a 8c10 0adc 1fb3 0524'
+            '3d53 cf4e 0000 0b4f 1b53 0c4d 12c3 0c10 084b 094c 884a 0000'
+            '2853 3953 fb23 0c5c 0c5b 1df3 0d99 0224 cc4e 0000 3841 3941'
+            '3a41 3b41 3041',
+}
+
+# main: call #0x4520 (puts), then call #0x4580 (strcpy)
+MAIN = 'b012 2045 b012 8045 ff3f'
+
+
+def routines_memory():
+    image = bytearray(0x10000)
+    for address, code in list(ROUTINES.items()) + [(0x4400, MAIN)]:
+        code = bytes.fromhex(code.replace(' ', ''))
+        image[address : address + len(code)] = code
+    return Memory(image)
+
+
+def call_state(entry, **registers):
+    """
+    A state that just called entry, with the given registers
+    """
+    state = blank_state()
+    state.memory = routines_memory()
+    state.cpu.concrete = True
+    # so the flags left in SR are the same either way
+    state.cpu.lazy_flags = True
+    state.cpu.registers[Register.R0] = BitVecVal(entry, 16)
+    state.cpu.registers[Register.R1] = BitVecVal(0x4000, 16)
+    state.memory[0x4000] = BitVecVal(0x04, 8) # return address
+    state.memory[0x4001] = BitVecVal(0x44, 8)
+    for i in range(4, 16):
+        state.cpu.registers[Register(i)] = BitVecVal(0x1110 * i & 0xffff, 16)
+    for name, value in registers.items():
+        state.cpu.registers[Register[name.upper()]] = BitVecVal(value, 16)
+    return state
+
+
+def write_string(state, address, string):
+    for i, byte in enumerate(string + b'\0'):
+        state.memory[address + i] = BitVecVal(byte, 8)
+
+
+class TestSummaries(unittest.TestCase):
+
+    def assertSameState(self, summarized, stepped):
+        for i in range(16):
+            register = Register(i)
+            expected = simplify(stepped.cpu.registers[register])
+            actual = simplify(summarized.cpu.registers[register])
+            self.assertEqual(str(simplify(actual)), str(simplify(expected)), \
+                    register)
+        for address in range(0x3000, 0x4800):
+            self.assertEqual(str(simplify(summarized.memory[address])), \
+                    str(simplify(stepped.memory[address])), hex(address))
+        self.assertEqual(summarized.sym_output.dump(summarized), \
+                stepped.sym_output.dump(stepped))
+        self.assertEqual(summarized.ticks, stepped.ticks)
+
+    def check(self, summary, state, exit_address):
+        summarized, = summary(state)
+        self.assertEqual(ip(summarized), exit_address)
+        self.assertSameState(summarized, run_to(state, exit_address, \
+                BlockCache(stops={exit_address})))
+        return summarized
+
+    def test_puts(self):
+        state = call_state(0x4520, r15=0x3000)
+        write_string(state, 0x3000, b'Enter the password')
+        summarized = self.check(puts, state, 0x4544)
+        self.assertEqual(summarized.sym_output.dump(summarized), \
+                b'Enter the password\n')
+
+    def test_puts_empty(self):
+        state = call_state(0x4520, r15=0x3000)
+        write_string(state, 0x3000, b'')
+        self.check(puts, state, 0x4544)
+
+    def test_getsn(self):
+        self.check(getsn, call_state(0x4560, r15=0x3100, r14=0x1c), 0x456a)
+
+    def test_strcpy(self):
+        state = call_state(0x4580, r15=0x3101, r14=0x3000)
+        write_string(state, 0x3000, b'hello')
+        self.check(strcpy, state, 0x4592)
+
+    def test_memset(self):
+        for dest, byte, count in [(0x3100, 0x41, 3), (0x3100, 0, 0), \
+                (0x3100, 0, 0x64), (0x3101, 0x41, 0x11), (0x3100, 0xaa, 7)]:
+            with self.subTest(dest=dest, byte=byte, count=count):
+                state = call_state(0x45a0, r15=dest, r14=byte, r13=count)
+                self.check(memset, state, 0x45fc)
+
+    def test_symbolic(self):
+        # symbolic bytes in the string, run normally
+        state = call_state(0x4520, r15=0x3000)
+        write_string(state, 0x3000, b'ab')
+        state.memory[0x3001] = BitVec('x', 8)
+        self.assertIsNone(puts(state))
+
+        state = call_state(0x45a0, r15=0x3100, r14=0)
+        state.cpu.registers[Register.R13] = BitVec('n', 16)
+        self.assertIsNone(memset(state))
+
+    def test_out_of_bounds(self):
+        # too long, or past the end of memory: run normally
+        for dest, count in [(0x5000, 0x2000), (0xfff0, 0x20)]:
+            with self.subTest(dest=dest, count=count):
+                state = call_state(0x45a0, r15=dest, r14=0, r13=count)
+                self.assertIsNone(memset(state))
+
+        state = call_state(0x4580, r15=0xfffe, r14=0x3000)
+        write_string(state, 0x3000, b'hello')
+        self.assertIsNone(strcpy(state))
+
+    def test_overwritten(self):
+        # the code changed since the summary was found
+        state = call_state(0x4580, r15=0x3101, r14=0x3000)
+        write_string(state, 0x3000, b'hello')
+        # mov.b r12, 0(r13) -> mov.b r12, 0(r14)
+        state.memory[0x458a] = BitVecVal(0xce, 8)
+        self.assertIsNone(strcpy(state))
+
+        # and so did INT, which puts calls
+        state = call_state(0x4520, r15=0x3000)
+        write_string(state, 0x3000, b'hi')
+        state.memory[0x4500] = BitVecVal(0x30, 8) # INT starts with a ret
+        self.assertIsNone(puts(state))
+
+    def test_find_summaries(self):
+        self.assertEqual(find_summaries(routines_memory(), 0x4400), \
+                {0x4520: puts, 0x4580: strcpy})
+
+    def test_step(self):
+        state = call_state(0x4400, r15=0x3000, r14=0x3000)
+        write_string(state, 0x3000, b'hi')
+        state.cpu.summaries = find_summaries(state.memory, 0x4400)
+        state, = state.step() # call #0x4520
+        state, = state.step()
+        self.assertEqual(ip(state), 0x4544)
+        self.assertEqual(state.sym_output.dump(state), b'hi\n')
+
+    def test_serialize(self):
+        state = call_state(0x4400)
+        state.cpu.summaries = {0x4520: puts}
+        base = routines_memory()
+        state = deserialize_state(serialize_state(state, base), base)
+        self.assertEqual(state.cpu.summaries, {0x4520: puts})
+
+
+if __name__ == '__main__':
+    unittest.main()